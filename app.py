@@ -1,10 +1,42 @@
-from flask import Flask, request, jsonify, render_template_string
+from flask import Flask, Blueprint, Response, current_app, g, request, jsonify
+import click
+import functools
 import psycopg2
 import os
+import signal
+import sys
+import time
 from datetime import datetime, timezone
 import json
+from db_pool import db_connection, get_pool, close_pool, DatabaseUnavailable
+from replicas import read_connection, get_router, close_router, REPLICA_MAX_LAG
+from meter_cache import get_registry
+from ingest_queue import get_ingest_queue, async_ingest_enabled, QueueFull
+from pagination import encode_cursor, decode_cursor, InvalidCursor
+from export import build_export_query, stream_readings, EXPORT_FORMATS
+from reading_formats import (columnar, pack_binary, epoch_to_datetime, READING_FORMATS, COLUMNAR_SELECT,
+                             BINARY_SELECT, BINARY_MIMETYPE, BINARY_RECORD)
+from rollups import create_rollup_schema, rebuild_rollups, get_consumption, INTERVALS
+from quality import rescore_readings
+from partitions import (setup_readings_table, partitioning_enabled, migrate_to_partitioned,
+                        maintain_partitions, PartitionMaintainer, PARTITION_INTERVAL)
+from stats import get_stats_service
+from listing_cache import get_listing_cache
+from health import get_readiness_probe
+from compression import StaticPage, compress_response, get_compression_stats
+from metrics import inc, observe, gauge_add, render as render_metrics, get_snapshot_writer
+from recent_readings import get_recent_readings, create_recent_readings_trigger
+from reading_stream import get_reading_stream, StreamFull, STREAM_HEARTBEAT, STREAM_MAX_SECONDS
+from fleet_query import parse_fleet_query, query_fleet, FleetQueryError
+from downsample import downsample_readings, DOWNSAMPLE_METHODS, DOWNSAMPLE_MAX_POINTS
+from cold_storage import get_cold_store, merge_cold, parse_date_param, archive_month, archive_months, ARCHIVE_DIR
+from billing import (create_billing_schema, create_run, run_billing, start_billing_run, get_run, consumption_query,
+                     BILLING_WORKERS, BILLING_CHUNK_METERS)
+from ingest import (validate_reading, parse_batch_body, insert_batch, insert_reading,
+                    ReadingError, BATCH_MAX_ROWS)
 
-app = Flask(__name__)
+# Routes and CLI commands live on a blueprint so create_app() can build the app per process
+api = Blueprint('api', __name__, cli_group=None)
 
 # HTML Dashboard Template
 DASHBOARD_HTML = '''<!DOCTYPE html>
@@ -156,14 +188,17 @@ DASHBOARD_HTML = '''<!DOCTYPE html>
         <div class="card full-width">
             <h2>🔧 API Information</h2>
             <div class="api-info">
-                <p><strong>API Base URL:</strong> <code>{{ request.url_root }}</code></p>
+                <p><strong>API Base URL:</strong> <code id="apiBase"></code></p>
                 <p><strong>Available Endpoints:</strong></p>
                 <ul>
                     <li><code>GET /api/v1/customers</code> - List all customers</li>
                     <li><code>GET /api/v1/meters</code> - List all meters</li>
                     <li><code>POST /api/v1/readings</code> - Submit meter reading</li>
                     <li><code>GET /api/v1/readings/{meter_id}</code> - Get meter history</li>
+                    <li><code>GET /api/v1/stream</code> - Live readings and count deltas (Server-Sent Events, <code>?meter_id=</code> to filter)</li>
+                    <li><code>GET /api/v1/stats</code> - System statistics (<code>?exact=true</code> for exact counts)</li>
                     <li><code>GET /health</code> - Health check</li>
+                    <li><code>GET /health/live</code>, <code>GET /health/ready</code> - Liveness and readiness probes</li>
                 </ul>
             </div>
         </div>
@@ -171,11 +206,51 @@ DASHBOARD_HTML = '''<!DOCTYPE html>
     <script>
         const API_BASE = window.location.origin;
         let meters = [], customers = [];
+        let meterReadings = null;   // last GET /api/v1/readings/{meter_id} response for the selected meter
+        let stream = null, streamLive = false;
         
         document.addEventListener("DOMContentLoaded", function() {
-            loadDashboard(); setupEventListeners(); setDefaultDateTime();
+            document.getElementById("apiBase").textContent = `${API_BASE}/`;
+            loadDashboard(); setupEventListeners(); setDefaultDateTime(); openStream("");
         });
         
+        // Live updates: new readings for the selected meter and reading-count deltas.
+        // The server ends streams periodically; the browser reconnects and "ready" triggers a refetch.
+        // A stream opened for a newly selected meter refetches nothing: its data was just loaded.
+        function openStream(meterId, reopened = false) {
+            if (stream) stream.close();
+            streamLive = false;
+            let connected = reopened;   // per stream: only a reconnect may have missed events
+            stream = new EventSource(`${API_BASE}/api/v1/stream${meterId ? `?meter_id=${encodeURIComponent(meterId)}` : ""}`);
+            stream.addEventListener("ready", () => {
+                if (connected) resync();
+                connected = true; streamLive = true;
+            });
+            stream.addEventListener("reading", event => {
+                const reading = JSON.parse(event.data);
+                if (!meterReadings || meterReadings.meter_info.meter_id !== reading.meter_id) return;
+                meterReadings.readings.unshift(reading);
+                meterReadings.readings.sort((a, b) => new Date(b.reading_date) - new Date(a.reading_date));
+                meterReadings.readings = meterReadings.readings.slice(0, 100);
+                renderMeterReadings();
+            });
+            stream.addEventListener("stats", event => {
+                const counter = document.getElementById("readingCount");
+                const current = parseInt(counter.textContent, 10);
+                if (!isNaN(current)) counter.textContent = current + JSON.parse(event.data).readings;
+            });
+            stream.addEventListener("resync", resync);
+            stream.onerror = () => {
+                streamLive = false;
+                // Refused (e.g. 503 when the server has too many streams): retry later, refetch meanwhile
+                if (stream.readyState === EventSource.CLOSED) setTimeout(() => openStream(meterId, true), 30000);
+            };
+        }
+        
+        function resync() {
+            loadDashboard(); loadMeterReadings();
+        }
+        
         function setDefaultDateTime() {
             const now = new Date();
             now.setMinutes(now.getMinutes() - now.getTimezoneOffset());
@@ -184,13 +259,15 @@ DASHBOARD_HTML = '''<!DOCTYPE html>
         
         function setupEventListeners() {
             document.getElementById("readingForm").addEventListener("submit", submitReading);
-            document.getElementById("meterSelect").addEventListener("change", loadMeterReadings);
+            document.getElementById("meterSelect").addEventListener("change", event => {
+                loadMeterReadings(); openStream(event.target.value);
+            });
         }
         
         async function loadDashboard() {
             try {
                 const [statsData, customersData, metersData] = await Promise.all([
-                    fetch(`${API_BASE}/api/v1/test-db`).then(r => r.json()),
+                    fetch(`${API_BASE}/api/v1/stats`).then(r => r.json()),
                     fetch(`${API_BASE}/api/v1/customers`).then(r => r.json()),
                     fetch(`${API_BASE}/api/v1/meters`).then(r => r.json())
                 ]);
@@ -249,7 +326,9 @@ DASHBOARD_HTML = '''<!DOCTYPE html>
                 
                 if (response.ok) {
                     alertDiv.innerHTML = `<div class="alert alert-success">✅ Reading submitted successfully! Reading ID: ${result.reading_id}</div>`;
-                    form.reset(); setDefaultDateTime(); await loadDashboard(); await loadMeterReadings();
+                    form.reset(); setDefaultDateTime();
+                    // The live stream delivers the new reading and count; refetch only without it
+                    if (!streamLive) { await loadDashboard(); await loadMeterReadings(); }
                 } else {
                     alertDiv.innerHTML = `<div class="alert alert-error">❌ Error: ${result.error}</div>`;
                 }
@@ -263,48 +342,56 @@ DASHBOARD_HTML = '''<!DOCTYPE html>
         async function loadMeterReadings() {
             const meterId = document.getElementById("meterSelect").value;
             const readingsSection = document.getElementById("readingsSection");
+            meterReadings = null;
             if (!meterId) { readingsSection.innerHTML = "<p>Select a meter to view readings.</p>"; return; }
             
             try {
                 readingsSection.innerHTML = "<p>Loading readings...</p>";
                 const response = await fetch(`${API_BASE}/api/v1/readings/${meterId}`);
                 const data = await response.json();
-                
-                if (data.readings && data.readings.length > 0) {
-                    const html = `<h3>📊 ${data.meter_info.meter_id} - ${data.meter_info.manufacturer} ${data.meter_info.model}</h3><p><strong>Customer:</strong> ${data.meter_info.customer_id} | <strong>Type:</strong> ${data.meter_info.meter_type}</p><div style="max-height: 400px; overflow-y: auto;">${data.readings.map(reading => `<div class="meter-reading"><strong>${reading.reading_value.toLocaleString()}</strong> ${data.meter_info.meter_type === "electric" ? "kWh" : data.meter_info.meter_type === "gas" ? "m³" : "L"}<span style="float: right; color: #666;">${new Date(reading.reading_date).toLocaleString()}</span><br><small>Type: ${reading.reading_type} | Quality: ${reading.quality_code}${reading.temperature ? ` | Temp: ${reading.temperature}°C` : ""}</small></div>`).join("")}</div>`;
-                    readingsSection.innerHTML = html;
-                } else {
-                    readingsSection.innerHTML = "<p>No readings found for this meter.</p>";
-                }
+                if (data.meter_info) meterReadings = data;
+                renderMeterReadings(data);
             } catch (error) {
                 readingsSection.innerHTML = "<p>Error loading readings.</p>";
             }
         }
+        
+        function renderMeterReadings(data = meterReadings) {
+            const readingsSection = document.getElementById("readingsSection");
+            if (data.readings && data.readings.length > 0) {
+                const html = `<h3>📊 ${data.meter_info.meter_id} - ${data.meter_info.manufacturer} ${data.meter_info.model}</h3><p><strong>Customer:</strong> ${data.meter_info.customer_id} | <strong>Type:</strong> ${data.meter_info.meter_type}</p><div style="max-height: 400px; overflow-y: auto;">${data.readings.map(reading => `<div class="meter-reading"><strong>${reading.reading_value.toLocaleString()}</strong> ${data.meter_info.meter_type === "electric" ? "kWh" : data.meter_info.meter_type === "gas" ? "m³" : "L"}<span style="float: right; color: #666;">${new Date(reading.reading_date).toLocaleString()}</span><br><small>Type: ${reading.reading_type} | Quality: ${reading.quality_code}${reading.temperature ? ` | Temp: ${reading.temperature}°C` : ""}</small></div>`).join("")}</div>`;
+                readingsSection.innerHTML = html;
+            } else {
+                readingsSection.innerHTML = "<p>No readings found for this meter.</p>";
+            }
+        }
     </script>
 </body>
 </html>'''
 
-def get_db_connection():
-    try:
-        conn = psycopg2.connect(
-            host=os.environ.get('DB_HOST'),
-            database=os.environ.get('DB_NAME', 'postgres'),
-            user=os.environ.get('DB_USER', 'postgres'),
-            password=os.environ.get('DB_PASSWORD')
-        )
-        return conn
-    except Exception as e:
-        print(f'DB error: {e}')
-        return None
+# The page has no server-side substitutions, so it is compressed once and served from memory
+DASHBOARD_PAGE = StaticPage(DASHBOARD_HTML, 'text/html', max_age=int(os.environ.get('DASHBOARD_MAX_AGE', 3600)))
+
+SCHEMA_LOCK_ID = 0x736d7369   # pg advisory lock key for schema setup
 
 def init_database():
-    conn = get_db_connection()
-    if not conn:
+    try:
+        with db_connection() as conn:
+            return _init_schema(conn)
+    except DatabaseUnavailable:
         return False
-    
+
+def create_readings_triggers(cur):
+    create_rollup_schema(cur)
+    create_recent_readings_trigger(cur)
+
+def _init_schema(conn):
     try:
         cur = conn.cursor()
         
+        # Serialize concurrent startups (several tasks rolling out at once) on the DDL below
+        cur.execute('SELECT pg_advisory_xact_lock(%s)', (SCHEMA_LOCK_ID,))
+        
         # Create customers table
         cur.execute('''
             CREATE TABLE IF NOT EXISTS customers (
@@ -333,28 +420,75 @@ def init_database():
             );
         ''')
         
-        # Create meter_readings table
+        # Create meter_readings table, range-partitioned on reading_date if configured
+        partitioned = setup_readings_table(cur) if partitioning_enabled() else False
+        if not partitioned:
+            cur.execute('''
+                CREATE TABLE IF NOT EXISTS meter_readings (
+                    reading_id SERIAL PRIMARY KEY,
+                    meter_id VARCHAR(50) REFERENCES meters(meter_id),
+                    customer_id VARCHAR(50) REFERENCES customers(customer_id),
+                    reading_value DECIMAL(12,3) NOT NULL,
+                    reading_date TIMESTAMP NOT NULL,
+                    reading_type VARCHAR(20) DEFAULT 'automatic',
+                    quality_code VARCHAR(10) DEFAULT 'good',
+                    temperature DECIMAL(5,2),
+                    voltage DECIMAL(5,2),
+                    signal_strength INTEGER,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    UNIQUE(meter_id, reading_date)
+                );
+            ''')
+        
+        # Notify listeners (the meter registry cache) when meter attributes change.
+        # last_reading_date is not in the column list so ingestion does not fire it.
         cur.execute('''
-            CREATE TABLE IF NOT EXISTS meter_readings (
-                reading_id SERIAL PRIMARY KEY,
-                meter_id VARCHAR(50) REFERENCES meters(meter_id),
-                customer_id VARCHAR(50) REFERENCES customers(customer_id),
-                reading_value DECIMAL(12,3) NOT NULL,
-                reading_date TIMESTAMP NOT NULL,
-                reading_type VARCHAR(20) DEFAULT 'automatic',
-                quality_code VARCHAR(10) DEFAULT 'good',
-                temperature DECIMAL(5,2),
-                voltage DECIMAL(5,2),
-                signal_strength INTEGER,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                UNIQUE(meter_id, reading_date)
-            );
+            CREATE OR REPLACE FUNCTION notify_meter_change() RETURNS trigger AS $$
+            BEGIN
+                IF TG_OP <> 'INSERT' THEN
+                    PERFORM pg_notify('meters_changed', OLD.meter_id);
+                END IF;
+                IF TG_OP <> 'DELETE' THEN
+                    PERFORM pg_notify('meters_changed', NEW.meter_id);
+                END IF;
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql;
+        ''')
+        cur.execute('DROP TRIGGER IF EXISTS meters_notify_change ON meters;')
+        cur.execute('''
+            CREATE TRIGGER meters_notify_change
+            AFTER INSERT OR DELETE OR UPDATE OF meter_id, customer_id, meter_type, manufacturer, model, status
+            ON meters FOR EACH ROW EXECUTE FUNCTION notify_meter_change();
         ''')
         
-        # Create indexes for performance
-        cur.execute('CREATE INDEX IF NOT EXISTS idx_readings_meter_date ON meter_readings(meter_id, reading_date);')
+        # Statement-level change notifications for customers (listing cache invalidation)
+        cur.execute('''
+            CREATE OR REPLACE FUNCTION notify_table_change() RETURNS trigger AS $$
+            BEGIN
+                PERFORM pg_notify(TG_ARGV[0], '');
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql;
+        ''')
+        cur.execute('DROP TRIGGER IF EXISTS customers_notify_change ON customers;')
+        cur.execute('''
+            CREATE TRIGGER customers_notify_change
+            AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON customers
+            FOR EACH STATEMENT EXECUTE FUNCTION notify_table_change('customers_changed');
+        ''')
+        
+        # Create indexes for performance (the partitioned layout's unique index already covers meter_id, reading_date)
+        if not partitioned:
+            cur.execute('CREATE INDEX IF NOT EXISTS idx_readings_meter_date ON meter_readings(meter_id, reading_date);')
         cur.execute('CREATE INDEX IF NOT EXISTS idx_readings_customer ON meter_readings(customer_id);')
         cur.execute('CREATE INDEX IF NOT EXISTS idx_readings_date ON meter_readings(reading_date);')
+        cur.execute('CREATE INDEX IF NOT EXISTS idx_customers_name ON customers(customer_name, customer_id);')
+        cur.execute('CREATE INDEX IF NOT EXISTS idx_meters_customer ON meters(customer_id);')
+        
+        # Consumption rollups and recent-readings notifications, both triggers on meter_readings
+        create_readings_triggers(cur)
+        create_billing_schema(cur)
         
         # Insert sample data
         cur.execute('''
@@ -383,25 +517,63 @@ def init_database():
         print(f'Init error: {e}')
         conn.rollback()
         return False
-    finally:
-        conn.close()
+
+@api.before_app_request
+def start_request_metrics():
+    g.metrics_route = request.url_rule.rule if request.url_rule else 'unmatched'
+    g.metrics_started = time.perf_counter()
+    gauge_add('http_requests_in_flight', (g.metrics_route,), 1)
+
+@api.after_app_request
+def record_request_metrics(response):
+    # Streamed bodies are still being sent, so this is time to first byte for them
+    route = g.get('metrics_route', 'unmatched')
+    observe('http_request_duration_seconds', (route, request.method, str(response.status_code)),
+            time.perf_counter() - g.get('metrics_started', time.perf_counter()))
+    if not response.is_streamed:
+        observe('http_response_bytes', (route,), response.calculate_content_length() or 0)
+    return response
+
+# Registered after the metrics hook so it runs first: http_response_bytes counts bytes sent
+@api.after_app_request
+def compress(response):
+    return compress_response(request, response)
+
+@api.teardown_app_request
+def finish_request_metrics(exc):
+    if 'metrics_route' in g:
+        gauge_add('http_requests_in_flight', (g.metrics_route,), -1)
 
 # WEB DASHBOARD ROUTE
-@app.route('/')
+@api.route('/')
 def dashboard():
-    return render_template_string(DASHBOARD_HTML)
+    return DASHBOARD_PAGE.response(request, Response)
 
-@app.route('/health')
+@api.route('/health')
 def health():
-    db_status = 'connected' if get_db_connection() else 'disconnected'
+    probe = get_readiness_probe().status()
     return jsonify({
         'status': 'healthy',
-        'database': db_status,
+        'database': probe['database'],
         'service': 'Smart Meter Reading API with Web Dashboard',
         'timestamp': datetime.now(timezone.utc).isoformat()
     })
 
-@app.route('/debug-env')
+@api.route('/health/live')
+def health_live():
+    # Process is up and serving requests; deliberately no I/O
+    return jsonify({'status': 'alive', 'timestamp': datetime.now(timezone.utc).isoformat()})
+
+@api.route('/health/ready')
+def health_ready():
+    probe = get_readiness_probe().status()
+    return jsonify({
+        'status': 'ready' if probe['ready'] else 'not_ready',
+        **probe,
+        'timestamp': datetime.now(timezone.utc).isoformat()
+    }), 200 if probe['ready'] else 503
+
+@api.route('/debug-env')
 def debug_env():
     return jsonify({
         'DB_HOST': os.environ.get('DB_HOST', 'NOT_SET'),
@@ -413,255 +585,741 @@ def debug_env():
 
 
 
-@app.route('/api/v1/test-db')
+@api.route('/api/v1/test-db')
 def test_db():
-    conn = get_db_connection()
-    if not conn:
-        return jsonify({'database': 'error', 'message': 'Connection failed'}), 500
-    
     try:
-        cur = conn.cursor()
-        cur.execute('SELECT version()')
-        version = cur.fetchone()
-        
-        # Get table counts
-        cur.execute('SELECT COUNT(*) FROM customers')
-        customers = cur.fetchone()[0]
-        cur.execute('SELECT COUNT(*) FROM meters')
-        meters = cur.fetchone()[0]
-        cur.execute('SELECT COUNT(*) FROM meter_readings')
-        readings = cur.fetchone()[0]
-        
-        conn.close()
+        with read_connection(wants_primary()) as conn:
+            cur = conn.cursor()
+            cur.execute('SELECT version(), pg_is_in_recovery()')
+            version = cur.fetchone()
+            
+            # Get table counts
+            cur.execute('SELECT COUNT(*) FROM customers')
+            customers = cur.fetchone()[0]
+            cur.execute('SELECT COUNT(*) FROM meters')
+            meters = cur.fetchone()[0]
+            cur.execute('SELECT COUNT(*) FROM meter_readings')
+            readings = cur.fetchone()[0]
+        
         return jsonify({
             'database': 'connected',
             'postgres_version': version[0],
+            'replica': version[1],
             'data_summary': {
                 'customers': customers,
                 'meters': meters,
                 'readings': readings
             }
         })
+    except DatabaseUnavailable:
+        return jsonify({'database': 'error', 'message': 'Connection failed'}), 500
     except Exception as e:
         return jsonify({'database': 'error', 'message': str(e)}), 500
 
-@app.route('/api/v1/customers')
-def get_customers():
-    conn = get_db_connection()
-    if not conn:
+@api.route('/api/v1/stats')
+def get_stats():
+    exact = request.args.get('exact', 'false').lower() in ('1', 'true', 'yes')
+    try:
+        return jsonify(get_stats_service().get(functools.partial(read_connection, wants_primary()), exact=exact))
+    except DatabaseUnavailable:
         return jsonify({'error': 'Database connection failed'}), 500
-    
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@api.route('/metrics')
+def metrics():
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+@api.route('/api/v1/db-pool')
+def db_pool_stats():
+    return jsonify(get_pool().stats())
+
+@api.route('/api/v1/replicas')
+def replica_stats():
+    router = get_router()
+    return jsonify(router.stats() if router else {'replicas': []})
+
+@api.route('/api/v1/cold-storage')
+def cold_storage_stats():
+    return jsonify(get_cold_store().stats())
+
+@api.route('/api/v1/recent-readings')
+def recent_readings_stats():
+    return jsonify(get_recent_readings().stats())
+
+@api.route('/api/v1/stream')
+def stream_events():
     try:
+        sub = get_reading_stream().subscribe(request.args.getlist('meter_id'))
+    except StreamFull as e:
+        response = jsonify({'error': str(e)})
+        response.headers['Retry-After'] = '30'
+        return response, 503
+    response = Response(get_reading_stream().events(sub, STREAM_HEARTBEAT, STREAM_MAX_SECONDS),
+                        mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@api.route('/api/v1/live-streams')
+def live_stream_stats():
+    return jsonify(get_reading_stream().stats())
+
+@api.route('/api/v1/compression')
+def compression_stats():
+    return jsonify(get_compression_stats().stats())
+
+@api.route('/api/v1/meter-cache')
+def meter_cache_stats():
+    return jsonify(get_registry().stats())
+
+LISTING_MAX_LIMIT = 1000
+
+def listing_page_params(filters):
+    # No limit and no cursor keeps the original full-table response
+    limit = request.args.get('limit')
+    cursor = request.args.get('cursor')
+    params = {name: request.args.get(name) for name in filters if request.args.get(name)}
+    if limit is not None or cursor:
+        params['limit'] = int(limit or 100)
+        if not 1 <= params['limit'] <= LISTING_MAX_LIMIT:
+            raise ValueError(f'limit must be between 1 and {LISTING_MAX_LIMIT}')
+    if cursor:
+        params['cursor'] = cursor
+    return params
+
+def wants_primary():
+    """Read-your-writes override: ?consistency=primary or X-Read-Consistency: primary skips replicas."""
+    return (request.args.get('consistency') == 'primary'
+            or request.headers.get('X-Read-Consistency', '').lower() == 'primary')
+
+def listing_connection():
+    # A rebuild right after a change notification must not cache what a lagging replica still shows
+    return read_connection(wants_primary() or get_listing_cache().invalidated_within(REPLICA_MAX_LAG))
+
+def conditional_json(etag, body):
+    response = Response(body, mimetype='application/json')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
+
+def build_customers_listing(params):
+    query = 'SELECT customer_id, account_number, customer_name, service_address, utility_type, rate_class FROM customers WHERE TRUE'
+    args = []
+    if 'utility_type' in params:
+        query += ' AND utility_type = %s'
+        args.append(params['utility_type'])
+    if 'cursor' in params:
+        after = decode_cursor('customers', params['cursor'], (str, str))
+        query += ' AND (customer_name, customer_id) > (%s, %s)'
+        args.extend(after)
+    query += ' ORDER BY customer_name, customer_id'
+    if 'limit' in params:
+        query += ' LIMIT %s'
+        args.append(params['limit'] + 1)
+    
+    with listing_connection() as conn:
         cur = conn.cursor()
-        cur.execute('SELECT customer_id, account_number, customer_name, service_address, utility_type, rate_class FROM customers ORDER BY customer_name')
+        cur.execute(query, args)
         customers = cur.fetchall()
-        
-        customer_list = []
-        for row in customers:
-            customer_list.append({
-                'customer_id': row[0],
-                'account_number': row[1],
-                'customer_name': row[2],
-                'service_address': row[3],
-                'utility_type': row[4],
-                'rate_class': row[5]
-            })
-        
-        conn.close()
-        return jsonify({
-            'customers': customer_list,
-            'count': len(customer_list)
+    
+    next_cursor = None
+    if 'limit' in params and len(customers) > params['limit']:
+        customers = customers[:params['limit']]
+        next_cursor = encode_cursor('customers', [customers[-1][2], customers[-1][0]])
+    
+    customer_list = []
+    for row in customers:
+        customer_list.append({
+            'customer_id': row[0],
+            'account_number': row[1],
+            'customer_name': row[2],
+            'service_address': row[3],
+            'utility_type': row[4],
+            'rate_class': row[5]
         })
+    
+    payload = {
+        'customers': customer_list,
+        'count': len(customer_list)
+    }
+    if 'limit' in params:
+        payload['next_cursor'] = next_cursor
+    return current_app.json.dumps(payload).encode('utf-8')
+
+@api.route('/api/v1/customers')
+def get_customers():
+    try:
+        params = listing_page_params(['utility_type'])
+        key = ('customers', tuple(sorted(params.items())))
+        etag, body = get_listing_cache().get(key, lambda: build_customers_listing(params))
+        return conditional_json(etag, body)
+    except (ValueError, InvalidCursor) as e:
+        return jsonify({'error': f'Invalid pagination parameters: {e}'}), 400
+    except DatabaseUnavailable:
+        return jsonify({'error': 'Database connection failed'}), 500
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-@app.route('/api/v1/meters')
-def get_meters():
-    conn = get_db_connection()
-    if not conn:
-        return jsonify({'error': 'Database connection failed'}), 500
+def build_meters_listing(params):
+    query = '''
+        SELECT m.meter_id, m.customer_id, m.meter_type, m.manufacturer, m.model, 
+               m.install_date, m.last_reading_date, m.status, c.customer_name
+        FROM meters m
+        JOIN customers c ON m.customer_id = c.customer_id
+        WHERE TRUE
+    '''
+    args = []
+    for name, column in (('meter_type', 'm.meter_type'), ('status', 'm.status'),
+                         ('customer_id', 'm.customer_id'), ('utility_type', 'c.utility_type')):
+        if name in params:
+            query += f' AND {column} = %s'
+            args.append(params[name])
+    if 'cursor' in params:
+        query += ' AND m.meter_id > %s'
+        args.extend(decode_cursor('meters', params['cursor'], (str,)))
+    query += ' ORDER BY m.meter_id'
+    if 'limit' in params:
+        query += ' LIMIT %s'
+        args.append(params['limit'] + 1)
     
-    try:
+    with listing_connection() as conn:
         cur = conn.cursor()
-        cur.execute('''
-            SELECT m.meter_id, m.customer_id, m.meter_type, m.manufacturer, m.model, 
-                   m.install_date, m.last_reading_date, m.status, c.customer_name
-            FROM meters m
-            JOIN customers c ON m.customer_id = c.customer_id
-            ORDER BY m.meter_id
-        ''')
+        cur.execute(query, args)
         meters = cur.fetchall()
-        
-        meter_list = []
-        for row in meters:
-            meter_list.append({
-                'meter_id': row[0],
-                'customer_id': row[1],
-                'meter_type': row[2],
-                'manufacturer': row[3],
-                'model': row[4],
-                'install_date': row[5].isoformat() if row[5] else None,
-                'last_reading_date': row[6].isoformat() if row[6] else None,
-                'status': row[7],
-                'customer_name': row[8]
-            })
-        
-        conn.close()
-        return jsonify({
-            'meters': meter_list,
-            'count': len(meter_list)
+    
+    next_cursor = None
+    if 'limit' in params and len(meters) > params['limit']:
+        meters = meters[:params['limit']]
+        next_cursor = encode_cursor('meters', [meters[-1][0]])
+    
+    meter_list = []
+    for row in meters:
+        meter_list.append({
+            'meter_id': row[0],
+            'customer_id': row[1],
+            'meter_type': row[2],
+            'manufacturer': row[3],
+            'model': row[4],
+            'install_date': row[5].isoformat() if row[5] else None,
+            'last_reading_date': row[6].isoformat() if row[6] else None,
+            'status': row[7],
+            'customer_name': row[8]
         })
+    
+    payload = {
+        'meters': meter_list,
+        'count': len(meter_list)
+    }
+    if 'limit' in params:
+        payload['next_cursor'] = next_cursor
+    return current_app.json.dumps(payload).encode('utf-8')
+
+@api.route('/api/v1/meters')
+def get_meters():
+    try:
+        params = listing_page_params(['meter_type', 'status', 'customer_id', 'utility_type'])
+        key = ('meters', tuple(sorted(params.items())))
+        etag, body = get_listing_cache().get(key, lambda: build_meters_listing(params))
+        return conditional_json(etag, body)
+    except (ValueError, InvalidCursor) as e:
+        return jsonify({'error': f'Invalid pagination parameters: {e}'}), 400
+    except DatabaseUnavailable:
+        return jsonify({'error': 'Database connection failed'}), 500
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-@app.route('/api/v1/readings', methods=['POST'])
+@api.route('/api/v1/readings', methods=['POST'])
 def submit_reading():
     try:
-        data = request.get_json()
-        
-        # Validate required fields
-        required_fields = ['meter_id', 'customer_id', 'reading_value']
-        missing_fields = [field for field in required_fields if field not in data]
-        if missing_fields:
-            return jsonify({
-                'error': 'Missing required fields', 
-                'missing': missing_fields,
-                'required': required_fields
-            }), 400
-        
-        # Validate data types and ranges
         try:
-            reading_value = float(data['reading_value'])
-            if reading_value < 0:
-                return jsonify({'error': 'Reading value cannot be negative'}), 400
-        except ValueError:
-            return jsonify({'error': 'Invalid reading value - must be a number'}), 400
+            reading = validate_reading(request.get_json())
+        except ReadingError as e:
+            inc('ingest_readings_total', ('single', 'rejected'))
+            return jsonify({'error': e.message, **e.details}), 400
         
-        # Parse reading date
-        if 'reading_date' in data:
-            try:
-                reading_date = datetime.fromisoformat(data['reading_date'].replace('Z', '+00:00'))
-            except ValueError:
-                return jsonify({'error': 'Invalid date format. Use ISO 8601 (e.g., 2025-06-03T05:00:00Z)'}), 400
-        else:
-            reading_date = datetime.now(timezone.utc)
+        if async_ingest_enabled() or 'respond-async' in request.headers.get('Prefer', ''):
+            return enqueue_reading(reading)
         
         # Insert into database
-        conn = get_db_connection()
-        if not conn:
-            return jsonify({'error': 'Database connection failed'}), 500
-        
         try:
-            cur = conn.cursor()
+            with db_connection() as conn:
+                # The insert is a single statement, so autocommit spares the BEGIN and COMMIT round trips
+                conn.autocommit = True
+                try:
+                    cur = conn.cursor()
+                    
+                    # Reject unknown meters from the registry before touching the database
+                    meter = get_registry().get(conn, reading['meter_id'])
+                    if not meter or meter.status != 'active':
+                        inc('ingest_readings_total', ('single', 'rejected'))
+                        return jsonify({'error': f'Meter {reading["meter_id"]} not found or inactive'}), 404
+                    
+                    # Validate customer matches meter
+                    if meter.customer_id != reading['customer_id']:
+                        inc('ingest_readings_total', ('single', 'rejected'))
+                        return jsonify({'error': f'Customer {reading["customer_id"]} does not match meter {reading["meter_id"]}'}), 400
+                    
+                    # Re-check ownership, insert, advance last_reading_date and fetch the
+                    # meter's history for quality checks in one statement
+                    outcome, meter_type, row = insert_reading(cur, reading)
+                finally:
+                    if not conn.closed:
+                        conn.autocommit = False
             
-            # Validate meter exists
-            cur.execute('SELECT customer_id, meter_type FROM meters WHERE meter_id = %s AND status = %s', (data['meter_id'], 'active'))
-            meter = cur.fetchone()
-            if not meter:
-                return jsonify({'error': f'Meter {data["meter_id"]} not found or inactive'}), 404
-            
-            # Validate customer matches meter
-            if meter[0] != data['customer_id']:
-                return jsonify({'error': f'Customer {data["customer_id"]} does not match meter {data["meter_id"]}'}), 400
-            
-            # Insert the reading
-            cur.execute('''
-                INSERT INTO meter_readings 
-                (meter_id, customer_id, reading_value, reading_date, reading_type, 
-                 quality_code, temperature, voltage, signal_strength)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-                RETURNING reading_id, created_at;
-            ''', (
-                data['meter_id'],
-                data['customer_id'],
-                reading_value,
-                reading_date,
-                data.get('reading_type', 'automatic'),
-                data.get('quality_code', 'good'),
-                data.get('temperature'),
-                data.get('voltage'),
-                data.get('signal_strength')
-            ))
-            
-            reading_id, created_at = cur.fetchone()
-            
-            # Update meter's last reading date
-            cur.execute('''
-                UPDATE meters 
-                SET last_reading_date = %s 
-                WHERE meter_id = %s;
-            ''', (reading_date, data['meter_id']))
-            
-            conn.commit()
+            if outcome in ('not_found', 'customer_mismatch'):
+                # The registry entry was stale
+                get_registry().invalidate(reading['meter_id'])
+                inc('ingest_readings_total', ('single', 'rejected'))
+                if outcome == 'not_found':
+                    return jsonify({'error': f'Meter {reading["meter_id"]} not found or inactive'}), 404
+                return jsonify({'error': f'Customer {reading["customer_id"]} does not match meter {reading["meter_id"]}'}), 400
+            if outcome == 'duplicate':
+                inc('ingest_readings_total', ('single', 'duplicate'))
+                return jsonify({'error': 'Duplicate reading for this meter and timestamp'}), 409
             
+            get_recent_readings().push([row])
+            get_reading_stream().publish([row])
+            inc('ingest_readings_total', ('single', 'accepted'))
             return jsonify({
-                'message': f'Reading recorded successfully for {meter[1]} meter',
-                'reading_id': reading_id,
-                'meter_id': data['meter_id'],
-                'customer_id': data['customer_id'],
-                'reading_value': reading_value,
-                'reading_date': reading_date.isoformat(),
-                'meter_type': meter[1],
-                'timestamp': created_at.isoformat()
+                'message': f'Reading recorded successfully for {meter_type} meter',
+                'reading_id': row[0],
+                'meter_id': reading['meter_id'],
+                'customer_id': reading['customer_id'],
+                'reading_value': reading['reading_value'],
+                'reading_date': reading['reading_date'].isoformat(),
+                'quality_code': row[6],
+                'meter_type': meter_type,
+                'timestamp': row[10].isoformat()
             }), 201
             
-        except psycopg2.IntegrityError as e:
-            conn.rollback()
-            if 'unique' in str(e).lower():
-                return jsonify({'error': 'Duplicate reading for this meter and timestamp'}), 409
+        except DatabaseUnavailable:
+            return jsonify({'error': 'Database connection failed'}), 500
+        except psycopg2.IntegrityError:
             return jsonify({'error': 'Data integrity error'}), 400
         except psycopg2.Error as e:
-            conn.rollback()
             return jsonify({'error': f'Database operation failed: {str(e)}'}), 500
-        finally:
-            conn.close()
             
     except Exception as e:
         return jsonify({'error': f'Internal server error: {str(e)}'}), 500
 
-@app.route('/api/v1/readings/<meter_id>')
+def enqueue_reading(reading):
+    try:
+        meter = get_registry().get(None, reading['meter_id'])
+    except DatabaseUnavailable:
+        return jsonify({'error': 'Database connection failed'}), 500
+    if not meter or meter.status != 'active':
+        inc('ingest_readings_total', ('single', 'rejected'))
+        return jsonify({'error': f'Meter {reading["meter_id"]} not found or inactive'}), 404
+    if meter.customer_id != reading['customer_id']:
+        inc('ingest_readings_total', ('single', 'rejected'))
+        return jsonify({'error': f'Customer {reading["customer_id"]} does not match meter {reading["meter_id"]}'}), 400
+    
+    try:
+        receipt = get_ingest_queue().put(reading)
+    except QueueFull as e:
+        response = jsonify({'error': str(e)})
+        response.headers['Retry-After'] = '1'
+        return response, 503
+    
+    inc('ingest_readings_total', ('single', 'queued'))
+    return jsonify({
+        'message': f'Reading queued for {meter.meter_type} meter',
+        'status': 'queued',
+        **receipt,
+        'meter_id': reading['meter_id'],
+        'customer_id': reading['customer_id'],
+        'reading_value': reading['reading_value'],
+        'reading_date': reading['reading_date'].isoformat(),
+        'meter_type': meter.meter_type
+    }), 202
+
+@api.route('/api/v1/ingest-queue')
+def ingest_queue_stats():
+    return jsonify({'async_default': async_ingest_enabled(), **get_ingest_queue().stats()})
+
+@api.route('/api/v1/readings/batch', methods=['POST'])
+def submit_readings_batch():
+    try:
+        rows = parse_batch_body(request.get_data(), request.content_type)
+    except (ReadingError, ValueError) as e:
+        return jsonify({'error': f'Invalid batch body: {e}'}), 400
+    
+    if not rows:
+        return jsonify({'error': 'Batch is empty'}), 400
+    if len(rows) > BATCH_MAX_ROWS:
+        return jsonify({'error': f'Batch too large - at most {BATCH_MAX_ROWS} readings per request'}), 413
+    
+    try:
+        with db_connection() as conn:
+            results = insert_batch(conn, rows)
+    except DatabaseUnavailable:
+        return jsonify({'error': 'Database connection failed'}), 500
+    except psycopg2.Error as e:
+        return jsonify({'error': f'Database operation failed: {str(e)}'}), 500
+    
+    summary = {'accepted': 0, 'duplicate': 0, 'rejected': 0}
+    for result in results:
+        summary[result['status']] += 1
+    for outcome, count in summary.items():
+        inc('ingest_readings_total', ('batch', outcome), count)
+    
+    return jsonify({
+        'total': len(results),
+        'accepted': summary['accepted'],
+        'duplicates': summary['duplicate'],
+        'rejected': summary['rejected'],
+        'results': results
+    }), 201 if summary['accepted'] else 200
+
+def export_response(meter_id, start_date, end_date, fmt):
+    query, params = build_export_query(meter_id, start_date, end_date)
+    body = stream_readings(query, params, fmt, functools.partial(read_connection, wants_primary()))
+    return streamed_response(body, f'readings-{meter_id or "all"}.{fmt}', fmt)
+
+def streamed_response(body, filename, fmt):
+    try:
+        first_chunk = next(body)
+    except DatabaseUnavailable:
+        return jsonify({'error': 'Database connection failed'}), 500
+    except psycopg2.DataError as e:
+        return jsonify({'error': f'Invalid query parameters: {str(e).splitlines()[0]}'}), 400
+    except psycopg2.Error as e:
+        return jsonify({'error': f'Database operation failed: {str(e)}'}), 500
+    
+    def generate():
+        try:
+            yield first_chunk
+            yield from body
+        finally:
+            body.close()
+    
+    return Response(generate(), mimetype=EXPORT_FORMATS[fmt], headers={
+        'Content-Disposition': f'attachment; filename="{filename}"',
+        'X-Accel-Buffering': 'no'
+    })
+
+@api.route('/api/v1/readings/query', methods=['POST'])
+def query_readings():
+    try:
+        params = parse_fleet_query(request.get_json(silent=True))
+    except (FleetQueryError, InvalidCursor) as e:
+        return jsonify({'error': str(e)}), 400
+    
+    try:
+        with read_connection(wants_primary()) as conn:
+            meters, next_meter_cursor, missing = query_fleet(conn.cursor(), **params)
+        return jsonify({
+            'meters': meters,
+            'meter_count': len(meters),
+            'reading_count': sum(group['reading_count'] for group in meters),
+            'missing_meter_ids': missing,
+            'next_meter_cursor': next_meter_cursor,
+            **({'timestamp_unit': 'epoch_seconds'} if params['fmt'] == 'columnar' else {})
+        })
+    except DatabaseUnavailable:
+        return jsonify({'error': 'Database connection failed'}), 500
+    except psycopg2.DataError as e:
+        return jsonify({'error': f'Invalid query parameters: {e.pgerror or e}'}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@api.route('/api/v1/consumption/<meter_id>')
+def get_meter_consumption(meter_id):
+    interval = request.args.get('interval', 'day')
+    start_date = request.args.get('start_date')
+    end_date = request.args.get('end_date')
+    if interval not in INTERVALS:
+        return jsonify({'error': f'Invalid interval - use one of {", ".join(INTERVALS)}'}), 400
+    
+    try:
+        # The registry loads misses from the primary, so a new meter is never cached as missing
+        meter = get_registry().get(None, meter_id)
+        if not meter:
+            return jsonify({'error': f'Meter {meter_id} not found'}), 404
+        with read_connection(wants_primary()) as conn:
+            buckets = get_consumption(conn.cursor(), meter_id, interval, start_date, end_date)
+        
+        return jsonify({
+            'meter_id': meter_id,
+            'meter_type': meter.meter_type,
+            'interval': interval,
+            'buckets': buckets,
+            'bucket_count': len(buckets),
+            'total_consumption': round(sum(b['consumption'] for b in buckets), 3),
+            'query_params': {
+                'start_date': start_date,
+                'end_date': end_date
+            }
+        })
+    except DatabaseUnavailable:
+        return jsonify({'error': 'Database connection failed'}), 500
+    except psycopg2.DataError as e:
+        return jsonify({'error': f'Invalid query parameters: {str(e).splitlines()[0]}'}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@api.route('/api/v1/billing/runs', methods=['POST'])
+def create_billing_run():
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data, dict):
+        return jsonify({'error': 'Request body must be a JSON object'}), 400
+    try:
+        bounds = [data.get('period_start'), data.get('period_end')]
+        # parse_date_param expects query-string text; a JSON number or list would fail in strip()
+        if any(value is not None and not isinstance(value, str) for value in bounds):
+            raise ValueError('not a string')
+        period_start, period_end = (parse_date_param(value) for value in bounds)
+    except (TypeError, ValueError):
+        return jsonify({'error': 'period_start and period_end must be ISO 8601 dates'}), 400
+    if not period_start or not period_end:
+        return jsonify({'error': 'period_start and period_end are required'}), 400
+    if period_end <= period_start:
+        return jsonify({'error': 'period_end must be after period_start'}), 400
+    
+    try:
+        run_id = start_billing_run(period_start, period_end)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 409
+    except DatabaseUnavailable:
+        return jsonify({'error': 'Database connection failed'}), 500
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    return jsonify({
+        'run_id': run_id,
+        'status': 'running',
+        'period_start': period_start.isoformat(),
+        'period_end': period_end.isoformat()
+    }), 202, {'Location': f'/api/v1/billing/runs/{run_id}'}
+
+@api.route('/api/v1/billing/runs/<int:run_id>')
+def get_billing_run(run_id):
+    try:
+        # Progress is written to the primary as chunks finish
+        with db_connection() as conn:
+            run = get_run(conn.cursor(), run_id)
+    except DatabaseUnavailable:
+        return jsonify({'error': 'Database connection failed'}), 500
+    if run is None:
+        return jsonify({'error': f'Billing run {run_id} not found'}), 404
+    return jsonify(run)
+
+@api.route('/api/v1/billing/runs/<int:run_id>/consumption')
+def export_billing_consumption(run_id):
+    fmt = request.args.get('format', 'ndjson')
+    group = request.args.get('group', 'meter')
+    if fmt not in EXPORT_FORMATS:
+        return jsonify({'error': f'Unsupported format - use one of {", ".join(EXPORT_FORMATS)}'}), 400
+    if group not in ('meter', 'customer'):
+        return jsonify({'error': 'Unsupported group - use one of meter, customer'}), 400
+    query, params, columns, values = consumption_query(run_id, group)
+    body = stream_readings(query, params, fmt, functools.partial(read_connection, wants_primary()), columns, values)
+    return streamed_response(body, f'billing-{run_id}-{group}.{fmt}', fmt)
+
+@api.route('/api/v1/readings/export')
+def export_all_readings():
+    fmt = request.args.get('format', 'ndjson')
+    start_date = request.args.get('start_date')
+    end_date = request.args.get('end_date')
+    if fmt not in EXPORT_FORMATS:
+        return jsonify({'error': f'Unsupported format - use one of {", ".join(EXPORT_FORMATS)}'}), 400
+    if not start_date or not end_date:
+        return jsonify({'error': 'start_date and end_date are required for a fleet-wide export'}), 400
+    return export_response(None, start_date, end_date, fmt)
+
+@api.route('/api/v1/readings/<meter_id>/export')
+def export_meter_readings(meter_id):
+    fmt = request.args.get('format', 'ndjson')
+    if fmt not in EXPORT_FORMATS:
+        return jsonify({'error': f'Unsupported format - use one of {", ".join(EXPORT_FORMATS)}'}), 400
+    
+    try:
+        if not get_registry().get(None, meter_id):
+            return jsonify({'error': f'Meter {meter_id} not found'}), 404
+    except DatabaseUnavailable:
+        return jsonify({'error': 'Database connection failed'}), 500
+    
+    return export_response(meter_id, request.args.get('start_date'), request.args.get('end_date'), fmt)
+
+def downsampled_response(meter_id, meter, times, values, source_count, query_params):
+    if query_params['format'] == 'columnar':
+        readings = {'reading_date': times, 'reading_value': values}
+    else:
+        readings = [{'reading_date': epoch_to_datetime(t).isoformat(), 'reading_value': v}
+                    for t, v in zip(times, values)]
+    response = {
+        'meter_info': {
+            'meter_id': meter_id,
+            'customer_id': meter.customer_id,
+            'meter_type': meter.meter_type,
+            'manufacturer': meter.manufacturer,
+            'model': meter.model
+        },
+        'readings': readings,
+        'reading_count': len(times),
+        'source_count': source_count,
+        'query_params': query_params
+    }
+    if query_params['format'] == 'columnar':
+        response['timestamp_unit'] = 'epoch_seconds'
+    return response
+
+@api.route('/api/v1/readings/<meter_id>')
 def get_readings(meter_id):
     # Query parameters
-    limit = min(int(request.args.get('limit', 100)), 1000)  # Max 1000 records
+    try:
+        limit = min(int(request.args.get('limit', 100)), 1000)  # Max 1000 records
+    except ValueError:
+        return jsonify({'error': 'limit must be an integer'}), 400
+    if limit < 1:
+        return jsonify({'error': 'limit must be at least 1'}), 400
     start_date = request.args.get('start_date')
     end_date = request.args.get('end_date')
+    cursor = request.args.get('cursor')
+    fmt = request.args.get('format', 'json')
+    if fmt not in READING_FORMATS:
+        return jsonify({'error': f'Unsupported format - use one of {", ".join(READING_FORMATS)}'}), 400
     
-    conn = get_db_connection()
-    if not conn:
-        return jsonify({'error': 'Database connection failed'}), 500
+    max_points = request.args.get('max_points')
+    method = request.args.get('downsample', 'lttb')
+    if max_points is not None:
+        try:
+            max_points = int(max_points)
+        except ValueError:
+            return jsonify({'error': 'max_points must be an integer'}), 400
+        if not 2 <= max_points <= DOWNSAMPLE_MAX_POINTS:
+            return jsonify({'error': f'max_points must be between 2 and {DOWNSAMPLE_MAX_POINTS}'}), 400
+        if method not in DOWNSAMPLE_METHODS:
+            return jsonify({'error': f'Unsupported downsample - use one of {", ".join(DOWNSAMPLE_METHODS)}'}), 400
+        if fmt == 'binary' or cursor:
+            return jsonify({'error': 'max_points cannot be combined with format=binary or cursor'}), 400
     
     try:
-        cur = conn.cursor()
-        
-        # Validate meter exists
-        cur.execute('SELECT customer_id, meter_type, manufacturer, model FROM meters WHERE meter_id = %s', (meter_id,))
-        meter = cur.fetchone()
+        after = decode_cursor(f'readings:{meter_id}', cursor, (datetime, int)) if cursor else None
+    except InvalidCursor as e:
+        return jsonify({'error': str(e)}), 400
+    
+    # Archived months are filtered in Python, so the window has to parse here too
+    cold = get_cold_store()
+    cold_window = None
+    if cold.files():
+        try:
+            cold_window = (parse_date_param(start_date), parse_date_param(end_date))
+        except ValueError:
+            return jsonify({'error': 'start_date and end_date must be ISO 8601 dates'}), 400
+    
+    try:
+        # Meter lookups and recent-buffer loads go to the primary: a lagging replica
+        # must not cache a new meter as missing or a buffer without its newest readings
+        meter = get_registry().get(None, meter_id)
         if not meter:
             return jsonify({'error': f'Meter {meter_id} not found'}), 404
         
-        # Build query with optional date filtering
-        query = '''
-            SELECT reading_id, meter_id, customer_id, reading_value, 
-                   reading_date, reading_type, quality_code, 
-                   temperature, voltage, signal_strength, created_at
-            FROM meter_readings 
-            WHERE meter_id = %s
-        '''
-        params = [meter_id]
+        # A chart-sized series over the whole window: limit does not apply
+        if max_points is not None:
+            archived = cold.series(meter_id, *cold_window) if cold_window else None
+            with read_connection(wants_primary()) as conn:
+                times, values, source_count = downsample_readings(
+                    conn.cursor(), meter_id, start_date, end_date, max_points, method, archived)
+            return jsonify(downsampled_response(meter_id, meter, times, values, source_count, {
+                'max_points': max_points,
+                'downsample': method,
+                'start_date': start_date,
+                'end_date': end_date,
+                'format': fmt
+            }))
+        
+        # The newest page with no filters is served from the recent-readings buffer
+        readings = None
+        if not (start_date or end_date or after):
+            readings = get_recent_readings().get(None, meter_id, limit + 1, fmt)
+        
+        if readings is None:
+            # Build query with optional date filtering
+            if fmt == 'columnar':
+                query = COLUMNAR_SELECT
+            elif fmt == 'binary':
+                query = BINARY_SELECT
+            else:
+                query = '''
+                    SELECT reading_id, meter_id, customer_id, reading_value, 
+                           reading_date, reading_type, quality_code, 
+                           temperature, voltage, signal_strength, created_at
+                '''
+            query += ' FROM meter_readings WHERE meter_id = %s'
+            params = [meter_id]
+        
+            if start_date:
+                query += ' AND reading_date >= %s'
+                params.append(start_date)
+        
+            if end_date:
+                query += ' AND reading_date <= %s'
+                params.append(end_date)
+        
+            # Keyset seek: the plain reading_date bound is what lets the
+            # planner use idx_readings_meter_date, the row comparison breaks ties
+            if after:
+                query += ' AND reading_date <= %s AND (reading_date, reading_id) < (%s, %s)'
+                params.extend([after[0], after[0], after[1]])
         
-        if start_date:
-            query += ' AND reading_date >= %s'
-            params.append(start_date)
+            # Fetch one extra row to know whether there is a next page
+            query += ' ORDER BY reading_date DESC, reading_id DESC LIMIT %s;'
+            params.append(limit + 1)
         
-        if end_date:
-            query += ' AND reading_date <= %s'
-            params.append(end_date)
+            with read_connection(wants_primary()) as conn:
+                cur = conn.cursor()
+                cur.execute(query, params)
+                readings = cur.fetchall()
         
-        query += ' ORDER BY reading_date DESC LIMIT %s;'
-        params.append(limit)
+        if cold_window:
+            readings = merge_cold(readings, cold, meter_id, *cold_window, after, limit + 1, fmt)
         
-        cur.execute(query, params)
-        readings = cur.fetchall()
+        next_cursor = None
+        if len(readings) > limit:
+            readings = readings[:limit]
+            last = readings[-1]
+            if fmt == 'columnar':
+                last_date = epoch_to_datetime(last[1])
+            elif fmt == 'binary':
+                last_date = epoch_to_datetime(last[1], 1000000)
+            else:
+                last_date = last[4]
+            next_cursor = encode_cursor(f'readings:{meter_id}', [last_date, last[0]])
+        
+        if fmt == 'binary':
+            headers = {
+                'X-Record-Format': BINARY_RECORD.format,
+                'X-Record-Count': str(len(readings))
+            }
+            if next_cursor:
+                headers['X-Next-Cursor'] = next_cursor
+            return Response(pack_binary(readings), mimetype=BINARY_MIMETYPE, headers=headers)
+        
+        meter_info = {
+            'meter_id': meter_id,
+            'customer_id': meter.customer_id,
+            'meter_type': meter.meter_type,
+            'manufacturer': meter.manufacturer,
+            'model': meter.model
+        }
+        query_params = {
+            'limit': limit,
+            'start_date': start_date,
+            'end_date': end_date,
+            'cursor': cursor,
+            'format': fmt
+        }
+        
+        if fmt == 'columnar':
+            return jsonify({
+                'meter_info': meter_info,
+                'readings': columnar(readings),
+                'timestamp_unit': 'epoch_seconds',
+                'reading_count': len(readings),
+                'next_cursor': next_cursor,
+                'query_params': query_params
+            })
         
         # Convert to JSON-serializable format
         readings_list = []
@@ -680,30 +1338,151 @@ def get_readings(meter_id):
                 'created_at': reading[10].isoformat()
             })
         
-        conn.close()
         return jsonify({
-            'meter_info': {
-                'meter_id': meter_id,
-                'customer_id': meter[0],
-                'meter_type': meter[1],
-                'manufacturer': meter[2],
-                'model': meter[3]
-            },
+            'meter_info': meter_info,
             'readings': readings_list,
             'reading_count': len(readings_list),
-            'query_params': {
-                'limit': limit,
-                'start_date': start_date,
-                'end_date': end_date
-            }
+            'next_cursor': next_cursor,
+            'query_params': query_params
         })
         
+    except DatabaseUnavailable:
+        return jsonify({'error': 'Database connection failed'}), 500
+    except psycopg2.DataError as e:
+        return jsonify({'error': f'Invalid query parameters: {str(e).splitlines()[0]}'}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
-    finally:
-        conn.close()
+
+@api.cli.command('rebuild-rollups')
+@click.option('--meter', 'meter_id', default=None, help='Only rebuild this meter')
+def rebuild_rollups_command(meter_id):
+    """Recompute consumption rollups from meter_readings."""
+    with db_connection() as conn:
+        count = rebuild_rollups(conn, meter_id)
+    print(f'✅ Rebuilt {count} rollup buckets')
+
+@api.cli.command('rescore-readings')
+@click.option('--meter', 'meter_id', default=None, help='Only rescore this meter')
+@click.option('--chunk', 'chunk_meters', default=50, show_default=True, help='Meters scored per transaction')
+def rescore_readings_command(meter_id, chunk_meters):
+    """Re-run quality checks over stored readings and update changed quality codes."""
+    with db_connection() as conn:
+        scored, updated = rescore_readings(conn, meter_id, chunk_meters)
+    print(f'✅ Scored {scored} readings, updated {updated} quality codes')
+
+@api.cli.command('partition-readings')
+def partition_readings_command():
+    """Migrate an unpartitioned meter_readings table to range partitions (blocks writes while it runs)."""
+    if not partitioning_enabled():
+        raise click.ClickException('Set READINGS_PARTITION_INTERVAL to day, week or month first')
+    with db_connection() as conn:
+        moved = migrate_to_partitioned(conn, create_readings_triggers)
+    print(f'✅ meter_readings partitioned by {PARTITION_INTERVAL}, {moved} readings moved')
+
+@api.cli.command('maintain-partitions')
+def maintain_partitions_command():
+    """Create upcoming meter_readings partitions and apply the retention policy."""
+    with db_connection() as conn:
+        created, removed = maintain_partitions(conn)
+    print(f'✅ Created {len(created)} partitions, removed {len(removed)}')
+
+@api.cli.command('archive-readings')
+@click.option('--before', type=click.DateTime(['%Y-%m-%d', '%Y-%m']), default=None,
+              help='Archive whole months before this date instead of READINGS_ARCHIVE_AFTER')
+@click.option('--dir', 'directory', default=ARCHIVE_DIR, show_default=True, help='Archive directory')
+def archive_readings_command(before, directory):
+    """Move whole months of old readings into compressed columnar files under the archive directory."""
+    with db_connection() as conn:
+        try:
+            months = archive_months(conn.cursor(), before)
+        except ValueError as e:
+            raise click.ClickException(str(e))
+        conn.rollback()
+        archived = []
+        for month in months:
+            started = time.perf_counter()
+            result = archive_month(conn, month, directory)
+            if not result['rows']:
+                continue
+            archived.append(result)
+            print(f"{result['month']}: {result['rows']} readings in {time.perf_counter() - started:.1f}s,"
+                  f" {result['file_bytes'] / 1024:.0f} kB file ({result['file_bytes'] / result['file_rows']:.1f} B/reading),"
+                  f" {len(result['dropped_partitions'])} partitions dropped, {result['deleted_rows']} rows deleted,"
+                  f" {result['table_bytes'] / 1024:.0f} kB freed in the table")
+    rows = sum(result['rows'] for result in archived)
+    file_bytes = sum(result['file_bytes'] for result in archived)
+    table_bytes = sum(result['table_bytes'] for result in archived)
+    print(f'✅ Archived {rows} readings from {len(archived)} months: {table_bytes / 1024:.0f} kB freed in'
+          f' meter_readings, {file_bytes / 1024:.0f} kB of archive files')
+
+@api.cli.command('billing-run')
+@click.option('--start', 'period_start', type=click.DateTime(), required=True, help='Period start (inclusive)')
+@click.option('--end', 'period_end', type=click.DateTime(), required=True, help='Period end (exclusive)')
+@click.option('--output', default=None, help='Write per-meter results to this CSV file instead of billing_consumption')
+@click.option('--workers', default=BILLING_WORKERS, show_default=True, help='Worker processes')
+@click.option('--chunk', 'chunk_meters', default=BILLING_CHUNK_METERS, show_default=True, help='Meters per chunk')
+def billing_run_command(period_start, period_end, output, workers, chunk_meters):
+    """Compute billing-period consumption for every meter, grouped by rate class."""
+    if period_end <= period_start:
+        raise click.ClickException('--end must be after --start')
+    started = time.perf_counter()
+    with db_connection() as conn:
+        run_id = None
+        if not output:
+            try:
+                run_id = create_run(conn, period_start, period_end)
+            except ValueError as e:
+                raise click.ClickException(str(e))
+        try:
+            summary = run_billing(conn, period_start, period_end, run_id, output, workers, chunk_meters)
+        except ValueError as e:
+            raise click.ClickException(str(e))
+    for rate_class, totals in summary.items():
+        statuses = ', '.join(f'{count} {status}' for status, count in totals['statuses'].items() if count)
+        print(f"{rate_class}: {totals['customers']} customers, {totals['meters']} meters,"
+              f" {totals['consumption']:.3f} consumed ({statuses})")
+    target = output or f'billing run {run_id}'
+    print(f'✅ Billed {sum(t["meters"] for t in summary.values())} meters into {target}'
+          f' in {time.perf_counter() - started:.1f}s')
+
+def warm_meter_cache():
+    try:
+        with db_connection() as conn:
+            count = get_registry().warm(conn)
+        print(f'Meter cache warmed with {count} meters')
+    except (DatabaseUnavailable, psycopg2.Error) as e:
+        print(f'Meter cache warm-up failed: {e}')
+    get_registry().subscribe()
+    get_recent_readings().subscribe()
+
+def start_background_services():
+    """Warm caches and start background threads. Runs once in every serving process, after fork."""
+    warm_meter_cache()
+    get_readiness_probe().start()
+    PartitionMaintainer().start()
+    get_snapshot_writer().start()
+
+def stop_background_services():
+    """Drain queued readings and release database connections before the process exits."""
+    get_reading_stream().close()
+    get_readiness_probe().stop()
+    get_ingest_queue().stop()
+    close_router()
+    close_pool()
+    get_snapshot_writer().stop()
+
+def create_app():
+    app = Flask(__name__)
+    app.register_blueprint(api)
+    return app
+
+app = create_app()
 
 if __name__ == '__main__':
+    # Development server; production runs under gunicorn (see gunicorn.conf.py)
     print('Starting Smart Meter API with Web Dashboard on port 8000...')
     init_database()
-    app.run(host='0.0.0.0', port=8000, debug=True)
+    start_background_services()
+    # Turn SIGTERM into a normal exit so atexit handlers drain the ingestion queue
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    app.run(host='0.0.0.0', port=8000, debug=os.environ.get('FLASK_DEBUG', 'false').lower() in ('1', 'true', 'yes'))
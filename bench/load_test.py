@@ -0,0 +1,395 @@
+"""Drive the API with concurrent clients against a synthetic fleet and report throughput and latency as JSON.
+
+    python bench/load_test.py seed --customers 200 --meters-per-customer 5 --readings 2000
+    python bench/load_test.py run --clients 8 --duration 20 --output results/main.json
+    python bench/load_test.py run --url http://localhost:8000 --scenarios ingest,range
+    python bench/load_test.py compare results/main.json results/branch.json
+    python bench/load_test.py reset
+
+seed and reset use the DB_* environment variables, like the app. run calls
+the app in-process through Flask's test client unless --url points at a
+running server. Fleet ids start with BENCH- so the fleet can be seeded next
+to real data and removed again. Every random choice comes from --seed, so
+two runs against the same fleet send the same requests.
+"""
+import argparse
+import http.client
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+from urllib.parse import urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+PREFIX = 'BENCH-'
+INTERVAL = timedelta(minutes=15)
+FLEET_END = datetime(2025, 1, 1)     # seeded readings end here; ingest writes after it
+UTILITY_TYPES = ('electric', 'gas', 'water')
+SCENARIOS = ('ingest', 'range', 'recent', 'fleet', 'customers', 'meters', 'stats')
+
+
+def customer_id(i):
+    return f'{PREFIX}C{i:06d}'
+
+
+def meter_id(customer, j):
+    return f'{PREFIX}M{customer:06d}-{j}'
+
+
+def fleet_ids(customers, meters_per_customer):
+    return [(meter_id(i, j), customer_id(i)) for i in range(customers) for j in range(meters_per_customer)]
+
+
+def _copy(cur, table, columns, rows):
+    buf = io.StringIO()
+    for row in rows:
+        buf.write('\t'.join('\\N' if value is None else str(value) for value in row))
+        buf.write('\n')
+    buf.seek(0)
+    cur.copy_expert(f'COPY {table} ({", ".join(columns)}) FROM STDIN', buf)
+
+
+def reset(conn):
+    cur = conn.cursor()
+    cur.execute('DELETE FROM meter_readings WHERE meter_id LIKE %s', (PREFIX + '%',))
+    cur.execute('DELETE FROM reading_rollups WHERE meter_id LIKE %s', (PREFIX + '%',))
+    cur.execute('DELETE FROM meters WHERE meter_id LIKE %s', (PREFIX + '%',))
+    cur.execute('DELETE FROM customers WHERE customer_id LIKE %s', (PREFIX + '%',))
+    conn.commit()
+
+
+def seed(conn, customers, meters_per_customer, readings, seed_value):
+    """Replace the BENCH- fleet with customers x meters_per_customer meters of `readings` 15-minute readings."""
+    rng = random.Random(seed_value)
+    reset(conn)
+    cur = conn.cursor()
+    _copy(cur, 'customers', ('customer_id', 'account_number', 'customer_name', 'service_address',
+                             'utility_type', 'rate_class'),
+          [(customer_id(i), f'{PREFIX}ACC{i:06d}', f'Bench Customer {i}', f'{i} Load Test Lane',
+            UTILITY_TYPES[i % 3], 'residential') for i in range(customers)])
+    _copy(cur, 'meters', ('meter_id', 'customer_id', 'meter_type', 'manufacturer', 'model',
+                          'install_date', 'last_reading_date', 'status'),
+          [(meter_id(i, j), customer_id(i), UTILITY_TYPES[i % 3], 'Bench', 'LT-1', '2020-01-01',
+            FLEET_END.isoformat(), 'active') for i in range(customers) for j in range(meters_per_customer)])
+    conn.commit()
+
+    start = FLEET_END - INTERVAL * (readings - 1)
+    for meter, customer in fleet_ids(customers, meters_per_customer):
+        value = rng.uniform(1000, 50000)
+        rows = []
+        for k in range(readings):
+            value += rng.expovariate(4)
+            rows.append((meter, customer, f'{value:.3f}', (start + INTERVAL * k).isoformat(), 'automatic',
+                         'good', f'{rng.uniform(-10, 35):.2f}', f'{rng.uniform(236, 244):.2f}',
+                         rng.randint(-90, -50)))
+        _copy(cur, 'meter_readings', ('meter_id', 'customer_id', 'reading_value', 'reading_date', 'reading_type',
+                                      'quality_code', 'temperature', 'voltage', 'signal_strength'), rows)
+        conn.commit()
+    cur.execute('ANALYZE meters; ANALYZE meter_readings;')
+    conn.commit()
+
+
+def load_fleet(conn):
+    cur = conn.cursor()
+    cur.execute('''
+        SELECT m.meter_id, m.customer_id, MIN(r.reading_date), MAX(r.reading_date),
+               MAX(r.reading_value)::float8
+        FROM meters m
+        JOIN meter_readings r ON r.meter_id = m.meter_id
+        WHERE m.meter_id LIKE %s
+        GROUP BY m.meter_id, m.customer_id
+        ORDER BY m.meter_id
+    ''', (PREFIX + '%',))
+    return cur.fetchall()
+
+
+# Clients return (status, body bytes) so both transports are timed the same way
+
+class InProcessClient:
+    def __init__(self):
+        from app import app
+        self._client = app.test_client()
+
+    def request(self, method, path, body=None):
+        response = self._client.open(path, method=method, data=body,
+                                     headers={'Content-Type': 'application/json'} if body else None)
+        return response.status_code, response.get_data()
+
+
+class HTTPClient:
+    """One keep-alive connection per client thread."""
+
+    def __init__(self, url):
+        parts = urlsplit(url)
+        self._host, self._port = parts.hostname, parts.port or 80
+        self._prefix = parts.path.rstrip('/')
+        self._conn = None
+
+    def request(self, method, path, body=None):
+        for attempt in range(2):
+            if self._conn is None:
+                self._conn = http.client.HTTPConnection(self._host, self._port, timeout=30)
+            try:
+                self._conn.request(method, self._prefix + path, body=body,
+                                   headers={'Content-Type': 'application/json'} if body else {})
+                response = self._conn.getresponse()
+                return response.status, response.read()
+            except (http.client.HTTPException, ConnectionError):
+                # The server may close an idle keep-alive connection; retry once on a new one
+                self._conn.close()
+                self._conn = None
+                if attempt:
+                    raise
+
+
+class Workload:
+    """Builds each scenario's next request from a per-client random stream."""
+
+    def __init__(self, fleet, limit):
+        self.fleet = fleet
+        self.limit = limit
+        self.customers = sorted({row[1] for row in fleet})
+        self._latest = {row[0]: (row[3], row[4]) for row in fleet}
+        self._lock = threading.Lock()
+
+    def ingest(self, rng):
+        meter, customer = rng.choice(self.fleet)[:2]
+        with self._lock:
+            # Advance each meter's clock and register so every request is a new, plausible reading
+            date, value = self._latest[meter]
+            date, value = self._latest[meter] = (date + INTERVAL, value + rng.expovariate(4))
+        body = json.dumps({'meter_id': meter, 'customer_id': customer, 'reading_value': round(value, 3),
+                           'reading_date': date.isoformat(), 'temperature': 20.5, 'voltage': 240.1,
+                           'signal_strength': -60})
+        return 'POST', '/api/v1/readings', body
+
+    def range(self, rng):
+        meter, _, first, last = rng.choice(self.fleet)[:4]
+        span = INTERVAL * self.limit
+        latest_start = max(last - span, first)
+        start = first + (latest_start - first) * rng.random()
+        return 'GET', (f'/api/v1/readings/{meter}?start_date={start.isoformat()}'
+                       f'&end_date={(start + span).isoformat()}&limit={self.limit}'), None
+
+    def recent(self, rng):
+        return 'GET', f'/api/v1/readings/{rng.choice(self.fleet)[0]}?limit={self.limit}', None
+
+    def fleet_query(self, rng):
+        meter_ids = [row[0] for row in rng.sample(self.fleet, min(50, len(self.fleet)))]
+        return 'POST', '/api/v1/readings/query', json.dumps({'meter_ids': meter_ids, 'limit': 20})
+
+    def customers_listing(self, rng):
+        return 'GET', f'/api/v1/customers?utility_type={rng.choice(UTILITY_TYPES)}&limit={self.limit}', None
+
+    def meters_listing(self, rng):
+        return 'GET', f'/api/v1/meters?customer_id={rng.choice(self.customers)}', None
+
+    def stats(self, rng):
+        return 'GET', '/api/v1/stats', None
+
+    def builder(self, scenario):
+        return {'ingest': self.ingest, 'range': self.range, 'recent': self.recent, 'fleet': self.fleet_query,
+                'customers': self.customers_listing, 'meters': self.meters_listing,
+                'stats': self.stats}[scenario]
+
+
+def percentile(ordered, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, max(0, int(round(fraction * len(ordered) + 0.5)) - 1))]
+
+
+def run_scenario(make_client, build, clients, duration, warmup, seed_value):
+    latencies = [[] for _ in range(clients)]
+    statuses = [{} for _ in range(clients)]
+    errors = [0] * clients
+    nbytes = [0] * clients
+    ready = threading.Barrier(clients + 1)
+    window = {}
+
+    def client_loop(index):
+        rng = random.Random(seed_value * 1000 + index)
+        client = make_client()
+        ready.wait()
+        while True:
+            now = time.perf_counter()
+            if now >= window['end']:
+                return
+            method, path, body = build(rng)
+            started = time.perf_counter()
+            try:
+                status, payload = client.request(method, path, body)
+            except Exception:
+                errors[index] += 1
+                continue
+            finished = time.perf_counter()
+            if started >= window['start']:
+                latencies[index].append(finished - started)
+                statuses[index][status] = statuses[index].get(status, 0) + 1
+                nbytes[index] += len(payload)
+
+    threads = [threading.Thread(target=client_loop, args=(i,), daemon=True) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    window['start'] = time.perf_counter() + warmup
+    window['end'] = window['start'] + duration
+    ready.wait()
+    for thread in threads:
+        thread.join()
+
+    ordered = sorted(value for values in latencies for value in values)
+    status_counts = {}
+    for counts in statuses:
+        for status, count in counts.items():
+            status_counts[str(status)] = status_counts.get(str(status), 0) + count
+    ok = sum(count for status, count in status_counts.items() if status.startswith('2'))
+
+    def ms(value):
+        return None if value is None else round(value * 1000, 3)
+
+    return {
+        'requests': len(ordered),
+        'ok': ok,
+        'statuses': status_counts,
+        'transport_errors': sum(errors),
+        'throughput_rps': round(len(ordered) / duration, 1),
+        'latency_ms': {
+            'mean': ms(sum(ordered) / len(ordered)) if ordered else None,
+            'p50': ms(percentile(ordered, 0.50)),
+            'p95': ms(percentile(ordered, 0.95)),
+            'p99': ms(percentile(ordered, 0.99)),
+            'max': ms(ordered[-1]) if ordered else None
+        },
+        'mean_response_bytes': round(sum(nbytes) / len(ordered)) if ordered else 0
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def run(args):
+    from db_pool import db_connection
+
+    with db_connection() as conn:
+        fleet = load_fleet(conn)
+    if not fleet:
+        sys.exit('No BENCH- fleet found; run "python bench/load_test.py seed" first')
+
+    if args.url:
+        make_client = lambda: HTTPClient(args.url)  # noqa: E731
+    else:
+        from app import start_background_services
+        start_background_services()
+        make_client = InProcessClient
+
+    workload = Workload(fleet, args.limit)
+    scenarios = {}
+    for scenario in args.scenarios.split(','):
+        result = run_scenario(make_client, workload.builder(scenario), args.clients, args.duration,
+                              args.warmup, args.seed)
+        scenarios[scenario] = result
+        latency = result['latency_ms']
+        print(f'{scenario:>10} {result["throughput_rps"]:>9.1f} rps  p50 {latency["p50"]} ms  '
+              f'p95 {latency["p95"]} ms  p99 {latency["p99"]} ms  statuses {result["statuses"]}',
+              file=sys.stderr)
+
+    report = {
+        'started_at': datetime.utcnow().isoformat() + 'Z',
+        'revision': git_revision(),
+        'target': args.url or 'in-process',
+        'python': platform.python_version(),
+        'cpus': os.cpu_count(),
+        'fleet': {'meters': len(fleet), 'customers': len(workload.customers),
+                  'readings_per_meter': round(sum((row[3] - row[2]) / INTERVAL + 1 for row in fleet) / len(fleet))},
+        'config': {'clients': args.clients, 'duration_s': args.duration, 'warmup_s': args.warmup,
+                   'limit': args.limit, 'seed': args.seed},
+        'scenarios': scenarios
+    }
+    body = json.dumps(report, indent=2)
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w') as f:
+            f.write(body + '\n')
+    else:
+        print(body)
+
+
+def compare(baseline_path, candidate_path):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    with open(candidate_path) as f:
+        candidate = json.load(f)
+
+    def change(old, new):
+        return f'{(new - old) / old * 100:+.1f}%' if old and new is not None else 'n/a'
+
+    print(f'{baseline.get("revision")} -> {candidate.get("revision")}')
+    print(f'{"scenario":>10} {"rps":>18} {"p50 ms":>18} {"p95 ms":>18} {"p99 ms":>18}')
+    for scenario, new in candidate['scenarios'].items():
+        old = baseline['scenarios'].get(scenario)
+        if old is None:
+            continue
+        cells = [f'{new["throughput_rps"]:.1f} ({change(old["throughput_rps"], new["throughput_rps"])})']
+        for key in ('p50', 'p95', 'p99'):
+            value = new['latency_ms'][key]
+            cells.append(f'{value} ({change(old["latency_ms"][key], value)})')
+        print(f'{scenario:>10} ' + ' '.join(f'{cell:>18}' for cell in cells))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    seed_parser = commands.add_parser('seed', help='Create the synthetic BENCH- fleet')
+    seed_parser.add_argument('--customers', type=int, default=200)
+    seed_parser.add_argument('--meters-per-customer', type=int, default=5)
+    seed_parser.add_argument('--readings', type=int, default=2000, help='Readings per meter')
+    seed_parser.add_argument('--seed', type=int, default=1)
+
+    run_parser = commands.add_parser('run', help='Run the scenarios and write a JSON report')
+    run_parser.add_argument('--url', help='Base URL of a running server (default: in-process test client)')
+    run_parser.add_argument('--scenarios', default=','.join(SCENARIOS), help=f'Comma-separated: {",".join(SCENARIOS)}')
+    run_parser.add_argument('--clients', type=int, default=8, help='Concurrent client threads')
+    run_parser.add_argument('--duration', type=float, default=20, help='Measured seconds per scenario')
+    run_parser.add_argument('--warmup', type=float, default=3, help='Unmeasured seconds before each scenario')
+    run_parser.add_argument('--limit', type=int, default=100, help='Page size for readings and listings')
+    run_parser.add_argument('--seed', type=int, default=1)
+    run_parser.add_argument('--output', help='Write the JSON report here instead of stdout')
+
+    compare_parser = commands.add_parser('compare', help='Show the change between two JSON reports')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('candidate')
+
+    commands.add_parser('reset', help='Delete the BENCH- fleet and everything ingested for it')
+
+    args = parser.parse_args()
+    if args.command == 'compare':
+        compare(args.baseline, args.candidate)
+    elif args.command == 'run':
+        run(args)
+    else:
+        from app import init_database
+        from db_pool import db_connection
+
+        init_database()
+        with db_connection() as conn:
+            if args.command == 'seed':
+                started = time.perf_counter()
+                seed(conn, args.customers, args.meters_per_customer, args.readings, args.seed)
+                print(f'Seeded {args.customers * args.meters_per_customer} meters x {args.readings} readings '
+                      f'in {time.perf_counter() - started:.1f}s', file=sys.stderr)
+            else:
+                reset(conn)
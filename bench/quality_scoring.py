@@ -0,0 +1,50 @@
+"""Time quality.score on a synthetic batch of 15-minute electric readings.
+
+    python bench/quality_scoring.py --rows 100000 --meters 2000
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from quality import score, QUALITY_CODES  # noqa: E402
+
+
+def synthetic_batch(rows, meters, seed=0):
+    rng = np.random.default_rng(seed)
+    per_meter = rows // meters
+    meter_ids = np.repeat([f'MTR-{i:06d}' for i in range(meters)], per_meter).tolist()
+    times = np.tile(np.arange(per_meter) * 900.0, meters) + 1.7e9
+    values = np.cumsum(rng.exponential(0.3, size=(meters, per_meter)), axis=1).ravel()
+    values += np.repeat(rng.uniform(0, 900000, meters), per_meter)
+    # Sprinkle in faults for the checks to find
+    faults = rng.choice(len(values), size=len(values) // 1000, replace=False)
+    values[faults[::2]] -= 50
+    values[faults[1::2]] += 400
+    shuffle = rng.permutation(len(values))
+    return ([meter_ids[i] for i in shuffle], times[shuffle].tolist(), values[shuffle].tolist(),
+            ['electric'] * len(values))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--meters', type=int, default=2000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    batch = synthetic_batch(args.rows, args.meters)
+    best = None
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        codes = score(*batch)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    counts = np.bincount(codes, minlength=len(QUALITY_CODES))
+    print(f'{len(codes)} readings across {args.meters} meters scored in {best * 1000:.1f} ms (best of {args.repeat})')
+    print(', '.join(f'{name}={count}' for name, count in zip(QUALITY_CODES, counts)))
@@ -0,0 +1,114 @@
+"""Compare serialization time and payload size of the readings response formats.
+
+    python bench/readings_formats.py                      # synthetic rows, no database
+    python bench/readings_formats.py --meter MTR-001      # end to end through the Flask app
+
+The synthetic run feeds each encoder rows shaped the way psycopg2 returns
+them for that format's SELECT (Decimal/datetime for json, float for the rest).
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from reading_formats import columnar, pack_binary  # noqa: E402
+
+
+def synthetic_rows(count):
+    base = datetime(2024, 1, 1)
+    json_rows, columnar_rows, binary_rows = [], [], []
+    for i in range(count):
+        date = base - timedelta(minutes=15 * i)
+        created = date + timedelta(seconds=3)
+        value = Decimal(f'{12345 + i * 0.137:.3f}')
+        json_rows.append((i + 1, 'MTR-001', 'CUST-001', value, date, 'automatic', 'good',
+                          Decimal('21.50'), Decimal('239.80'), -67, created))
+        epoch = (date - datetime(1970, 1, 1)).total_seconds()
+        columnar_rows.append((i + 1, epoch, 'CUST-001', float(value), 'automatic', 'good',
+                              21.5, 239.8, -67, (created - datetime(1970, 1, 1)).total_seconds()))
+        binary_rows.append((i + 1, int(epoch * 1000000), float(value)))
+    return json_rows, columnar_rows, binary_rows
+
+
+def encode_json(rows):
+    # Mirrors the per-row dict building in get_readings
+    readings_list = []
+    for reading in rows:
+        readings_list.append({
+            'reading_id': reading[0],
+            'meter_id': reading[1],
+            'customer_id': reading[2],
+            'reading_value': float(reading[3]),
+            'reading_date': reading[4].isoformat(),
+            'reading_type': reading[5],
+            'quality_code': reading[6],
+            'temperature': float(reading[7]) if reading[7] else None,
+            'voltage': float(reading[8]) if reading[8] else None,
+            'signal_strength': reading[9],
+            'created_at': reading[10].isoformat()
+        })
+    return json.dumps({'readings': readings_list}, separators=(',', ':')).encode('utf-8')
+
+
+def encode_columnar(rows):
+    return json.dumps({'readings': columnar(rows)}, separators=(',', ':')).encode('utf-8')
+
+
+def timed(fn, rows, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        body = fn(rows)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, len(body)
+
+
+def run_synthetic(sizes, repeat):
+    print(f'{"rows":>6} {"format":>9} {"best ms":>9} {"bytes":>9} {"vs json":>8}')
+    for count in sizes:
+        json_rows, columnar_rows, binary_rows = synthetic_rows(count)
+        base_ms, base_bytes = timed(encode_json, json_rows, repeat)
+        results = [
+            ('json', base_ms, base_bytes),
+            ('columnar', *timed(encode_columnar, columnar_rows, repeat)),
+            ('binary', *timed(pack_binary, binary_rows, repeat))
+        ]
+        for name, seconds, size in results:
+            print(f'{count:>6} {name:>9} {seconds * 1000:>9.3f} {size:>9} {base_ms / seconds:>7.1f}x')
+
+
+def run_app(meter_id, limit, repeat):
+    from app import app
+
+    client = app.test_client()
+    print(f'{"format":>9} {"best ms":>9} {"bytes":>9}')
+    for fmt in ('json', 'columnar', 'binary'):
+        best, size = None, 0
+        for _ in range(repeat):
+            start = time.perf_counter()
+            response = client.get(f'/api/v1/readings/{meter_id}?limit={limit}&format={fmt}')
+            elapsed = time.perf_counter() - start
+            if response.status_code != 200:
+                sys.exit(f'{fmt}: HTTP {response.status_code} {response.get_data(as_text=True)}')
+            size = len(response.get_data())
+            best = elapsed if best is None else min(best, elapsed)
+        print(f'{fmt:>9} {best * 1000:>9.3f} {size:>9}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, nargs='+', default=[100, 1000])
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--meter', help='Benchmark GET /api/v1/readings/<meter> against the configured database')
+    args = parser.parse_args()
+
+    if args.meter:
+        run_app(args.meter, max(args.rows), args.repeat)
+    else:
+        run_synthetic(args.rows, args.repeat)
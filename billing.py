@@ -0,0 +1,393 @@
+"""Billing-period consumption per meter: register readings interpolated at the period boundaries, in a process pool."""
+import csv
+import io
+import json
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+
+import numpy as np
+import psycopg2
+
+from db_pool import connect, db_connection
+from quality import UNUSABLE_CODES
+
+BILLING_WORKERS = int(os.environ.get('BILLING_WORKERS', os.cpu_count() or 1))
+BILLING_CHUNK_METERS = int(os.environ.get('BILLING_CHUNK_METERS', 2000))
+# Readings further than this outside the period are not used to interpolate a boundary
+BILLING_INTERPOLATION_WINDOW = os.environ.get('BILLING_INTERPOLATION_WINDOW', '7 days')
+# A running run whose progress hasn't moved for this long is taken to have died with its process
+BILLING_STALE_AFTER = int(os.environ.get('BILLING_STALE_AFTER', 600))
+
+BILLING_LOCK_ID = 0x62696c6c   # pg advisory lock key for starting a billing run
+BILLING_RUN_LOCK_ID = BILLING_LOCK_ID + 1   # held by the session computing a run, for as long as it runs
+
+BILLING_STATUSES = ('complete', 'partial', 'negative', 'no_data')
+RESULT_COLUMNS = ['meter_id', 'customer_id', 'rate_class', 'start_date', 'start_value',
+                  'end_date', 'end_value', 'consumption', 'status']
+CUSTOMER_COLUMNS = ['customer_id', 'rate_class', 'meters', 'consumption', 'incomplete_meters']
+
+_EPOCH = datetime(1970, 1, 1)
+
+
+def create_billing_schema(cur):
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS billing_runs (
+            run_id SERIAL PRIMARY KEY,
+            period_start TIMESTAMP NOT NULL,
+            period_end TIMESTAMP NOT NULL,
+            status VARCHAR(10) NOT NULL DEFAULT 'running' CHECK (status IN ('running', 'complete', 'failed')),
+            meters INTEGER,
+            processed INTEGER NOT NULL DEFAULT 0,
+            summary JSONB,
+            error TEXT,
+            started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            finished_at TIMESTAMP
+        );
+    ''')
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS billing_consumption (
+            run_id INTEGER NOT NULL REFERENCES billing_runs(run_id) ON DELETE CASCADE,
+            meter_id VARCHAR(50) NOT NULL,
+            customer_id VARCHAR(50),
+            rate_class VARCHAR(20),
+            start_date TIMESTAMP,
+            start_value DECIMAL(14,3),
+            end_date TIMESTAMP,
+            end_value DECIMAL(14,3),
+            consumption DECIMAL(14,3),
+            status VARCHAR(10) NOT NULL,
+            PRIMARY KEY (run_id, meter_id)
+        );
+    ''')
+
+
+# Four index seeks per meter on idx_readings_meter_date: the last usable reading
+# at or before the period start, the first and last inside the period, and the
+# first at or after the end. The window bounds keep a partitioned table's seeks
+# to the partitions around the boundaries.
+_SEEK = '''
+    LEFT JOIN LATERAL (
+        SELECT date_part('epoch', reading_date) AS t, reading_value::float8 AS v
+        FROM meter_readings
+        WHERE meter_id = u.meter_id AND {where} AND quality_code NOT IN %(unusable)s
+        ORDER BY reading_date {order}
+        LIMIT 1
+    ) {alias} ON TRUE
+'''
+BOUNDARY_QUERY = '''
+    SELECT u.meter_id, m.customer_id, c.rate_class, p.t, p.v, f.t, f.v, l.t, l.v, n.t, n.v
+    FROM unnest(%(meters)s::varchar[]) AS u(meter_id)
+    JOIN meters m ON m.meter_id = u.meter_id
+    LEFT JOIN customers c ON c.customer_id = m.customer_id
+''' + ''.join(_SEEK.format(alias=alias, where=where, order=order) for alias, where, order in (
+    ('p', 'reading_date <= %(start)s AND reading_date >= %(start)s - %(window)s::interval', 'DESC'),
+    ('f', 'reading_date > %(start)s AND reading_date < %(end)s', 'ASC'),
+    ('l', 'reading_date > %(start)s AND reading_date < %(end)s', 'DESC'),
+    ('n', 'reading_date >= %(end)s AND reading_date <= %(end)s + %(window)s::interval', 'ASC')
+))
+
+
+def _interpolate(t, t0, v0, t1, v1):
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(t1 > t0, v0 + (v1 - v0) * (t - t0) / (t1 - t0), v0)
+
+
+def period_consumption(start, end, p_t, p_v, f_t, f_v, l_t, l_v, n_t, n_v):
+    """Boundary readings -> (start_t, start_v, end_t, end_v, consumption, status index) arrays.
+
+    p is the last reading at or before start, f and l the first and last
+    strictly inside the period, n the first at or after end; NaN where a
+    meter has none. A boundary with readings on both sides is interpolated
+    to the boundary itself. Otherwise the nearest reading inside the
+    period stands in for it and the meter is partial.
+    """
+    right_t, right_v = np.where(np.isnan(f_t), n_t, f_t), np.where(np.isnan(f_t), n_v, f_v)
+    left_t, left_v = np.where(np.isnan(l_t), p_t, l_t), np.where(np.isnan(l_t), p_v, l_v)
+
+    start_known = (p_t == start) | (~np.isnan(p_t) & ~np.isnan(right_t))
+    start_v = np.where(p_t == start, p_v, np.where(start_known, _interpolate(start, p_t, p_v, right_t, right_v), f_v))
+    start_t = np.where(start_known, start, f_t)
+
+    end_known = (n_t == end) | (~np.isnan(n_t) & ~np.isnan(left_t))
+    end_v = np.where(n_t == end, n_v, np.where(end_known, _interpolate(end, left_t, left_v, n_t, n_v), l_v))
+    end_t = np.where(end_known, end, l_t)
+
+    consumption = end_v - start_v
+    status = np.where(start_known & end_known, 0, 1)
+    status[consumption < 0] = 2
+    status[np.isnan(consumption)] = 3
+    return start_t, start_v, end_t, end_v, consumption, status
+
+
+def _timestamps(seconds):
+    text = np.datetime_as_string(np.where(np.isnan(seconds), 0, seconds).astype('datetime64[s]'))
+    return np.where(np.isnan(seconds), '', text)
+
+
+def _decimals(values):
+    return np.where(np.isnan(values), '', np.char.mod('%.3f', np.nan_to_num(values)))
+
+
+_worker_conn = None
+
+
+def _connection():
+    global _worker_conn
+    if _worker_conn is None or _worker_conn.closed:
+        _worker_conn = connect()
+        _worker_conn.set_session(readonly=True, autocommit=True)
+    return _worker_conn
+
+
+def bill_chunk(meter_ids, start, end, window=BILLING_INTERPOLATION_WINDOW, run_id=None):
+    """Worker: one chunk of meters -> (CSV rows in RESULT_COLUMNS order, per-rate-class partial summary).
+
+    With run_id, each row starts with it, ready to COPY into billing_consumption.
+    """
+    cur = _connection().cursor()
+    cur.execute(BOUNDARY_QUERY, {'meters': meter_ids, 'start': start, 'end': end, 'window': window,
+                                 'unusable': UNUSABLE_CODES})
+    rows = cur.fetchall()
+    if not rows:
+        return '', {}
+    meters, customers, rate_classes = (list(column) for column in zip(*[row[:3] for row in rows]))
+    boundaries = np.array([row[3:] for row in rows], dtype=np.float64).T
+    start_s = (start - _EPOCH).total_seconds()
+    end_s = (end - _EPOCH).total_seconds()
+    start_t, start_v, end_t, end_v, consumption, status = period_consumption(start_s, end_s, *boundaries)
+    consumption = np.round(consumption, 3)
+
+    columns = [meters, customers, rate_classes, _timestamps(start_t), _decimals(start_v), _timestamps(end_t),
+               _decimals(end_v), _decimals(consumption), np.array(BILLING_STATUSES)[status]]
+    if run_id is not None:
+        columns.insert(0, [run_id] * len(meters))
+    buf = io.StringIO()
+    csv.writer(buf, lineterminator='\n').writerows(zip(*columns))
+
+    summary = {}
+    for i, rate_class in enumerate(rate_classes):
+        part = summary.setdefault(rate_class, {'meters': 0, 'consumption': 0.0, 'customers': set(),
+                                               'statuses': dict.fromkeys(BILLING_STATUSES, 0)})
+        part['meters'] += 1
+        part['customers'].add(customers[i])
+        part['statuses'][BILLING_STATUSES[status[i]]] += 1
+        if status[i] != 3:
+            part['consumption'] += float(consumption[i])
+    return buf.getvalue(), summary
+
+
+def _merge_summary(total, part):
+    for rate_class, values in part.items():
+        merged = total.setdefault(rate_class, {'meters': 0, 'consumption': 0.0, 'customers': set(),
+                                               'statuses': dict.fromkeys(BILLING_STATUSES, 0)})
+        merged['meters'] += values['meters']
+        merged['consumption'] += values['consumption']
+        merged['customers'] |= values['customers']
+        for status, count in values['statuses'].items():
+            merged['statuses'][status] += count
+
+
+def _summary_json(total):
+    return {
+        rate_class or 'unassigned': {
+            'meters': values['meters'],
+            'customers': len(values['customers']),
+            'consumption': round(values['consumption'], 3),
+            'statuses': values['statuses']
+        } for rate_class, values in sorted(total.items(), key=lambda item: item[0] or '')
+    }
+
+
+def _run_lock_held(cur):
+    # A bigint advisory key shows in pg_locks as classid (high half), objid (low half), objsubid 1
+    cur.execute('''
+        SELECT EXISTS (SELECT 1 FROM pg_locks
+                       WHERE locktype = 'advisory' AND classid = %s AND objid = %s AND objsubid = 1 AND granted)
+    ''', (BILLING_RUN_LOCK_ID >> 32, BILLING_RUN_LOCK_ID & 0xffffffff))
+    return cur.fetchone()[0]
+
+
+def create_run(conn, period_start, period_end):
+    """Insert a running billing run and return its id; ValueError if another run is in progress.
+
+    Any process computing a run, through the API or the CLI, holds
+    BILLING_RUN_LOCK_ID, so only one runs at a time across all workers and
+    hosts. A running run is only taken for dead when nothing holds the lock.
+    """
+    cur = conn.cursor()
+    cur.execute('SELECT pg_advisory_xact_lock(%s)', (BILLING_LOCK_ID,))
+    computing = _run_lock_held(cur)
+    if not computing:
+        cur.execute('''
+            UPDATE billing_runs SET status = 'failed', error = 'Run stopped reporting progress', finished_at = now()
+            WHERE status = 'running' AND updated_at < now() - make_interval(secs => %s)
+        ''', (BILLING_STALE_AFTER,))
+    cur.execute("SELECT run_id FROM billing_runs WHERE status = 'running'")
+    running = cur.fetchone()
+    if running:
+        conn.rollback()
+        raise ValueError(f'Billing run {running[0]} is still running')
+    if computing:
+        conn.rollback()
+        raise ValueError('Another billing run is in progress')
+    cur.execute('INSERT INTO billing_runs (period_start, period_end) VALUES (%s, %s) RETURNING run_id',
+                (period_start, period_end))
+    run_id = cur.fetchone()[0]
+    conn.commit()
+    return run_id
+
+
+def run_billing(conn, period_start, period_end, run_id=None, output=None,
+                workers=BILLING_WORKERS, chunk_meters=BILLING_CHUNK_METERS, progress=print):
+    """Compute consumption for every meter over [period_start, period_end).
+
+    Results go to billing_consumption under run_id, or to the CSV file
+    output when given. Chunks of chunk_meters meters run in a pool of
+    worker processes; this process only writes results and progress.
+    conn holds BILLING_RUN_LOCK_ID throughout; ValueError if another run
+    has it. Returns the per-rate-class summary.
+    """
+    cur = conn.cursor()
+    cur.execute('SELECT pg_try_advisory_lock(%s)', (BILLING_RUN_LOCK_ID,))
+    if not cur.fetchone()[0]:
+        conn.rollback()
+        error = 'Another billing run is in progress'
+        if run_id is not None:
+            cur.execute("UPDATE billing_runs SET status = 'failed', error = %s, finished_at = now() WHERE run_id = %s",
+                        (error, run_id))
+            conn.commit()
+        raise ValueError(error)
+    try:
+        return _run_billing(conn, cur, period_start, period_end, run_id, output, workers, chunk_meters, progress)
+    finally:
+        # Session-level, so it survives commits; unlock before the connection goes back to the pool
+        try:
+            conn.rollback()
+            cur.execute('SELECT pg_advisory_unlock(%s)', (BILLING_RUN_LOCK_ID,))
+            conn.commit()
+        except psycopg2.Error:
+            pass    # the lock went with the broken connection
+
+
+def _run_billing(conn, cur, period_start, period_end, run_id, output, workers, chunk_meters, progress):
+    cur.execute('SELECT meter_id FROM meters ORDER BY meter_id')
+    meter_ids = [row[0] for row in cur.fetchall()]
+    chunks = [meter_ids[i:i + chunk_meters] for i in range(0, len(meter_ids), chunk_meters)]
+    if run_id is not None:
+        cur.execute('UPDATE billing_runs SET meters = %s, updated_at = now() WHERE run_id = %s',
+                    (len(meter_ids), run_id))
+    conn.commit()
+
+    out = None
+    if output:
+        out = open(output, 'w', newline='')
+        out.write(','.join(RESULT_COLUMNS) + '\n')
+    total, processed, started, reported = {}, 0, time.monotonic(), 0.0
+    # spawn, not fork: this may run on a thread of a multi-threaded web worker
+    pool = ProcessPoolExecutor(max_workers=max(1, workers), mp_context=multiprocessing.get_context('spawn'))
+    try:
+        futures = {pool.submit(bill_chunk, chunk, period_start, period_end, run_id=run_id if out is None else None): len(chunk)
+                   for chunk in chunks}
+        for future in as_completed(futures):
+            text, summary = future.result()
+            if out is not None:
+                out.write(text)
+            else:
+                cur.copy_expert(f'COPY billing_consumption (run_id, {", ".join(RESULT_COLUMNS)}) FROM STDIN '
+                                "WITH (FORMAT csv)", io.StringIO(text))
+            processed += futures[future]
+            _merge_summary(total, summary)
+            if run_id is not None:
+                cur.execute('UPDATE billing_runs SET processed = %s, updated_at = now() WHERE run_id = %s',
+                            (processed, run_id))
+                conn.commit()
+            now = time.monotonic()
+            if progress and (now - reported >= 2 or processed == len(meter_ids)):
+                reported = now
+                elapsed = now - started
+                progress(f'{processed}/{len(meter_ids)} meters, {processed / elapsed:.0f} meters/s')
+    except BaseException as e:
+        pool.shutdown(wait=False, cancel_futures=True)
+        conn.rollback()
+        if run_id is not None:
+            cur.execute("UPDATE billing_runs SET status = 'failed', error = %s, finished_at = now() WHERE run_id = %s",
+                        (str(e) or type(e).__name__, run_id))
+            conn.commit()
+        raise
+    finally:
+        pool.shutdown()
+        if out is not None:
+            out.close()
+
+    summary = _summary_json(total)
+    if run_id is not None:
+        cur.execute('''
+            UPDATE billing_runs SET status = 'complete', summary = %s, updated_at = now(), finished_at = now()
+            WHERE run_id = %s
+        ''', (json.dumps(summary), run_id))
+        conn.commit()
+    return summary
+
+
+def start_billing_run(period_start, period_end):
+    """Create a run and compute it on a background thread; returns the run id."""
+    with db_connection() as conn:
+        run_id = create_run(conn, period_start, period_end)
+
+    def work():
+        try:
+            with db_connection() as conn:
+                run_billing(conn, period_start, period_end, run_id=run_id, progress=None)
+        except Exception as e:
+            print(f'Billing run {run_id} failed: {e}')
+
+    threading.Thread(target=work, name=f'billing-run-{run_id}', daemon=True).start()
+    return run_id
+
+
+RUN_COLUMNS = ('run_id', 'period_start', 'period_end', 'status', 'meters', 'processed', 'summary', 'error',
+               'started_at', 'updated_at', 'finished_at')
+
+
+def get_run(cur, run_id):
+    cur.execute(f'SELECT {", ".join(RUN_COLUMNS)} FROM billing_runs WHERE run_id = %s', (run_id,))
+    row = cur.fetchone()
+    if row is None:
+        return None
+    run = dict(zip(RUN_COLUMNS, row))
+    for key in ('period_start', 'period_end', 'started_at', 'updated_at', 'finished_at'):
+        run[key] = run[key].isoformat() if run[key] else None
+    return run
+
+
+def consumption_query(run_id, group):
+    """(query, params, columns, values) streaming a run's results per meter or per customer."""
+    if group == 'customer':
+        query = '''
+            SELECT customer_id, rate_class, COUNT(*), SUM(consumption),
+                   COUNT(*) FILTER (WHERE status <> 'complete')
+            FROM billing_consumption WHERE run_id = %s
+            GROUP BY customer_id, rate_class
+            ORDER BY customer_id, rate_class
+        '''
+        return query, [run_id], CUSTOMER_COLUMNS, _customer_values
+    query = f'SELECT {", ".join(RESULT_COLUMNS)} FROM billing_consumption WHERE run_id = %s ORDER BY meter_id'
+    return query, [run_id], RESULT_COLUMNS, _meter_values
+
+
+def _number(value):
+    return float(value) if value is not None else None
+
+
+def _meter_values(row):
+    return [row[0], row[1], row[2], row[3].isoformat() if row[3] else None, _number(row[4]),
+            row[5].isoformat() if row[5] else None, _number(row[6]), _number(row[7]), row[8]]
+
+
+def _customer_values(row):
+    return [row[0], row[1], row[2], _number(row[3]), row[4]]
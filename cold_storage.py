@@ -0,0 +1,574 @@
+"""Cold storage for old readings: one compressed columnar file per month, read through mmap."""
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from partitions import is_partitioned, list_partitions, next_period
+
+ARCHIVE_DIR = os.environ.get('READINGS_ARCHIVE_DIR', 'archive')
+ARCHIVE_AFTER = os.environ.get('READINGS_ARCHIVE_AFTER', '')     # e.g. '13 months'
+ARCHIVE_COMPRESSION_LEVEL = int(os.environ.get('READINGS_ARCHIVE_COMPRESSION_LEVEL', 6))
+ARCHIVE_FETCH_SIZE = 20000
+
+MAGIC = b'MRCOLD01'
+TRAILER = struct.Struct('<QQ8s')    # meta offset, meta length, magic
+FILE_PREFIX, FILE_SUFFIX = 'readings-', '.mrc'
+
+_EPOCH = datetime(1970, 1, 1)
+# Fixed-point scales of the DECIMAL columns, so archived values round-trip exactly
+VALUE_SCALE = 1000          # reading_value DECIMAL(12,3)
+SENSOR_SCALE = 100          # temperature, voltage DECIMAL(5,2)
+NULL_INT32 = np.iinfo(np.int32).min
+NULL_INT64 = np.iinfo(np.int64).min
+
+# Exported in meter order; the writer turns each meter's run into one block
+EXPORT_SELECT = '''
+    SELECT meter_id, (EXTRACT(EPOCH FROM reading_date) * 1000000)::bigint, reading_id,
+           (reading_value * 1000)::bigint, customer_id, reading_type, quality_code,
+           (temperature * 100)::int, (voltage * 100)::int, signal_strength,
+           (EXTRACT(EPOCH FROM created_at) * 1000000)::bigint
+    FROM meter_readings
+    WHERE reading_date >= %s AND reading_date < %s
+    ORDER BY meter_id, reading_date
+'''
+
+
+def to_micros(value):
+    return (value - _EPOCH) // timedelta(microseconds=1)
+
+
+def from_micros(value):
+    return _EPOCH + timedelta(microseconds=int(value))
+
+
+def month_start(value):
+    return datetime(value.year, value.month, 1)
+
+
+def archive_path(directory, month):
+    return os.path.join(directory, f'{FILE_PREFIX}{month:%Y%m}{FILE_SUFFIX}')
+
+
+def parse_date_param(value):
+    """A start_date/end_date query value as the naive timestamp PostgreSQL would compare against."""
+    if value is None:
+        return None
+    value = value.strip()
+    if value.endswith('Z'):
+        value = value[:-1]
+    # A TIMESTAMP column ignores any offset in the literal, so drop it the same way
+    return datetime.fromisoformat(value).replace(tzinfo=None)
+
+
+# Block layout, before compression: row count, seven int64/int32 columns, three
+# dictionary-coded text columns. Dates, ids, values and created_at are stored as
+# deltas from the previous row, which turns regular intervals into long runs.
+
+_COUNT = struct.Struct('<I')
+
+
+def _delta(column):
+    return np.diff(column, prepend=np.int64(0)).astype('<i8')
+
+
+def _dictionary(values):
+    table = sorted(set(values), key=lambda v: (v is None, v or ''))
+    codes = {value: i for i, value in enumerate(table)}
+    return table, np.fromiter((codes[v] for v in values), '<u2', count=len(values))
+
+
+def encode_block(rows, level=ARCHIVE_COMPRESSION_LEVEL):
+    """Compress one meter's export rows (EXPORT_SELECT order, ascending dates) into a block."""
+    columns = list(zip(*rows))
+    n = len(rows)
+
+    def ints(index, dtype, null):
+        return np.fromiter((null if v is None else v for v in columns[index]), dtype, count=n)
+
+    parts = [_COUNT.pack(n)]
+    for index in (1, 2, 3):      # reading_date, reading_id, reading_value
+        parts.append(_delta(np.fromiter(columns[index], np.int64, count=n)).tobytes())
+    # created_at may hold NULLs; a one-byte marker says whether it is stored as deltas or raw
+    created = ints(10, '<i8', NULL_INT64)
+    if (created == NULL_INT64).any():
+        parts.append(b'\x00' + created.tobytes())
+    else:
+        parts.append(b'\x01' + _delta(created).tobytes())
+    for index in (7, 8, 9):      # temperature, voltage, signal_strength
+        parts.append(ints(index, '<i4', NULL_INT32).tobytes())
+    tables = []
+    for index in (4, 5, 6):      # customer_id, reading_type, quality_code
+        table, codes = _dictionary(columns[index])
+        tables.append(table)
+        parts.append(codes.tobytes())
+    parts.append(json.dumps(tables, separators=(',', ':')).encode('utf-8'))
+    return zlib.compress(b''.join(parts), level)
+
+
+def decode_block(data):
+    """Decompress a block into a dict of numpy columns plus the three text tables."""
+    raw = zlib.decompress(data)
+    n = _COUNT.unpack_from(raw)[0]
+    pos = _COUNT.size
+    out = {}
+    for name in ('reading_date', 'reading_id', 'reading_value'):
+        out[name] = np.cumsum(np.frombuffer(raw, '<i8', n, pos))
+        pos += 8 * n
+    marker = raw[pos:pos + 1]
+    created = np.frombuffer(raw, '<i8', n, pos + 1)
+    out['created_at'] = np.cumsum(created) if marker == b'\x01' else created
+    pos += 1 + 8 * n
+    for name in ('temperature', 'voltage', 'signal_strength'):
+        out[name] = np.frombuffer(raw, '<i4', n, pos)
+        pos += 4 * n
+    for name in ('customer_id', 'reading_type', 'quality_code'):
+        out[name] = np.frombuffer(raw, '<u2', n, pos)
+        pos += 2 * n
+    out['tables'] = json.loads(raw[pos:].decode('utf-8'))
+    return out
+
+
+def _index_dtype(id_width):
+    return np.dtype([('meter_id', f'S{id_width}'), ('offset', '<u8'), ('length', '<u4'),
+                     ('count', '<u4'), ('first', '<i8'), ('last', '<i8')])
+
+
+class ArchiveFile:
+    """One month's archive, memory-mapped; the meter index is a sorted array searched in place."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.identity = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        self.size = stat.st_size
+        if self._mmap[:len(MAGIC)] != MAGIC:
+            raise ValueError(f'{path} is not a readings archive')
+        meta_offset, meta_length, magic = TRAILER.unpack_from(self._mmap, self.size - TRAILER.size)
+        if magic != MAGIC:
+            raise ValueError(f'{path} is truncated')
+        self.meta = json.loads(self._mmap[meta_offset:meta_offset + meta_length])
+        self.month = datetime.fromisoformat(self.meta['month'])
+        self.index = np.frombuffer(self._mmap, _index_dtype(self.meta['id_width']),
+                                   self.meta['meters'], self.meta['index_offset'])
+        self._view = memoryview(self._mmap)
+
+    def lookup(self, meter_id):
+        key = meter_id.encode('utf-8')
+        ids = self.index['meter_id']
+        i = int(np.searchsorted(ids, key))
+        if i < len(ids) and ids[i] == key:
+            return self.index[i]
+        return None
+
+    def raw_block(self, entry):
+        return self._view[int(entry['offset']):int(entry['offset']) + int(entry['length'])]
+
+    def block(self, entry):
+        return decode_block(self.raw_block(entry))
+
+
+def _select(block, lo, hi, before):
+    """Positions of block rows with lo <= date <= hi and (date, id) < before, ascending."""
+    dates = block['reading_date']
+    start = 0 if lo is None else int(np.searchsorted(dates, lo, 'left'))
+    stop = len(dates) if hi is None else int(np.searchsorted(dates, hi, 'right'))
+    if before is not None:
+        # Dates are unique per meter, so the id only matters on an exact date match
+        cut = int(np.searchsorted(dates, before[0], 'left'))
+        if cut < len(dates) and dates[cut] == before[0] and block['reading_id'][cut] < before[1]:
+            cut += 1
+        stop = min(stop, cut)
+    return start, max(start, stop)
+
+
+def block_rows(block, meter_id, positions, fmt):
+    """Rows in the shape the readings query returns for fmt, for the given block positions."""
+    customers, types, qualities = block['tables']
+    rows = []
+    for i in positions:
+        date_us, reading_id = int(block['reading_date'][i]), int(block['reading_id'][i])
+        value = int(block['reading_value'][i]) / VALUE_SCALE
+        if fmt == 'binary':
+            rows.append((reading_id, date_us, value))
+            continue
+        temperature, voltage, signal = (int(block[name][i]) for name in ('temperature', 'voltage', 'signal_strength'))
+        temperature = None if temperature == NULL_INT32 else temperature / SENSOR_SCALE
+        voltage = None if voltage == NULL_INT32 else voltage / SENSOR_SCALE
+        signal = None if signal == NULL_INT32 else signal
+        created_us = int(block['created_at'][i])
+        customer = customers[block['customer_id'][i]]
+        reading_type, quality = types[block['reading_type'][i]], qualities[block['quality_code'][i]]
+        if fmt == 'columnar':
+            rows.append((reading_id, date_us / 1000000, customer, value, reading_type, quality,
+                         temperature, voltage, signal, None if created_us == NULL_INT64 else created_us / 1000000))
+        else:
+            rows.append((reading_id, meter_id, customer, value, from_micros(date_us), reading_type, quality,
+                         temperature, voltage, signal, None if created_us == NULL_INT64 else from_micros(created_us)))
+    return rows
+
+
+def row_key(row, fmt):
+    """(reading_date in microseconds, reading_id) of a readings query row in fmt's shape."""
+    if fmt == 'binary':
+        return row[1], row[0]
+    if fmt == 'columnar':
+        return round(row[1] * 1000000), row[0]
+    return to_micros(row[4]), row[0]
+
+
+class ColdStore:
+    """The archive directory as seen by readers; rescanned at most once a second."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._files = []        # ArchiveFile, newest month first
+        self._scanned = 0.0
+        self._dir_mtime = None
+
+        self.queries = 0
+        self.blocks_read = 0
+
+    def files(self):
+        now = time.monotonic()
+        if now - self._scanned >= 1.0:
+            with self._lock:
+                if now - self._scanned >= 1.0:
+                    self._scan()
+                    self._scanned = now
+        return self._files
+
+    def _scan(self):
+        try:
+            names = sorted(n for n in os.listdir(self.directory)
+                           if n.startswith(FILE_PREFIX) and n.endswith(FILE_SUFFIX))
+        except FileNotFoundError:
+            self._files = []
+            return
+        current = {f.path: f for f in self._files}
+        files = []
+        for name in names:
+            path = os.path.join(self.directory, name)
+            existing = current.get(path)
+            try:
+                stat = os.stat(path)
+                if existing is not None and existing.identity == (stat.st_ino, stat.st_mtime_ns, stat.st_size):
+                    files.append(existing)
+                else:
+                    files.append(ArchiveFile(path))
+            except (OSError, ValueError) as e:
+                print(f'Skipping archive file {path}: {e}')
+        # Replaced files stay mapped until the last reader drops them
+        self._files = sorted(files, key=lambda f: f.month, reverse=True)
+
+    def newest(self, meter_id):
+        """reading_date in microseconds of the meter's newest archived reading, or None."""
+        for archive in self.files():
+            entry = archive.lookup(meter_id)
+            if entry is not None:
+                return int(entry['last'])
+        return None
+
+    def readings(self, meter_id, start=None, end=None, before=None, limit=100, fmt='json'):
+        """Up to `limit` archived rows for meter_id, newest first, shaped like the readings query for fmt.
+
+        start and end bound reading_date (datetimes, inclusive); before is a
+        (reading_date, reading_id) keyset bound.
+        """
+        lo = None if start is None else to_micros(start)
+        hi = None if end is None else to_micros(end)
+        bound = None if before is None else (to_micros(before[0]), before[1])
+        self.queries += 1
+        rows = []
+        for archive in self.files():
+            if len(rows) >= limit:
+                break
+            entry = archive.lookup(meter_id)
+            if (entry is None or (lo is not None and entry['last'] < lo) or (hi is not None and entry['first'] > hi)
+                    or (bound is not None and entry['first'] > bound[0])):
+                continue
+            block = archive.block(entry)
+            self.blocks_read += 1
+            first, stop = _select(block, lo, hi, bound)
+            take = range(stop - 1, max(first, stop - (limit - len(rows))) - 1, -1)
+            rows.extend(block_rows(block, meter_id, take, fmt))
+        return rows
+
+    def series(self, meter_id, start=None, end=None):
+        """(epoch seconds, values) of every archived reading in the window, ascending."""
+        lo = None if start is None else to_micros(start)
+        hi = None if end is None else to_micros(end)
+        times, values = [], []
+        for archive in reversed(self.files()):
+            entry = archive.lookup(meter_id)
+            if entry is None or (lo is not None and entry['last'] < lo) or (hi is not None and entry['first'] > hi):
+                continue
+            block = archive.block(entry)
+            self.blocks_read += 1
+            first, stop = _select(block, lo, hi, None)
+            times.append(block['reading_date'][first:stop] / 1000000)
+            values.append(block['reading_value'][first:stop] / VALUE_SCALE)
+        if not times:
+            return np.empty(0), np.empty(0)
+        return np.concatenate(times), np.concatenate(values)
+
+    def stats(self):
+        files = self.files()
+        return {
+            'directory': os.path.abspath(self.directory),
+            'files': len(files),
+            'months': [f'{archive.month:%Y-%m}' for archive in files],
+            'readings': sum(archive.meta['rows'] for archive in files),
+            'bytes': sum(archive.size for archive in files),
+            'queries': self.queries,
+            'blocks_read': self.blocks_read
+        }
+
+
+_cold_store = None
+_cold_store_lock = threading.Lock()
+
+
+def get_cold_store():
+    global _cold_store
+    if _cold_store is None:
+        with _cold_store_lock:
+            if _cold_store is None:
+                _cold_store = ColdStore(ARCHIVE_DIR)
+    return _cold_store
+
+
+def merge_cold(readings, cold, meter_id, start, end, after, limit, fmt):
+    """Merge archived readings into a newest-first page of live readings.
+
+    Archived months normally hold only readings older than any live one,
+    but a late reading can land in an archived month, so the two are merged
+    by (reading_date, reading_id) and the live row wins a duplicate date.
+    """
+    newest = cold.newest(meter_id)
+    if newest is None:
+        return readings
+    # A full page whose oldest row is newer than everything archived can't change
+    if len(readings) >= limit and row_key(readings[limit - 1], fmt)[0] > newest:
+        return readings
+    archived = cold.readings(meter_id, start, end, after, limit, fmt)
+    if not archived:
+        return readings
+    live_dates = {row_key(row, fmt)[0] for row in readings}
+    merged = list(readings) + [row for row in archived if row_key(row, fmt)[0] not in live_dates]
+    merged.sort(key=lambda row: row_key(row, fmt), reverse=True)
+    return merged[:limit]
+
+
+class _ArchiveWriter:
+    def __init__(self, path, month, level):
+        self.tmp_path = f'{path}.tmp'
+        self.path = path
+        self.month = month
+        self.level = level
+        self.file = open(self.tmp_path, 'wb')
+        self.file.write(MAGIC)
+        self.offset = len(MAGIC)
+        self.entries = []
+        self.rows = 0
+
+    def add(self, meter_id, data, count, first, last):
+        self.file.write(data)
+        self.entries.append((meter_id.encode('utf-8'), self.offset, len(data), count, first, last))
+        self.offset += len(data)
+        self.rows += count
+
+    def add_rows(self, meter_id, rows):
+        self.add(meter_id, encode_block(rows, self.level), len(rows), rows[0][1], rows[-1][1])
+
+    def finish(self):
+        """Write the sorted index and trailer, fsync, and move the file into place."""
+        self.entries.sort()
+        width = max((len(entry[0]) for entry in self.entries), default=1)
+        index = np.array(self.entries, dtype=_index_dtype(width))
+        index_offset = self.offset
+        self.file.write(index.tobytes())
+        meta = json.dumps({
+            'version': 1,
+            'month': self.month.isoformat(),
+            'meters': len(index),
+            'rows': self.rows,
+            'id_width': width,
+            'index_offset': index_offset,
+            'value_scale': VALUE_SCALE,
+            'sensor_scale': SENSOR_SCALE,
+            'created_at': datetime.utcnow().isoformat()
+        }).encode('utf-8')
+        meta_offset = index_offset + index.nbytes
+        self.file.write(meta)
+        self.file.write(TRAILER.pack(meta_offset, len(meta), MAGIC))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        os.replace(self.tmp_path, self.path)
+        dir_fd = os.open(os.path.dirname(self.path) or '.', os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+        return meta_offset + len(meta) + TRAILER.size
+
+    def abort(self):
+        self.file.close()
+        try:
+            os.remove(self.tmp_path)
+        except FileNotFoundError:
+            pass
+
+
+def _merge_existing(rows, existing_block, meter_id):
+    """Fold a meter's previously archived rows into its newly exported rows; exported rows win."""
+    old = block_rows(existing_block, meter_id, range(len(existing_block['reading_date'])), 'json')
+    exported = {row[1] for row in rows}
+    for r in old:
+        date_us = to_micros(r[4])
+        if date_us in exported:
+            continue
+        rows.append((meter_id, date_us, r[0], round(r[3] * VALUE_SCALE), r[2], r[5], r[6],
+                     None if r[7] is None else round(r[7] * SENSOR_SCALE),
+                     None if r[8] is None else round(r[8] * SENSOR_SCALE), r[9],
+                     None if r[10] is None else to_micros(r[10])))
+    rows.sort(key=lambda row: row[1])
+    return rows
+
+
+def archive_month(conn, month, directory=ARCHIVE_DIR, level=ARCHIVE_COMPRESSION_LEVEL):
+    """Move one calendar month of readings from meter_readings into its archive file.
+
+    The export and the delete share one REPEATABLE READ snapshot, so a
+    reading inserted meanwhile stays in the table. The file is in place
+    before the delete commits: a failure after that leaves readings in
+    both places, which readers deduplicate and the next run cleans up.
+    Returns a summary dict.
+    """
+    end = next_period(month, 'month')
+    os.makedirs(directory, exist_ok=True)
+    path = archive_path(directory, month)
+    existing = ArchiveFile(path) if os.path.exists(path) else None
+
+    # Partitions lying wholly inside the month are found in a transaction of their own:
+    # any query in the REPEATABLE READ transaction below would take its snapshot
+    cur = conn.cursor()
+    whole = []
+    if is_partitioned(cur):
+        whole = [name for name, start, stop in list_partitions(cur) if start >= month and stop <= end]
+    conn.rollback()
+
+    conn.set_session(isolation_level='REPEATABLE READ')
+    try:
+        cur = conn.cursor()
+        # LOCK takes no snapshot, so it runs first: it waits for in-flight inserts into
+        # the partitions to commit, and the snapshot taken after it sees them. Later
+        # inserts block until the partitions are dropped.
+        for name in whole:
+            cur.execute(f'LOCK TABLE {name} IN SHARE MODE')
+        table_bytes = 0
+        if whole:
+            cur.execute('SELECT COALESCE(SUM(pg_total_relation_size(c::regclass)), 0) FROM unnest(%s::text[]) c',
+                        (whole,))
+            table_bytes = int(cur.fetchone()[0])
+
+        export = conn.cursor(name=f'archive_{month:%Y%m}')
+        export.itersize = ARCHIVE_FETCH_SIZE
+        export.execute(EXPORT_SELECT, (month, end))
+        writer = _ArchiveWriter(path, month, level)
+        written = set()
+        exported = 0
+        try:
+            group = []
+            for row in export:
+                exported += 1
+                if group and row[0] != group[0][0]:
+                    _write_group(writer, group, existing, written)
+                    group = []
+                group.append(row)
+            if group:
+                _write_group(writer, group, existing, written)
+            export.close()
+            if existing is not None:
+                # Meters archived before and untouched since keep their compressed block as is
+                for entry in existing.index:
+                    meter_id = entry['meter_id'].decode('utf-8')
+                    if meter_id not in written:
+                        writer.add(meter_id, bytes(existing.raw_block(entry)), int(entry['count']),
+                                   int(entry['first']), int(entry['last']))
+            if writer.rows == 0:
+                writer.abort()
+                conn.rollback()
+                return {'month': f'{month:%Y-%m}', 'rows': 0}
+            file_bytes = writer.finish()
+        except BaseException:
+            writer.abort()
+            raise
+
+        for name in whole:
+            cur.execute(f'ALTER TABLE meter_readings DETACH PARTITION {name}')
+            cur.execute(f'DROP TABLE {name}')
+        # Row sizes stand in for the space a DELETE frees; VACUUM makes it reusable
+        cur.execute('''
+            WITH deleted AS (
+                DELETE FROM meter_readings WHERE reading_date >= %s AND reading_date < %s
+                RETURNING pg_column_size(meter_readings.*) AS size
+            )
+            SELECT count(*), COALESCE(SUM(size), 0) FROM deleted
+        ''', (month, end))
+        deleted, deleted_bytes = cur.fetchone()
+        table_bytes += int(deleted_bytes)
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        conn.set_session(isolation_level='DEFAULT')
+    return {
+        'month': f'{month:%Y-%m}',
+        'rows': exported,
+        'file_rows': writer.rows,
+        'dropped_partitions': whole,
+        'deleted_rows': deleted,
+        'file_bytes': file_bytes,
+        'table_bytes': table_bytes
+    }
+
+
+def _write_group(writer, rows, existing, written):
+    meter_id = rows[0][0]
+    if existing is not None:
+        entry = existing.lookup(meter_id)
+        if entry is not None:
+            rows = _merge_existing(list(rows), existing.block(entry), meter_id)
+    writer.add_rows(meter_id, rows)
+    written.add(meter_id)
+
+
+def archive_months(cur, before=None, after=None):
+    """Calendar months holding readings older than `before` (or READINGS_ARCHIVE_AFTER ago), oldest first."""
+    if before is None:
+        if not (after or ARCHIVE_AFTER):
+            raise ValueError('Set READINGS_ARCHIVE_AFTER (e.g. "13 months") or pass --before')
+        cur.execute('SELECT now()::timestamp - %s::interval', (after or ARCHIVE_AFTER,))
+        before = cur.fetchone()[0]
+    cutoff = month_start(before)
+    cur.execute('SELECT MIN(reading_date) FROM meter_readings WHERE reading_date < %s', (cutoff,))
+    oldest = cur.fetchone()[0]
+    months = []
+    if oldest is not None:
+        month = month_start(oldest)
+        while month < cutoff:
+            months.append(month)
+            month = next_period(month, 'month')
+    return months
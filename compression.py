@@ -0,0 +1,129 @@
+"""Content-negotiated gzip/brotli response compression and precompressed static pages."""
+import gzip
+import hashlib
+import os
+import threading
+import time
+
+try:
+    import brotli
+except ImportError:     # gzip only
+    brotli = None
+
+from metrics import inc
+
+COMPRESS_MIN_BYTES = int(os.environ.get('COMPRESS_MIN_BYTES', 1024))
+# Dynamic responses are compressed on every request, so trade a little ratio for CPU:
+# on readings and listing JSON, gzip 5 and brotli 4 come within a few percent of
+# gzip 6 / brotli 5 output at lower cost. Static pages use the maximum levels once.
+COMPRESS_GZIP_LEVEL = int(os.environ.get('COMPRESS_GZIP_LEVEL', 5))
+COMPRESS_BROTLI_QUALITY = int(os.environ.get('COMPRESS_BROTLI_QUALITY', 4))
+COMPRESS_LOG_INTERVAL = float(os.environ.get('COMPRESS_LOG_INTERVAL', 60))
+
+ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+COMPRESSIBLE_TYPES = ('application/json', 'text/html', 'text/plain', 'text/csv')
+
+
+def compress(body, encoding, level=None):
+    if encoding == 'br':
+        return brotli.compress(body, quality=COMPRESS_BROTLI_QUALITY if level is None else level)
+    return gzip.compress(body, COMPRESS_GZIP_LEVEL if level is None else level, mtime=0)
+
+
+def choose_encoding(request):
+    """Best encoding the client accepts (by q-value, then br over gzip), or None for identity."""
+    return request.accept_encodings.best_match(ENCODINGS)
+
+
+class CompressionStats:
+    """Bytes before and after compression, logged at most once per interval."""
+
+    def __init__(self, log_interval=60.0):
+        self.log_interval = log_interval
+        self._lock = threading.Lock()
+        self._totals = {}   # encoding -> [responses, bytes in, bytes out]
+        self._window = {}
+        self._last_log = time.monotonic()
+
+    def record(self, encoding, size_in, size_out):
+        inc('http_compression_bytes_total', (encoding, 'in'), size_in)
+        inc('http_compression_bytes_total', (encoding, 'out'), size_out)
+        now = time.monotonic()
+        with self._lock:
+            for table in (self._totals, self._window):
+                counts = table.setdefault(encoding, [0, 0, 0])
+                counts[0] += 1
+                counts[1] += size_in
+                counts[2] += size_out
+            if now - self._last_log < self.log_interval:
+                return
+            window, self._window, self._last_log = self._window, {}, now
+        for name, (responses, size_in, size_out) in sorted(window.items()):
+            print(f'Compression ({name}): {responses} responses, {size_in} -> {size_out} bytes, '
+                  f'{size_in - size_out} saved ({(1 - size_out / size_in) * 100:.1f}%)')
+
+    def stats(self):
+        with self._lock:
+            return {
+                name: {'responses': responses, 'bytes_in': size_in, 'bytes_out': size_out,
+                       'bytes_saved': size_in - size_out}
+                for name, (responses, size_in, size_out) in self._totals.items()
+            }
+
+
+_stats = CompressionStats(log_interval=COMPRESS_LOG_INTERVAL)
+
+
+def get_compression_stats():
+    return _stats
+
+
+def compress_response(request, response):
+    """after_request hook: compress eligible responses for clients that accept it."""
+    if response.mimetype not in COMPRESSIBLE_TYPES:
+        return response
+    response.vary.add('Accept-Encoding')
+    if (response.direct_passthrough or response.is_streamed or 'Content-Encoding' in response.headers
+            or response.status_code < 200 or response.status_code in (204, 206, 304)):
+        return response
+    encoding = choose_encoding(request)
+    if encoding is None:
+        return response
+    body = response.get_data()
+    if len(body) < COMPRESS_MIN_BYTES:
+        return response
+
+    compressed = compress(body, encoding)
+    if len(compressed) >= len(body):
+        return response
+    response.set_data(compressed)
+    response.headers['Content-Encoding'] = encoding
+    # Same entity, different bytes: a weak validator still matches If-None-Match
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    _stats.record(encoding, len(body), len(compressed))
+    return response
+
+
+class StaticPage:
+    """A constant body compressed once per encoding at the highest levels, served with strong ETags."""
+
+    def __init__(self, body, mimetype, max_age=3600):
+        self.mimetype = mimetype
+        self.max_age = max_age
+        self.variants = {None: body if isinstance(body, bytes) else body.encode('utf-8')}
+        for encoding in ENCODINGS:
+            self.variants[encoding] = compress(self.variants[None], encoding, level=11 if encoding == 'br' else 9)
+        self.digest = hashlib.sha256(self.variants[None]).hexdigest()[:16]
+
+    def response(self, request, response_class):
+        encoding = choose_encoding(request)
+        response = response_class(self.variants[encoding], mimetype=self.mimetype)
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+        response.vary.add('Accept-Encoding')
+        response.set_etag(f'{self.digest}-{encoding or "identity"}')
+        response.cache_control.public = True
+        response.cache_control.max_age = self.max_age
+        return response.make_conditional(request)
@@ -0,0 +1,117 @@
+"""One LISTEN connection per process, fanning PostgreSQL NOTIFY payloads out to callbacks."""
+import select
+import threading
+
+import psycopg2
+import psycopg2.extensions
+
+from db_pool import connect, DatabaseUnavailable
+
+
+class ChangeListener:
+    def __init__(self, connect_fn=connect, poll_interval=1.0, retry_delay=2.0, max_retry_delay=30.0):
+        self.connect_fn = connect_fn
+        self.poll_interval = poll_interval
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.listening = False
+        self.notifications = 0
+        self.reconnects = 0
+
+        self._lock = threading.Lock()
+        self._handlers = {}     # channel -> [(callback, on_reset)]
+        self._thread = None
+        self._stop = threading.Event()
+
+    def subscribe(self, channel, callback, on_reset=None):
+        # on_reset runs whenever the listener (re)connects: notifications sent
+        # while nobody was listening are lost, so subscribers must resync.
+        with self._lock:
+            self._handlers.setdefault(channel, []).append((callback, on_reset))
+        self.start()
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='db-change-listener', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.poll_interval + 1)
+
+    def stats(self):
+        with self._lock:
+            channels = sorted(self._handlers)
+        return {
+            'listening': self.listening,
+            'channels': channels,
+            'notifications': self.notifications,
+            'reconnects': self.reconnects
+        }
+
+    def _run(self):
+        delay = self.retry_delay
+        while not self._stop.is_set():
+            conn = None
+            try:
+                conn = self.connect_fn()
+                conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                self.listening = True
+                delay = self.retry_delay
+                self._poll(conn)
+            except (DatabaseUnavailable, psycopg2.Error) as e:
+                if not self._stop.is_set():
+                    print(f'Change listener error: {e}')
+            finally:
+                self.listening = False
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except psycopg2.Error:
+                        pass
+            if self._stop.wait(delay):
+                break
+            self.reconnects += 1
+            delay = min(delay * 2, self.max_retry_delay)
+
+    def _poll(self, conn):
+        cur = conn.cursor()
+        listening = set()
+        while not self._stop.is_set():
+            with self._lock:
+                handlers = {channel: list(subs) for channel, subs in self._handlers.items()}
+            for channel in sorted(handlers.keys() - listening):
+                cur.execute(f'LISTEN {channel}')
+                listening.add(channel)
+                for _, on_reset in handlers[channel]:
+                    if on_reset:
+                        on_reset()
+
+            if select.select([conn], [], [], self.poll_interval) == ([], [], []):
+                continue
+            conn.poll()
+            while conn.notifies:
+                notify = conn.notifies.pop(0)
+                self.notifications += 1
+                for callback, _ in handlers.get(notify.channel, ()):
+                    try:
+                        callback(notify.payload)
+                    except Exception as e:
+                        print(f'Change listener callback error on {notify.channel}: {e}')
+
+
+_listener = None
+_listener_lock = threading.Lock()
+
+
+def get_listener():
+    global _listener
+    if _listener is None:
+        with _listener_lock:
+            if _listener is None:
+                _listener = ChangeListener()
+    return _listener
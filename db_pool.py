@@ -0,0 +1,320 @@
+"""Shared, bounded PostgreSQL connection pool used by every route."""
+import os
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+
+import psycopg2
+import psycopg2.extensions
+
+from metrics import TimedCursor, observe, query_helper
+
+
+class DatabaseUnavailable(Exception):
+    pass
+
+
+class PoolTimeout(DatabaseUnavailable):
+    pass
+
+
+def connect(host=None, port=None):
+    try:
+        return psycopg2.connect(
+            host=host or os.environ.get('DB_HOST'),
+            port=port,
+            database=os.environ.get('DB_NAME', 'postgres'),
+            user=os.environ.get('DB_USER', 'postgres'),
+            password=os.environ.get('DB_PASSWORD'),
+            cursor_factory=TimedCursor
+        )
+    except psycopg2.Error as e:
+        print(f'DB error: {e}')
+        raise DatabaseUnavailable(str(e)) from e
+
+
+class ConnectionPool:
+    def __init__(self, connect_fn=connect, min_size=1, max_size=10, acquire_timeout=5.0,
+                 max_uses=5000, max_lifetime=1800.0, validate_after=30.0):
+        if max_size < 1 or min_size > max_size:
+            raise ValueError('Pool requires 1 <= max_size and min_size <= max_size')
+        self.connect_fn = connect_fn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.acquire_timeout = acquire_timeout
+        self.max_uses = max_uses
+        self.max_lifetime = max_lifetime
+        self.validate_after = validate_after
+
+        self._cond = threading.Condition()
+        self._idle = []     # LIFO stack of idle connections, most recently used last
+        self._meta = {}     # conn -> {'created': t, 'uses': n, 'last_used': t}
+        self._size = 0      # open connections plus connections currently being opened
+        self._closed = False
+
+        self._acquired = 0
+        self._waits = 0
+        self._wait_time = 0.0
+        self._max_wait = 0.0
+        self._timeouts = 0
+        self._created = 0
+        self._recycled = 0
+        self._discarded = 0
+        self._validation_failures = 0
+
+    def fill(self):
+        # Best effort: a database that is down at startup must not stop the app from booting
+        while True:
+            with self._cond:
+                if self._closed or self._size >= self.min_size:
+                    return
+                self._size += 1
+            try:
+                conn = self._open()
+            except DatabaseUnavailable:
+                with self._cond:
+                    self._size -= 1
+                    self._cond.notify()
+                return
+            with self._cond:
+                self._idle.append(conn)
+                self._cond.notify()
+
+    def acquire(self, timeout=None):
+        timeout = self.acquire_timeout if timeout is None else timeout
+        start = time.monotonic()
+        deadline = start + timeout
+        waited = False
+
+        while True:
+            conn = None
+            with self._cond:
+                while True:
+                    if self._closed:
+                        raise DatabaseUnavailable('Connection pool is closed')
+                    if self._idle:
+                        conn = self._idle.pop()
+                        break
+                    if self._size < self.max_size:
+                        self._size += 1
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._timeouts += 1
+                        raise PoolTimeout(f'Timed out after {timeout:.1f}s waiting for a database connection')
+                    waited = True
+                    self._cond.wait(remaining)
+
+            if conn is None:
+                try:
+                    conn = self._open()
+                except DatabaseUnavailable:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+            elif not self._validate(conn):
+                continue
+
+            elapsed = time.monotonic() - start
+            observe('db_pool_acquire_seconds', (), elapsed)
+            with self._cond:
+                self._acquired += 1
+                if waited:
+                    self._waits += 1
+                self._wait_time += elapsed
+                self._max_wait = max(self._max_wait, elapsed)
+                self._meta[conn]['uses'] += 1
+            return conn
+
+    def release(self, conn, discard=False):
+        now = time.monotonic()
+        with self._cond:
+            meta = self._meta.get(conn)
+        if meta is None:
+            return
+
+        if not discard and not conn.closed:
+            try:
+                if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                discard = True
+
+        recycle = (meta['uses'] >= self.max_uses or now - meta['created'] >= self.max_lifetime)
+        if discard or recycle or conn.closed or self._closed:
+            self._close(conn)
+            with self._cond:
+                if recycle and not discard:
+                    self._recycled += 1
+                else:
+                    self._discarded += 1
+                self._cond.notify()
+            return
+
+        meta['last_used'] = now
+        with self._cond:
+            self._idle.append(conn)
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self, timeout=None):
+        conn = self.acquire(timeout)
+        discard = False
+        try:
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            discard = True
+            raise
+        except Exception:
+            if not conn.closed:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    discard = True
+            raise
+        finally:
+            self.release(conn, discard=discard)
+
+    def stats(self):
+        with self._cond:
+            idle = len(self._idle)
+            return {
+                'min_size': self.min_size,
+                'max_size': self.max_size,
+                'size': self._size,
+                'in_use': self._size - idle,
+                'idle': idle,
+                'acquired': self._acquired,
+                'waits': self._waits,
+                'wait_time_total_ms': round(self._wait_time * 1000, 3),
+                'wait_time_avg_ms': round(self._wait_time * 1000 / self._acquired, 3) if self._acquired else 0.0,
+                'wait_time_max_ms': round(self._max_wait * 1000, 3),
+                'timeouts': self._timeouts,
+                'created': self._created,
+                'recycled': self._recycled,
+                'discarded': self._discarded,
+                'validation_failures': self._validation_failures
+            }
+
+    def backend_pids(self):
+        """Server process ids of every open pooled connection, idle or checked out."""
+        with self._cond:
+            conns = list(self._meta)
+        return {conn.get_backend_pid() for conn in conns if not conn.closed}
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._cond.notify_all()
+        for conn in idle:
+            self._close(conn)
+
+    def _open(self):
+        conn = self.connect_fn()
+        now = time.monotonic()
+        with self._cond:
+            self._meta[conn] = {'created': now, 'uses': 0, 'last_used': now}
+            self._created += 1
+        return conn
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+        with self._cond:
+            self._meta.pop(conn, None)
+            self._size -= 1
+
+    def _validate(self, conn):
+        meta = self._meta[conn]
+        now = time.monotonic()
+        ok = not conn.closed and now - meta['created'] < self.max_lifetime
+        if ok and now - meta['last_used'] >= self.validate_after:
+            try:
+                cur = conn.cursor()
+                cur.execute('SELECT 1')
+                cur.fetchone()
+                cur.close()
+                conn.rollback()
+            except psycopg2.Error:
+                ok = False
+        if not ok:
+            self._close(conn)
+            with self._cond:
+                self._validation_failures += 1
+                self._cond.notify()
+        return ok
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                pool = ConnectionPool(
+                    min_size=int(os.environ.get('DB_POOL_MIN_SIZE', 1)),
+                    max_size=int(os.environ.get('DB_POOL_MAX_SIZE', 10)),
+                    acquire_timeout=float(os.environ.get('DB_POOL_TIMEOUT', 5)),
+                    max_uses=int(os.environ.get('DB_POOL_MAX_USES', 5000)),
+                    max_lifetime=float(os.environ.get('DB_POOL_MAX_LIFETIME', 1800)),
+                    validate_after=float(os.environ.get('DB_POOL_VALIDATE_AFTER', 30))
+                )
+                pool.fill()
+                _pool = pool
+    return _pool
+
+
+def close_pool():
+    """Close this process's pool; the next get_pool() opens a fresh one."""
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.close()
+
+
+_inherited_pools = []
+
+
+def _forget_pool_after_fork():
+    # The parent owns any inherited sockets. Closing them here, even implicitly
+    # when the connections are garbage collected, would end the parent's
+    # sessions, so keep them referenced and never touch them.
+    global _pool, _pool_lock
+    if _pool is not None:
+        _inherited_pools.append(_pool)
+    _pool = None
+    _pool_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_forget_pool_after_fork)
+
+
+def db_connection(timeout=None):
+    return get_pool().connection(timeout)
+
+
+# Statement names prepared on each connection; entries go away with the connection
+_prepared = weakref.WeakKeyDictionary()
+
+
+@query_helper
+def execute_prepared(cur, name, param_types, query, params):
+    """Run query as a server-side prepared statement, preparing it on the connection's first use.
+
+    query uses $1..$n placeholders typed by param_types. Prepared statements
+    outlive transactions, so a rollback doesn't force a re-prepare.
+    """
+    names = _prepared.setdefault(cur.connection, set())
+    if name not in names:
+        cur.execute(f'PREPARE {name} ({", ".join(param_types)}) AS {query}')
+        names.add(name)
+    cur.execute(f'EXECUTE {name} ({", ".join(["%s"] * len(params))})', params)
@@ -0,0 +1,171 @@
+"""Reduce a meter's readings over a time window to a chart-sized series: LTTB, min/max or average buckets."""
+import itertools
+import os
+
+import numpy as np
+
+DOWNSAMPLE_METHODS = ('lttb', 'minmax', 'avg')
+DOWNSAMPLE_MAX_POINTS = int(os.environ.get('DOWNSAMPLE_MAX_POINTS', 5000))
+# Windows with more readings than this are pre-bucketed in SQL instead of fetched row by row
+DOWNSAMPLE_RAW_LIMIT = int(os.environ.get('DOWNSAMPLE_RAW_LIMIT', 200000))
+# SQL pre-buckets per output point: each keeps its min and max reading, so LTTB still sees the extremes
+PRE_BUCKETS_PER_POINT = 4
+
+
+def _time_buckets(t, count):
+    span = t[-1] - t[0]
+    if span <= 0:
+        return np.zeros(len(t), dtype=np.int64)
+    return np.minimum(((t - t[0]) / span * count).astype(np.int64), count - 1)
+
+
+def lttb(t, v, n):
+    """Indexes of n points chosen by Largest-Triangle-Three-Buckets; t must be ascending."""
+    size = len(t)
+    if n >= size:
+        return np.arange(size)
+    if n < 3:
+        return np.array([0, size - 1][:max(n, 1)])
+    # n - 2 equal-count buckets between the always-kept first and last points
+    edges = np.linspace(1, size - 1, n - 1).astype(np.int64)
+    counts = np.diff(edges)
+    mean_t = np.add.reduceat(t[:size - 1], edges[:-1]) / counts
+    mean_v = np.add.reduceat(v[:size - 1], edges[:-1]) / counts
+    mean_t = np.append(mean_t[1:], t[-1])   # each bucket looks at the next bucket's centroid
+    mean_v = np.append(mean_v[1:], v[-1])
+
+    selected = np.empty(n, dtype=np.int64)
+    selected[0], selected[-1] = 0, size - 1
+    a = 0
+    for i in range(n - 2):
+        lo, hi = edges[i], edges[i + 1]
+        # Twice the triangle area between the last selected point, each candidate and the next centroid
+        area = np.abs((t[a] - mean_t[i]) * (v[lo:hi] - v[a]) - (t[a] - t[lo:hi]) * (mean_v[i] - v[a]))
+        a = lo + int(area.argmax())
+        selected[i + 1] = a
+    return selected
+
+
+def minmax(t, v, n):
+    """Indexes of the lowest and highest reading in each of n // 2 equal-time buckets, in time order."""
+    if n >= len(t):
+        return np.arange(len(t))
+    bucket = _time_buckets(t, max(n // 2, 1))
+    order = np.lexsort((v, bucket))
+    starts = np.flatnonzero(np.diff(bucket[order], prepend=-1))
+    ends = np.append(starts[1:], len(order)) - 1
+    return np.unique(np.concatenate((order[starts], order[ends])))
+
+
+def average(t, v, n, weights=None):
+    """(times, values) of the mean reading in each of n equal-time buckets, empty buckets dropped.
+
+    weights counts the readings behind each point when the points are already means.
+    """
+    if n >= len(t):
+        return t, v
+    bucket = _time_buckets(t, n)
+    if weights is None:
+        weights = np.ones(len(t))
+    counts = np.bincount(bucket, weights=weights, minlength=n)
+    keep = counts > 0
+    return (np.bincount(bucket, weights=t * weights, minlength=n)[keep] / counts[keep],
+            np.bincount(bucket, weights=v * weights, minlength=n)[keep] / counts[keep])
+
+
+def _where(meter_id, start_date, end_date):
+    clauses, params = ['meter_id = %s'], [meter_id]
+    if start_date:
+        clauses.append('reading_date >= %s')
+        params.append(start_date)
+    if end_date:
+        clauses.append('reading_date <= %s')
+        params.append(end_date)
+    return ' AND '.join(clauses), params
+
+
+def _fetch_buckets(cur, meter_id, start_date, end_date, buckets):
+    """Per equal-time bucket: count, mean time/value and the min and max readings as (value, time)."""
+    where, params = _where(meter_id, start_date, end_date)
+    cur.execute(f'''
+        WITH r AS (
+            SELECT date_part('epoch', reading_date) AS t, reading_value::float8 AS v
+            FROM meter_readings
+            WHERE {where}
+        ), bounds AS (
+            SELECT min(t) AS lo, max(t) AS hi FROM r
+        )
+        SELECT count(*), avg(t), avg(v), min(ARRAY[v, t]), max(ARRAY[v, t])
+        FROM r, bounds
+        GROUP BY LEAST(floor((t - lo) / NULLIF(hi - lo, 0) * %s), %s - 1)
+        ORDER BY 2
+    ''', params + [buckets, buckets])
+    return cur.fetchall()
+
+
+def _with_archived(t, v, counts, archived):
+    """Add archived (times, values) points to a series; a live point wins a duplicate time."""
+    archived_t, archived_v = archived
+    t = np.concatenate((t, archived_t))
+    v = np.concatenate((v, archived_v))
+    if counts is not None:
+        counts = np.concatenate((counts, np.ones(len(archived_t))))
+    t, first = np.unique(t, return_index=True)
+    return t, v[first], None if counts is None else counts[first]
+
+
+def downsample_readings(cur, meter_id, start_date, end_date, max_points, method, archived=None):
+    """Return (epoch-second times, values, readings considered) for the whole window, reduced to max_points.
+
+    archived is an optional ascending (times, values) pair from cold storage
+    covering the same window.
+    """
+    where, params = _where(meter_id, start_date, end_date)
+    # Pick the path before shipping anything: a capped count is an index-only
+    # scan of idx_readings_meter_date and returns one row however large the window
+    cur.execute(f'SELECT count(*) FROM (SELECT 1 FROM meter_readings WHERE {where} LIMIT %s) r',
+                params + [DOWNSAMPLE_RAW_LIMIT + 1])
+    raw = cur.fetchone()[0] <= DOWNSAMPLE_RAW_LIMIT
+
+    counts = None
+    if raw:
+        # date_part returns float8 directly; EXTRACT goes through numeric and costs
+        # about a fifth more per row on a year of quarter-hourly readings
+        cur.execute(f'''
+            SELECT date_part('epoch', reading_date), reading_value::float8
+            FROM meter_readings
+            WHERE {where}
+            ORDER BY reading_date
+        ''', params)
+        rows = cur.fetchall()
+        source = len(rows)
+        series = np.fromiter(itertools.chain.from_iterable(rows), np.float64, count=2 * source).reshape(-1, 2)
+        t, v = series[:, 0], series[:, 1]
+    elif method == 'avg':
+        buckets = _fetch_buckets(cur, meter_id, start_date, end_date, max_points)
+        if archived is None or not len(archived[0]):
+            return ([row[1] for row in buckets], [row[2] for row in buckets], sum(row[0] for row in buckets))
+        # Bucket means are re-averaged with the archived points, weighted by their counts
+        source = sum(row[0] for row in buckets)
+        series = np.array([row[:3] for row in buckets], dtype=np.float64).reshape(-1, 3)
+        counts, t, v = series[:, 0], series[:, 1], series[:, 2]
+    else:
+        # Too many rows to ship: keep each fine bucket's extremes and reduce those
+        buckets = _fetch_buckets(cur, meter_id, start_date, end_date, max_points * PRE_BUCKETS_PER_POINT)
+        source = sum(row[0] for row in buckets)
+        points = sorted({(low[1], low[0]) for _, _, _, low, _ in buckets} |
+                        {(high[1], high[0]) for _, _, _, _, high in buckets})
+        series = np.array(points, dtype=np.float64).reshape(-1, 2)
+        t, v = series[:, 0], series[:, 1]
+
+    if archived is not None and len(archived[0]):
+        size = len(t)
+        t, v, counts = _with_archived(t, v, counts, archived)
+        source += len(t) - size
+
+    if method == 'avg':
+        t, v = average(t, v, max_points, counts)
+    else:
+        index = lttb(t, v, max_points) if method == 'lttb' else minmax(t, v, max_points)
+        t, v = t[index], v[index]
+    return t.tolist(), v.tolist(), source
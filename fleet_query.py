@@ -0,0 +1,155 @@
+"""Newest readings for many meters at once: one meters scan with a LATERAL top-N per meter."""
+import os
+
+from pagination import encode_cursor, decode_cursor
+from reading_formats import COLUMNAR_SELECT, columnar, epoch_to_datetime
+from reading_stream import reading_dict
+from recent_readings import READING_COLUMNS
+
+FLEET_QUERY_MAX_METERS = int(os.environ.get('FLEET_QUERY_MAX_METERS', 500))
+FLEET_QUERY_MAX_ROWS = int(os.environ.get('FLEET_QUERY_MAX_ROWS', 100000))
+FLEET_QUERY_FORMATS = ('json', 'columnar')
+
+_METER_COLUMNS = ('meter_id', 'customer_id', 'meter_type', 'manufacturer', 'model')
+
+
+class FleetQueryError(ValueError):
+    pass
+
+
+def parse_fleet_query(body):
+    """Validate a POST /api/v1/readings/query body into keyword arguments for query_fleet."""
+    if not isinstance(body, dict):
+        raise FleetQueryError('Body must be a JSON object')
+    meter_ids = body.get('meter_ids')
+    if meter_ids is not None:
+        if not isinstance(meter_ids, list) or not all(isinstance(m, str) for m in meter_ids):
+            raise FleetQueryError('meter_ids must be a list of strings')
+        if len(meter_ids) > FLEET_QUERY_MAX_METERS:
+            raise FleetQueryError(f'At most {FLEET_QUERY_MAX_METERS} meter_ids per query')
+    filters = {name: body[name] for name in ('customer_id', 'meter_type') if body.get(name) is not None}
+    if not meter_ids and not filters:
+        raise FleetQueryError('Provide meter_ids, customer_id or meter_type')
+    if not all(isinstance(value, str) for value in filters.values()):
+        raise FleetQueryError('customer_id and meter_type must be strings')
+    try:
+        limit = int(body.get('limit', 100))
+    except (TypeError, ValueError):
+        raise FleetQueryError('limit must be an integer')
+    if not 1 <= limit <= 1000:
+        raise FleetQueryError('limit must be between 1 and 1000')
+    fmt = body.get('format', 'json')
+    if fmt not in FLEET_QUERY_FORMATS:
+        raise FleetQueryError(f'Unsupported format - use one of {", ".join(FLEET_QUERY_FORMATS)}')
+    after_meter = None
+    if body.get('meter_cursor'):
+        after_meter = decode_cursor('fleet-meters', body['meter_cursor'], (str,))[0]
+    return {
+        'meter_ids': sorted(set(meter_ids)) if meter_ids else None,
+        'customer_id': filters.get('customer_id'),
+        'meter_type': filters.get('meter_type'),
+        'start_date': body.get('start_date'),
+        'end_date': body.get('end_date'),
+        'limit': limit,
+        'fmt': fmt,
+        'after_meter': after_meter
+    }
+
+
+def query_fleet(cur, meter_ids=None, customer_id=None, meter_type=None, start_date=None, end_date=None,
+                limit=100, fmt='json', after_meter=None):
+    """Newest `limit` readings of every matching meter, grouped by meter in meter_id order.
+
+    Meters are paged so no response exceeds FLEET_QUERY_MAX_ROWS readings;
+    meter_cursor continues with the next page of meters. Each group's
+    next_cursor pages further back through that meter's readings with
+    GET /api/v1/readings/<meter_id>?cursor=.
+    """
+    meters_per_page = max(1, min(FLEET_QUERY_MAX_METERS, FLEET_QUERY_MAX_ROWS // limit))
+
+    meter_where, meter_params = [], []
+    if meter_ids is not None:
+        meter_where.append('meter_id = ANY(%s)')
+        meter_params.append(meter_ids)
+    if customer_id is not None:
+        meter_where.append('customer_id = %s')
+        meter_params.append(customer_id)
+    if meter_type is not None:
+        meter_where.append('meter_type = %s')
+        meter_params.append(meter_type)
+    if after_meter is not None:
+        meter_where.append('meter_id > %s')
+        meter_params.append(after_meter)
+
+    reading_where, reading_params = [], []
+    if start_date:
+        reading_where.append('reading_date >= %s')
+        reading_params.append(start_date)
+    if end_date:
+        reading_where.append('reading_date <= %s')
+        reading_params.append(end_date)
+
+    if fmt == 'columnar':
+        select, date_index = COLUMNAR_SELECT, 1
+    else:
+        select, date_index = f'SELECT {", ".join(READING_COLUMNS)}', 4
+    offset = len(_METER_COLUMNS) + 1
+
+    # One extra meter tells whether there is another page of meters, one extra
+    # reading per meter whether that meter has older readings
+    cur.execute(f'''
+        SELECT {', '.join('m.' + column for column in _METER_COLUMNS)}, r.*
+        FROM (
+            SELECT {', '.join(_METER_COLUMNS)}
+            FROM meters
+            WHERE {' AND '.join(meter_where)}
+            ORDER BY meter_id
+            LIMIT %s
+        ) m
+        LEFT JOIN LATERAL (
+            {select}
+            FROM meter_readings
+            WHERE meter_id = m.meter_id{''.join(' AND ' + clause for clause in reading_where)}
+            ORDER BY reading_date DESC, reading_id DESC
+            LIMIT %s
+        ) r ON TRUE
+        ORDER BY 1, {offset + date_index} DESC, {offset} DESC
+    ''', meter_params + [meters_per_page + 1] + reading_params + [limit + 1])
+
+    groups = []
+    for row in cur:
+        meter, reading = row[:len(_METER_COLUMNS)], row[len(_METER_COLUMNS):]
+        if not groups or groups[-1][0][0] != meter[0]:
+            groups.append((meter, []))
+        if reading[0] is not None:
+            groups[-1][1].append(reading)
+
+    next_meter_cursor = None
+    if len(groups) > meters_per_page:
+        groups = groups[:meters_per_page]
+        next_meter_cursor = encode_cursor('fleet-meters', [groups[-1][0][0]])
+
+    result = []
+    for meter, readings in groups:
+        next_cursor = None
+        if len(readings) > limit:
+            readings = readings[:limit]
+            last = readings[-1]
+            last_date = epoch_to_datetime(last[1]) if fmt == 'columnar' else last[4]
+            next_cursor = encode_cursor(f'readings:{meter[0]}', [last_date, last[0]])
+        result.append({
+            'meter_info': dict(zip(_METER_COLUMNS, meter)),
+            'readings': columnar(readings) if fmt == 'columnar' else [reading_dict(r) for r in readings],
+            'reading_count': len(readings),
+            'next_cursor': next_cursor
+        })
+
+    missing = []
+    if meter_ids is not None:
+        found = {meter[0] for meter, _ in groups}
+        last_seen = groups[-1][0][0] if next_meter_cursor else None
+        missing = [m for m in meter_ids
+                   if m not in found and (after_meter is None or m > after_meter)
+                   and (last_seen is None or m < last_seen)]
+    return result, next_meter_cursor, missing
+
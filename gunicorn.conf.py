@@ -0,0 +1,74 @@
+"""Gunicorn settings for production: prefork workers with threads, tuned for ECS Fargate task stops."""
+import glob
+import os
+import signal
+import tempfile
+
+
+def _cpu_count():
+    # Fargate reports the host's CPUs through os.cpu_count(); the affinity mask is the task's share
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+bind = f'0.0.0.0:{os.environ.get("PORT", 8000)}'
+
+# psycopg2 blocks the calling thread, so concurrency comes from threads in each worker.
+# Every worker has its own pool of up to DB_POOL_MAX_SIZE connections.
+workers = int(os.environ.get('WEB_CONCURRENCY', _cpu_count() * 2))
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+
+# Import the app once in the master so workers share its pages; the app opens no
+# connections at import time, and db_pool drops any inherited pool after fork.
+preload_app = True
+
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 60))
+# Longer than the ALB idle timeout (60s) so the ALB, not gunicorn, closes idle connections
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', 75))
+# ECS sends SIGTERM, then SIGKILL after the container stopTimeout (30s by default).
+# In-flight requests and the ingestion queue drain (INGEST_DRAIN_TIMEOUT) must fit inside this.
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 25))
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 0))
+max_requests_jitter = int(os.environ.get('GUNICORN_MAX_REQUESTS_JITTER', 0))
+
+accesslog = os.environ.get('GUNICORN_ACCESS_LOG') or None
+errorlog = '-'
+
+
+def on_starting(server):
+    # Workers publish metrics snapshots here so any worker can answer a /metrics scrape
+    metrics_dir = os.environ.setdefault('METRICS_DIR', tempfile.mkdtemp(prefix='smart-meter-metrics-'))
+    for path in glob.glob(os.path.join(metrics_dir, '*.pkl')):
+        os.remove(path)
+
+    # Schema setup runs once per task in the master, not once per worker
+    from app import init_database
+    from db_pool import close_pool
+
+    init_database()
+    close_pool()
+
+
+def post_worker_init(worker):
+    from app import start_background_services
+    from reading_stream import get_reading_stream
+
+    start_background_services()
+
+    # Live streams would hold the worker for the whole graceful timeout; end them as soon as SIGTERM arrives
+    handle_exit = signal.getsignal(signal.SIGTERM)
+
+    def close_streams_and_exit(signum, frame):
+        get_reading_stream().close()
+        handle_exit(signum, frame)
+
+    signal.signal(signal.SIGTERM, close_streams_and_exit)
+
+
+def worker_exit(server, worker):
+    from app import stop_background_services
+
+    stop_background_services()
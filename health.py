@@ -0,0 +1,97 @@
+"""Background database readiness probe so health checks never block on the database."""
+import os
+import threading
+import time
+from datetime import datetime, timezone
+
+import psycopg2
+
+from db_pool import db_connection, DatabaseUnavailable
+
+
+class ReadinessProbe:
+    def __init__(self, interval=5.0, timeout=2.0):
+        self.interval = interval
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+        self._result = {
+            'database': 'unknown',
+            'ready': False,
+            'latency_ms': None,
+            'checked_at': None,
+            'error': 'Readiness probe has not run yet',
+            'consecutive_failures': 0
+        }
+        self._checked = None    # monotonic time of the last completed probe
+
+    def start(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='readiness-probe', daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def status(self):
+        self.start()
+        with self._lock:
+            result = dict(self._result)
+            checked = self._checked
+        # A wedged probe thread must not keep reporting the last good result
+        age = None if checked is None else time.monotonic() - checked
+        result['age_seconds'] = None if age is None else round(age, 3)
+        if age is None or age > self.interval * 3 + self.timeout:
+            result['ready'] = False
+        return result
+
+    def check(self):
+        start = time.monotonic()
+        error = None
+        try:
+            with db_connection(timeout=self.timeout) as conn:
+                cur = conn.cursor()
+                cur.execute('SET LOCAL statement_timeout = %s', (int(self.timeout * 1000),))
+                cur.execute('SELECT 1')
+                cur.fetchone()
+                conn.rollback()
+        except (DatabaseUnavailable, psycopg2.Error) as e:
+            error = str(e).strip()
+        latency_ms = round((time.monotonic() - start) * 1000, 3)
+
+        with self._lock:
+            failures = 0 if error is None else self._result['consecutive_failures'] + 1
+            self._result = {
+                'database': 'connected' if error is None else 'disconnected',
+                'ready': error is None,
+                'latency_ms': latency_ms,
+                'checked_at': datetime.now(timezone.utc).isoformat(),
+                'error': error,
+                'consecutive_failures': failures
+            }
+            self._checked = time.monotonic()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.check()
+            self._stop.wait(self.interval)
+
+
+_probe = None
+_probe_lock = threading.Lock()
+
+
+def get_readiness_probe():
+    global _probe
+    if _probe is None:
+        with _probe_lock:
+            if _probe is None:
+                _probe = ReadinessProbe(
+                    interval=float(os.environ.get('HEALTH_PROBE_INTERVAL', 5)),
+                    timeout=float(os.environ.get('HEALTH_PROBE_TIMEOUT', 2))
+                )
+    return _probe
@@ -0,0 +1,375 @@
+"""Reading validation and set-based bulk loading shared by the ingestion endpoints."""
+import io
+import json
+import os
+from datetime import datetime, timezone
+
+from db_pool import execute_prepared
+from meter_cache import get_registry
+from quality import score, load_context, QUALITY_CHECKS, QUALITY_CODES, CONTEXT_EXCLUDED_CODES, BASELINE_WINDOW
+from reading_stream import get_reading_stream
+from recent_readings import get_recent_readings, notify_rewritten, READING_COLUMNS
+
+REQUIRED_FIELDS = ['meter_id', 'customer_id', 'reading_value']
+BATCH_MAX_ROWS = int(os.environ.get('BATCH_MAX_ROWS', 50000))
+
+# Column limits from the meter_readings DDL in app.init_database
+MAX_READING_VALUE = 999999999.999
+MAX_SENSOR_VALUE = 999.99
+TEXT_LIMITS = {'reading_type': 20, 'quality_code': 10}
+
+
+class ReadingError(ValueError):
+    def __init__(self, message, details=None):
+        super().__init__(message)
+        self.message = message
+        self.details = details or {}
+
+
+def _optional_number(data, field, limit, cast=float):
+    value = data.get(field)
+    if value is None:
+        return None
+    try:
+        value = cast(value)
+    except (TypeError, ValueError):
+        raise ReadingError(f'Invalid {field} - must be a number')
+    if abs(value) > limit:
+        raise ReadingError(f'{field} out of range')
+    return value
+
+
+def validate_reading(data):
+    if not isinstance(data, dict):
+        raise ReadingError('Reading must be a JSON object')
+
+    missing_fields = [field for field in REQUIRED_FIELDS if field not in data]
+    if missing_fields:
+        raise ReadingError('Missing required fields', {
+            'missing': missing_fields,
+            'required': REQUIRED_FIELDS
+        })
+
+    try:
+        reading_value = float(data['reading_value'])
+    except (TypeError, ValueError):
+        raise ReadingError('Invalid reading value - must be a number')
+    if reading_value < 0:
+        raise ReadingError('Reading value cannot be negative')
+    if reading_value > MAX_READING_VALUE:
+        raise ReadingError('Reading value out of range')
+
+    if data.get('reading_date') is not None:
+        try:
+            reading_date = datetime.fromisoformat(str(data['reading_date']).replace('Z', '+00:00'))
+        except ValueError:
+            raise ReadingError('Invalid date format. Use ISO 8601 (e.g., 2025-06-03T05:00:00Z)')
+    else:
+        reading_date = datetime.now(timezone.utc)
+    # reading_date is stored as naive UTC; normalising here makes the in-batch
+    # duplicate checks use the same key as the unique constraint
+    if reading_date.tzinfo is not None:
+        reading_date = reading_date.astimezone(timezone.utc).replace(tzinfo=None)
+
+    reading = {
+        'meter_id': str(data['meter_id']),
+        'customer_id': str(data['customer_id']),
+        'reading_value': reading_value,
+        'reading_date': reading_date,
+        'reading_type': data.get('reading_type', 'automatic'),
+        'quality_code': data.get('quality_code', 'good'),
+        'temperature': _optional_number(data, 'temperature', MAX_SENSOR_VALUE),
+        'voltage': _optional_number(data, 'voltage', MAX_SENSOR_VALUE),
+        'signal_strength': _optional_number(data, 'signal_strength', 2 ** 31 - 1, int)
+    }
+    for field, limit in TEXT_LIMITS.items():
+        if not isinstance(reading[field], str) or len(reading[field]) > limit:
+            raise ReadingError(f'{field} must be a string of at most {limit} characters')
+    return reading
+
+
+def _epoch(value):
+    # Naive timestamps are UTC, matching how stored reading_date values are read back
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.timestamp()
+
+
+def apply_quality_checks(conn, readings):
+    """Score validated readings against each meter's recent history and flag suspect ones.
+
+    Only readings still marked 'good' have their quality_code replaced.
+    """
+    if not QUALITY_CHECKS or not readings:
+        return
+    times = [_epoch(r['reading_date']) for r in readings]
+    earliest = {}
+    for reading, when in zip(readings, times):
+        meter_id = reading['meter_id']
+        if meter_id not in earliest or when < earliest[meter_id]:
+            earliest[meter_id] = when
+    meters = get_registry().get_many(conn, sorted(earliest))
+
+    ctx_ids, ctx_times, ctx_values, ctx_flat = load_context(conn.cursor(), earliest)
+    ids = ctx_ids + [r['meter_id'] for r in readings]
+    codes = score(
+        ids,
+        ctx_times + times,
+        ctx_values + [r['reading_value'] for r in readings],
+        [meters[m].meter_type if m in meters else None for m in ids],
+        known_flat=ctx_flat + [False] * len(readings)
+    )
+    for reading, code in zip(readings, codes[len(ctx_ids):].tolist()):
+        if code and reading['quality_code'] == 'good':
+            reading['quality_code'] = QUALITY_CODES[code]
+
+
+def parse_batch_body(body, content_type):
+    """Return a list of row payloads from a JSON array or NDJSON request body."""
+    text = body.decode('utf-8') if isinstance(body, bytes) else body
+    stripped = text.lstrip()
+    if 'ndjson' not in (content_type or '') and stripped.startswith('['):
+        rows = json.loads(stripped)
+        if not isinstance(rows, list):
+            raise ReadingError('Batch body must be a JSON array or NDJSON')
+        return rows
+    rows = []
+    for line_no, line in enumerate(text.splitlines(), 1):
+        if not line.strip():
+            continue
+        try:
+            rows.append(json.loads(line))
+        except ValueError as e:
+            raise ReadingError(f'Invalid NDJSON on line {line_no}: {e}')
+    return rows
+
+
+def _copy_text(value):
+    if value is None:
+        return '\\N'
+    if isinstance(value, datetime):
+        return value.isoformat()
+    value = str(value)
+    return (value.replace('\\', '\\\\').replace('\t', '\\t')
+                 .replace('\n', '\\n').replace('\r', '\\r'))
+
+
+COPY_COLUMNS = ('row_no', 'meter_id', 'customer_id', 'reading_value', 'reading_date', 'reading_type',
+                'quality_code', 'temperature', 'voltage', 'signal_strength')
+
+
+def copy_rows(cur, table, rows):
+    buf = io.StringIO()
+    for row in rows:
+        buf.write('\t'.join(_copy_text(row[col]) for col in COPY_COLUMNS))
+        buf.write('\n')
+    buf.seek(0)
+    cur.copy_expert(f'COPY {table} ({", ".join(COPY_COLUMNS)}) FROM STDIN', buf)
+
+
+def load_readings(cur, readings):
+    """COPY already-validated readings into meter_readings in the current transaction.
+
+    Every reading needs a 'row_no' unique within the call. Existing
+    (meter_id, reading_date) pairs are skipped and last_reading_date is
+    advanced once per meter. Returns {row_no: row} for inserted rows, each
+    row holding the stored READING_COLUMNS values. A batch can be loaded in
+    parts within one transaction: rows left by an earlier call are cleared.
+    """
+    cur.execute('''
+        CREATE TEMP TABLE IF NOT EXISTS reading_batch (
+            row_no INTEGER,
+            meter_id VARCHAR(50),
+            customer_id VARCHAR(50),
+            reading_value DECIMAL(12,3),
+            reading_date TIMESTAMP,
+            reading_type VARCHAR(20),
+            quality_code VARCHAR(10),
+            temperature DECIMAL(5,2),
+            voltage DECIMAL(5,2),
+            signal_strength INTEGER
+        ) ON COMMIT DELETE ROWS;
+        DELETE FROM reading_batch;
+    ''')
+    copy_rows(cur, 'reading_batch', readings)
+
+    # Insert, skip existing (meter_id, reading_date) pairs and advance
+    # last_reading_date once per meter, all in a single statement.
+    cur.execute(f'''
+        WITH ins AS (
+            INSERT INTO meter_readings
+            (meter_id, customer_id, reading_value, reading_date, reading_type,
+             quality_code, temperature, voltage, signal_strength)
+            SELECT meter_id, customer_id, reading_value, reading_date, reading_type,
+                   quality_code, temperature, voltage, signal_strength
+            FROM reading_batch
+            ORDER BY meter_id, reading_date
+            ON CONFLICT (meter_id, reading_date) DO NOTHING
+            RETURNING {', '.join(READING_COLUMNS)}
+        ), upd AS (
+            UPDATE meters m
+            SET last_reading_date = GREATEST(m.last_reading_date, latest.reading_date)
+            FROM (SELECT meter_id, MAX(reading_date) AS reading_date FROM ins GROUP BY meter_id) latest
+            WHERE m.meter_id = latest.meter_id
+        )
+        SELECT b.row_no, {', '.join('ins.' + column for column in READING_COLUMNS)}
+        FROM ins
+        JOIN reading_batch b ON b.meter_id = ins.meter_id AND b.reading_date = ins.reading_date;
+    ''')
+    return {row[0]: row[1:] for row in cur.fetchall()}
+
+
+# Ownership check, insert and last_reading_date update for one reading in a
+# single statement. The LEFT JOINs always yield one row, and its outcome tells
+# apart a missing or inactive meter, a customer mismatch and a duplicate. The
+# same row carries the meter's accepted readings before this one, as
+# load_context would fetch them, for scoring; $10 is 0 when checks are off.
+INSERT_READING = f'''
+    WITH meter AS (
+        SELECT meter_id, customer_id, meter_type, status FROM meters WHERE meter_id = $1
+    ), ins AS (
+        INSERT INTO meter_readings
+        (meter_id, customer_id, reading_value, reading_date, reading_type,
+         quality_code, temperature, voltage, signal_strength)
+        SELECT $1, $2, $3, $4, $5, $6, $7, $8, $9
+        FROM meter
+        WHERE status = 'active' AND customer_id = $2
+        ON CONFLICT (meter_id, reading_date) DO NOTHING
+        RETURNING {', '.join(READING_COLUMNS)}
+    ), upd AS (
+        UPDATE meters m
+        SET last_reading_date = GREATEST(m.last_reading_date, ins.reading_date)
+        FROM ins
+        WHERE m.meter_id = ins.meter_id
+    ), history AS (
+        SELECT array_agg(EXTRACT(EPOCH FROM reading_date)::float8) AS times,
+               array_agg(reading_value::float8) AS reading_values,
+               array_agg(quality_code = 'flatline') AS flat
+        FROM (
+            SELECT reading_date, reading_value, quality_code
+            FROM meter_readings
+            WHERE meter_id = $1 AND reading_date < $4 AND quality_code <> ALL ($11)
+            ORDER BY reading_date DESC
+            LIMIT $10
+        ) h
+    )
+    SELECT CASE
+               WHEN meter.meter_id IS NULL OR meter.status <> 'active' THEN 'not_found'
+               WHEN meter.customer_id IS DISTINCT FROM $2 THEN 'customer_mismatch'
+               WHEN ins.reading_id IS NULL THEN 'duplicate'
+               ELSE 'inserted'
+           END,
+           meter.meter_type, history.times, history.reading_values, history.flat,
+           {', '.join('ins.' + column for column in READING_COLUMNS)}
+    FROM (SELECT 1) AS one
+    CROSS JOIN history
+    LEFT JOIN meter ON TRUE
+    LEFT JOIN ins ON TRUE
+'''
+INSERT_READING_TYPES = ('varchar', 'varchar', 'numeric', 'timestamp', 'varchar', 'varchar',
+                        'numeric', 'numeric', 'integer', 'integer', 'varchar[]')
+
+
+def insert_reading(cur, reading):
+    """Insert one validated reading with the prepared INSERT_READING statement.
+
+    Returns (outcome, meter_type, row): outcome is 'inserted', 'duplicate',
+    'not_found' or 'customer_mismatch', and row is the stored reading in
+    READING_COLUMNS order when inserted. On an autocommit connection this is
+    the only round trip the insert needs.
+
+    Quality checks run after the insert, against the history the statement
+    returned. A 'good' reading that trips one is rewritten in a second
+    statement, so only flagged readings cost another round trip; until it
+    commits, other sessions see the reading as 'good'.
+    """
+    execute_prepared(cur, 'insert_reading', INSERT_READING_TYPES, INSERT_READING, (
+        reading['meter_id'],
+        reading['customer_id'],
+        reading['reading_value'],
+        reading['reading_date'],
+        reading['reading_type'],
+        reading['quality_code'],
+        reading['temperature'],
+        reading['voltage'],
+        reading['signal_strength'],
+        BASELINE_WINDOW + 1 if QUALITY_CHECKS else 0,
+        list(CONTEXT_EXCLUDED_CODES)
+    ))
+    outcome, meter_type, times, values, flat, *row = cur.fetchone()
+    if outcome != 'inserted':
+        return outcome, meter_type, None
+    if QUALITY_CHECKS and reading['quality_code'] == 'good':
+        times, values, flat = times or [], values or [], flat or []
+        code = score(
+            [reading['meter_id']] * (len(times) + 1),
+            times + [_epoch(reading['reading_date'])],
+            values + [reading['reading_value']],
+            [meter_type] * (len(times) + 1),
+            known_flat=flat + [False]
+        )[-1]
+        if code:
+            row[6] = QUALITY_CODES[code]
+            cur.execute('UPDATE meter_readings SET quality_code = %s WHERE meter_id = %s AND reading_date = %s',
+                        (row[6], row[1], row[4]))
+            notify_rewritten(cur, [row[1]])
+    return outcome, meter_type, tuple(row)
+
+
+def insert_batch(conn, payloads):
+    """Validate and load a batch of readings in one transaction.
+
+    Returns one result dict per input row, in input order, with status
+    'accepted', 'duplicate' or 'rejected'.
+    """
+    results = [None] * len(payloads)
+    valid = []
+    seen = set()
+    for row_no, payload in enumerate(payloads):
+        try:
+            reading = validate_reading(payload)
+        except ReadingError as e:
+            results[row_no] = {'row': row_no, 'status': 'rejected', 'error': e.message}
+            continue
+        key = (reading['meter_id'], reading['reading_date'])
+        if key in seen:
+            results[row_no] = {'row': row_no, 'status': 'duplicate', 'meter_id': reading['meter_id']}
+            continue
+        seen.add(key)
+        reading['row_no'] = row_no
+        valid.append(reading)
+
+    if valid:
+        # One set-based ownership check for every meter the registry doesn't already hold
+        meters = get_registry().get_many(conn, sorted({r['meter_id'] for r in valid}))
+
+        loadable = []
+        for reading in valid:
+            meter = meters.get(reading['meter_id'])
+            if meter is None or meter.status != 'active':
+                error = f'Meter {reading["meter_id"]} not found or inactive'
+            elif meter.customer_id != reading['customer_id']:
+                error = f'Customer {reading["customer_id"]} does not match meter {reading["meter_id"]}'
+            else:
+                loadable.append(reading)
+                continue
+            results[reading['row_no']] = {'row': reading['row_no'], 'status': 'rejected', 'error': error}
+        valid = loadable
+
+    if valid:
+        apply_quality_checks(conn, valid)
+        inserted = load_readings(conn.cursor(), valid)
+
+        for reading in valid:
+            row_no = reading['row_no']
+            if row_no in inserted:
+                results[row_no] = {'row': row_no, 'status': 'accepted', 'reading_id': inserted[row_no][0],
+                                   'meter_id': reading['meter_id'], 'quality_code': inserted[row_no][6]}
+            else:
+                results[row_no] = {'row': row_no, 'status': 'duplicate', 'meter_id': reading['meter_id']}
+
+    conn.commit()
+    if valid:
+        get_recent_readings().push(list(inserted.values()))
+        get_reading_stream().publish(list(inserted.values()))
+    return results
@@ -0,0 +1,235 @@
+"""Write-behind ingestion: readings are queued in memory and flushed in micro-batches."""
+import atexit
+import os
+import queue
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+
+import psycopg2
+
+from db_pool import db_connection, DatabaseUnavailable
+from metrics import inc
+from ingest import load_readings, apply_quality_checks
+from reading_stream import get_reading_stream
+from recent_readings import get_recent_readings
+
+
+class QueueFull(Exception):
+    pass
+
+
+class IngestQueue:
+    def __init__(self, max_size=10000, flush_interval=0.2, flush_rows=1000, retry_delay=1.0, drain_timeout=20.0):
+        self.max_size = max_size
+        self.flush_interval = flush_interval
+        self.flush_rows = flush_rows
+        self.retry_delay = retry_delay
+        self.drain_timeout = drain_timeout
+
+        self._queue = queue.Queue(maxsize=max_size)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stopping = threading.Event()
+        self._drain_deadline = None
+
+        self.enqueued = 0
+        self.rejected_full = 0
+        self.batches = 0
+        self.accepted = 0
+        self.duplicates = 0
+        self.failed = 0
+        self.retries = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self._flush_ms_total = 0.0
+        self.last_batch_rows = 0
+        self.last_queue_lag_ms = 0.0
+
+    def put(self, reading):
+        """Queue a validated reading and return its receipt, or raise QueueFull."""
+        if self._stopping.is_set():
+            raise QueueFull('Ingestion queue is shutting down')
+        self.start()
+        receipt = {
+            'receipt_id': uuid.uuid4().hex,
+            'queued_at': datetime.now(timezone.utc).isoformat()
+        }
+        try:
+            self._queue.put_nowait((reading, time.monotonic()))
+        except queue.Full:
+            with self._lock:
+                self.rejected_full += 1
+            raise QueueFull(f'Ingestion queue is full ({self.max_size} readings pending)')
+        with self._lock:
+            self.enqueued += 1
+        return receipt
+
+    def start(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='ingest-flusher', daemon=True)
+                self._thread.start()
+                atexit.register(self.stop)
+
+    def stop(self):
+        """Stop accepting readings and flush everything already queued."""
+        if self._stopping.is_set():
+            return
+        self._drain_deadline = time.monotonic() + self.drain_timeout
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.drain_timeout + 1)
+        pending = self._queue.qsize()
+        if pending:
+            print(f'Ingestion queue stopped with {pending} readings not flushed')
+
+    def stats(self):
+        with self._lock:
+            return {
+                'depth': self._queue.qsize(),
+                'capacity': self.max_size,
+                'enqueued': self.enqueued,
+                'rejected_full': self.rejected_full,
+                'batches': self.batches,
+                'accepted': self.accepted,
+                'duplicates': self.duplicates,
+                'failed': self.failed,
+                'retries': self.retries,
+                'last_batch_rows': self.last_batch_rows,
+                'last_flush_ms': round(self.last_flush_ms, 3),
+                'avg_flush_ms': round(self._flush_ms_total / self.batches, 3) if self.batches else 0.0,
+                'max_flush_ms': round(self.max_flush_ms, 3),
+                'last_queue_lag_ms': round(self.last_queue_lag_ms, 3)
+            }
+
+    def _run(self):
+        while True:
+            try:
+                first = self._queue.get(timeout=0.5)
+            except queue.Empty:
+                if self._stopping.is_set():
+                    return
+                continue
+
+            batch = [first]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.flush_rows:
+                try:
+                    if self._stopping.is_set():
+                        batch.append(self._queue.get_nowait())
+                    else:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._flush(batch)
+
+    def _flush(self, batch):
+        # Duplicates inside one micro-batch would map to the same inserted row
+        readings = []
+        seen = set()
+        for reading, _ in batch:
+            key = (reading['meter_id'], reading['reading_date'])
+            if key not in seen:
+                seen.add(key)
+                readings.append(dict(reading, row_no=len(readings)))
+        in_batch_duplicates = len(batch) - len(readings)
+
+        while True:
+            start = time.monotonic()
+            try:
+                with db_connection() as conn:
+                    apply_quality_checks(conn, readings)
+                    inserted, failures = self._load(conn.cursor(), readings)
+                    conn.commit()
+                    get_recent_readings().push(list(inserted.values()))
+                    get_reading_stream().publish(list(inserted.values()))
+            except (DatabaseUnavailable, psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+                if self._drain_deadline is not None and time.monotonic() > self._drain_deadline:
+                    self._record_failure(len(batch), e)
+                    return
+                with self._lock:
+                    self.retries += 1
+                print(f'Ingestion flush failed, retrying in {self.retry_delay}s: {e}')
+                time.sleep(self.retry_delay)
+                continue
+            except psycopg2.Error as e:
+                self._record_failure(len(batch), e)
+                return
+
+            for reading, error in failures:
+                self._record_failure(1, f'{reading["meter_id"]} at {reading["reading_date"].isoformat()}: {error}')
+            inc('ingest_readings_total', ('queue', 'accepted'), len(inserted))
+            inc('ingest_readings_total', ('queue', 'duplicate'), len(batch) - len(inserted) - len(failures))
+            now = time.monotonic()
+            elapsed_ms = (now - start) * 1000
+            with self._lock:
+                self.last_queue_lag_ms = (now - batch[0][1]) * 1000
+                self.batches += 1
+                self.accepted += len(inserted)
+                self.duplicates += len(readings) - len(inserted) - len(failures) + in_batch_duplicates
+                self.last_batch_rows = len(batch)
+                self.last_flush_ms = elapsed_ms
+                self.max_flush_ms = max(self.max_flush_ms, elapsed_ms)
+                self._flush_ms_total += elapsed_ms
+            return
+
+    def _load(self, cur, readings):
+        """Load readings, bisecting around rows the database rejects.
+
+        A constraint violation or bad value in one reading fails the whole
+        COPY, so on a non-transient error each half is retried under a
+        savepoint until the offending readings are isolated. Returns
+        (inserted, [(reading, error)]); connection errors propagate so the
+        caller retries the batch.
+        """
+        cur.execute('SAVEPOINT flush_part')
+        try:
+            inserted = load_readings(cur, readings)
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            raise
+        except psycopg2.Error as e:
+            cur.execute('ROLLBACK TO SAVEPOINT flush_part')
+            if len(readings) == 1:
+                return {}, [(readings[0], str(e).strip())]
+            mid = len(readings) // 2
+            inserted, failures = self._load(cur, readings[:mid])
+            more, more_failures = self._load(cur, readings[mid:])
+            inserted.update(more)
+            return inserted, failures + more_failures
+        cur.execute('RELEASE SAVEPOINT flush_part')
+        return inserted, []
+
+    def _record_failure(self, count, error):
+        print(f'Ingestion flush dropped {count} readings: {error}')
+        inc('ingest_readings_total', ('queue', 'failed'), count)
+        with self._lock:
+            self.failed += count
+
+
+_ingest_queue = None
+_ingest_queue_lock = threading.Lock()
+
+
+def async_ingest_enabled():
+    return os.environ.get('INGEST_ASYNC', 'false').lower() in ('1', 'true', 'yes')
+
+
+def get_ingest_queue():
+    global _ingest_queue
+    if _ingest_queue is None:
+        with _ingest_queue_lock:
+            if _ingest_queue is None:
+                _ingest_queue = IngestQueue(
+                    max_size=int(os.environ.get('INGEST_QUEUE_SIZE', 10000)),
+                    flush_interval=int(os.environ.get('INGEST_FLUSH_INTERVAL_MS', 200)) / 1000,
+                    flush_rows=int(os.environ.get('INGEST_FLUSH_ROWS', 1000)),
+                    drain_timeout=float(os.environ.get('INGEST_DRAIN_TIMEOUT', 20))
+                )
+    return _ingest_queue
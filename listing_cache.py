@@ -0,0 +1,96 @@
+"""Serialized-response cache for the customer and meter listings, invalidated by NOTIFY."""
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from db_events import get_listener
+
+# Any of these changes can alter a cached listing (meters embeds customer_name)
+CHANNELS = ('customers_changed', 'meters_changed')
+
+
+class ListingCache:
+    def __init__(self, ttl=30.0, max_entries=256):
+        # Attribute changes invalidate immediately through NOTIFY; the TTL only
+        # bounds how stale meters.last_reading_date can be in a cached listing
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()   # key -> (etag, body, expires_at)
+        self._generation = 0
+        self._invalidated_at = None
+        self._subscribed = False
+
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, key, build):
+        """Return (etag, body) for key, calling build() -> bytes on a miss."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[2] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0], entry[1]
+            self.misses += 1
+            generation = self._generation
+
+        body = build()
+        etag = hashlib.blake2b(body, digest_size=16).hexdigest()
+        with self._lock:
+            if generation == self._generation and self._subscribed and get_listener().listening:
+                self._entries[key] = (etag, body, time.monotonic() + self.ttl)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return etag, body
+
+    def invalidate(self, payload=None):
+        with self._lock:
+            self.invalidations += 1
+            self._generation += 1
+            self._invalidated_at = time.monotonic()
+            self._entries.clear()
+
+    def invalidated_within(self, seconds):
+        """True if a change was notified in the last `seconds`, e.g. so a rebuild skips lagging replicas."""
+        invalidated_at = self._invalidated_at
+        return invalidated_at is not None and time.monotonic() - invalidated_at < seconds
+
+    def subscribe(self, listener=None):
+        if self._subscribed:
+            return
+        self._subscribed = True
+        listener = listener or get_listener()
+        for channel in CHANNELS:
+            listener.subscribe(channel, self.invalidate, on_reset=self.invalidate)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'invalidations': self.invalidations
+            }
+
+
+_listing_cache = None
+_listing_cache_lock = threading.Lock()
+
+
+def get_listing_cache():
+    global _listing_cache
+    if _listing_cache is None:
+        with _listing_cache_lock:
+            if _listing_cache is None:
+                _listing_cache = ListingCache(
+                    ttl=float(os.environ.get('LISTING_CACHE_TTL', 30)),
+                    max_entries=int(os.environ.get('LISTING_CACHE_MAX_ENTRIES', 256))
+                )
+                _listing_cache.subscribe()
+    return _listing_cache
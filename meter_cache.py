@@ -0,0 +1,147 @@
+"""In-process meter registry used to validate readings without a meters lookup per request."""
+import os
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from db_events import get_listener
+from db_pool import db_connection
+
+MeterInfo = namedtuple('MeterInfo', 'meter_id customer_id meter_type manufacturer model status')
+
+METER_COLUMNS = 'meter_id, customer_id, meter_type, manufacturer, model, status'
+CHANNEL = 'meters_changed'
+
+
+class MeterRegistry:
+    def __init__(self, ttl=300.0, negative_ttl=5.0, max_size=100000):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()   # meter_id -> (MeterInfo or None, expires_at), LRU order
+        self._subscribed = False
+        self._resyncs = 0
+        self._generation = 0     # Bumped on invalidation so in-flight loads don't store stale rows
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, conn, meter_id):
+        """Return the MeterInfo for meter_id, or None if the meter does not exist.
+
+        conn is only used on a cache miss; pass None to borrow one from the pool.
+        """
+        return self.get_many(conn, [meter_id]).get(meter_id)
+
+    def get_many(self, conn, meter_ids):
+        found = {}
+        missing = []
+        now = time.monotonic()
+        with self._lock:
+            generation = self._generation
+            for meter_id in meter_ids:
+                entry = self._entries.get(meter_id)
+                if entry is not None and entry[1] > now:
+                    self._entries.move_to_end(meter_id)
+                    self.hits += 1
+                    if entry[0] is not None:
+                        found[meter_id] = entry[0]
+                else:
+                    self.misses += 1
+                    missing.append(meter_id)
+
+        if missing:
+            if conn is None:
+                with db_connection() as conn:
+                    loaded = self._load(conn, missing)
+            else:
+                loaded = self._load(conn, missing)
+            found.update(loaded)
+            self._store([(meter_id, loaded.get(meter_id)) for meter_id in missing], generation)
+        return found
+
+    def _load(self, conn, meter_ids):
+        cur = conn.cursor()
+        cur.execute(f'SELECT {METER_COLUMNS} FROM meters WHERE meter_id = ANY(%s)', (meter_ids,))
+        return {row[0]: MeterInfo(*row) for row in cur.fetchall()}
+
+    def warm(self, conn):
+        with self._lock:
+            generation = self._generation
+        cur = conn.cursor()
+        cur.execute(f'SELECT {METER_COLUMNS} FROM meters ORDER BY last_reading_date DESC NULLS LAST LIMIT %s',
+                    (self.max_size,))
+        rows = cur.fetchall()
+        # Least recently read first so the busiest meters are the last to be evicted
+        self._store([(row[0], MeterInfo(*row)) for row in reversed(rows)], generation)
+        return len(rows)
+
+    def invalidate(self, meter_id=None):
+        with self._lock:
+            self.invalidations += 1
+            self._generation += 1
+            if meter_id:
+                self._entries.pop(meter_id, None)
+            else:
+                self._entries.clear()
+
+    def subscribe(self, listener=None):
+        if self._subscribed:
+            return
+        self._subscribed = True
+        (listener or get_listener()).subscribe(CHANNEL, self.invalidate, on_reset=self._resync)
+
+    def _resync(self):
+        # The first LISTEN follows warm(); only a reconnect can have missed changes
+        self._resyncs += 1
+        if self._resyncs > 1:
+            self.invalidate()
+
+    def stats(self):
+        with self._lock:
+            size = len(self._entries)
+        lookups = self.hits + self.misses
+        return {
+            'size': size,
+            'max_size': self.max_size,
+            'ttl_seconds': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': round(self.hits / lookups, 4) if lookups else 0.0,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+            'listening': self._subscribed and get_listener().listening
+        }
+
+    def _store(self, items, generation):
+        now = time.monotonic()
+        with self._lock:
+            if generation != self._generation:
+                return
+            for meter_id, info in items:
+                ttl = self.ttl if info is not None else self.negative_ttl
+                self._entries[meter_id] = (info, now + ttl)
+                self._entries.move_to_end(meter_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_registry():
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                _registry = MeterRegistry(
+                    ttl=float(os.environ.get('METER_CACHE_TTL', 300)),
+                    negative_ttl=float(os.environ.get('METER_CACHE_NEGATIVE_TTL', 5)),
+                    max_size=int(os.environ.get('METER_CACHE_MAX_SIZE', 100000))
+                )
+    return _registry
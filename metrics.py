@@ -0,0 +1,285 @@
+"""Prometheus metrics kept in per-thread aggregates, merged across threads and gunicorn workers at scrape time."""
+import bisect
+import glob
+import os
+import pickle
+import sys
+import threading
+import time
+
+import psycopg2.extensions
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+BYTES_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+# name -> (type, help, label names, buckets)
+METRICS = {
+    'http_request_duration_seconds': ('histogram', 'Request latency by route, method and status.',
+                                      ('route', 'method', 'status'), LATENCY_BUCKETS),
+    'http_response_bytes': ('histogram', 'Response body size by route (streamed responses excluded).',
+                            ('route',), BYTES_BUCKETS),
+    'http_requests_in_flight': ('gauge', 'Requests currently being handled, by route.', ('route',), None),
+    'http_compression_bytes_total': ('counter', 'Compressed response bytes before (in) and after (out), by encoding.',
+                                     ('encoding', 'direction'), None),
+    'db_query_duration_seconds': ('histogram', 'Time in cursor execute/fetch calls, by calling function.',
+                                  ('query',), LATENCY_BUCKETS),
+    'db_rows_returned_total': ('counter', 'Rows returned to the application, by calling function.', ('query',), None),
+    'db_pool_acquire_seconds': ('histogram', 'Time to get a pooled connection, including opening one.',
+                                (), LATENCY_BUCKETS),
+    'db_read_connections_total': ('counter', 'Read-only route connections by target (primary or replica) and reason.',
+                                  ('target', 'reason'), None),
+    'ingest_readings_total': ('counter', 'Readings by ingestion path and outcome.', ('path', 'outcome'), None),
+}
+
+
+class _ThreadStore:
+    __slots__ = ('thread', 'values', 'histograms')
+
+    def __init__(self, thread):
+        self.thread = thread
+        self.values = {}        # (name, labels) -> counter or gauge value
+        self.histograms = {}    # (name, labels) -> [bucket counts..., +Inf count, sum]
+
+
+_local = threading.local()
+_stores = []
+_stores_lock = threading.Lock()
+_retired = _ThreadStore(None)    # totals of threads that have exited
+
+
+def _store():
+    try:
+        return _local.store
+    except AttributeError:
+        store = _local.store = _ThreadStore(threading.current_thread())
+        with _stores_lock:
+            _stores.append(store)
+        return store
+
+
+# Recording only touches the calling thread's store, so it needs no locks
+
+def inc(name, labels=(), value=1):
+    values = _store().values
+    key = (name, labels)
+    values[key] = values.get(key, 0) + value
+
+
+def gauge_add(name, labels=(), delta=1):
+    inc(name, labels, delta)
+
+
+def observe(name, labels, value):
+    histograms = _store().histograms
+    key = (name, labels)
+    counts = histograms.get(key)
+    if counts is None:
+        counts = histograms[key] = [0] * (len(METRICS[name][3]) + 2)
+    counts[bisect.bisect_left(METRICS[name][3], value)] += 1
+    counts[-1] += value
+
+
+def _merge_into(target, values, histograms):
+    for key, value in values:
+        target.values[key] = target.values.get(key, 0) + value
+    for key, counts in histograms:
+        existing = target.histograms.get(key)
+        if existing is None:
+            target.histograms[key] = list(counts)
+        else:
+            for i, count in enumerate(counts):
+                existing[i] += count
+
+
+def snapshot():
+    """Merge every thread's store into one process-wide (values, histograms) pair."""
+    merged = _ThreadStore(None)
+    with _stores_lock:
+        for store in list(_stores):
+            # list() copies each dict in one step under the GIL, so owners can keep writing
+            values, histograms = list(store.values.items()), list(store.histograms.items())
+            if not store.thread.is_alive():
+                _merge_into(_retired, values, histograms)
+                _stores.remove(store)
+                continue
+            _merge_into(merged, values, histograms)
+        _merge_into(merged, list(_retired.values.items()), list(_retired.histograms.items()))
+    return merged.values, merged.histograms
+
+
+# Multi-process mode: with METRICS_DIR set (gunicorn.conf.py does this) every
+# process writes its snapshot there, and a scrape merges all of them.
+
+def _metrics_dir():
+    return os.environ.get('METRICS_DIR')
+
+
+def write_snapshot():
+    directory = _metrics_dir()
+    if not directory:
+        return
+    values, histograms = snapshot()
+    path = os.path.join(directory, f'{os.getpid()}.pkl')
+    with open(path + '.tmp', 'wb') as f:
+        pickle.dump((values, histograms), f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(path + '.tmp', path)
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def collect():
+    """Return (values, histograms) for this process, or for all worker processes in multi-process mode."""
+    directory = _metrics_dir()
+    if not directory:
+        return snapshot()
+    write_snapshot()
+    merged = _ThreadStore(None)
+    for path in glob.glob(os.path.join(directory, '*.pkl')):
+        try:
+            with open(path, 'rb') as f:
+                values, histograms = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            continue
+        if not _alive(int(os.path.basename(path)[:-4])):
+            # Counters of exited workers still count; their gauges do not
+            values = {key: value for key, value in values.items() if METRICS[key[0]][0] != 'gauge'}
+        _merge_into(merged, values.items(), histograms.items())
+    return merged.values, merged.histograms
+
+
+class SnapshotWriter:
+    """Periodically publish this process's snapshot so scrapes served by other workers see it."""
+
+    def __init__(self, interval=5.0):
+        self.interval = interval
+        self._thread = None
+        self._stop = threading.Event()
+
+    def start(self):
+        if self._thread is None and _metrics_dir():
+            self._thread = threading.Thread(target=self._run, name='metrics-writer', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if _metrics_dir():
+            write_snapshot()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                write_snapshot()
+            except OSError as e:
+                print(f'Metrics snapshot failed: {e}')
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names, values, extra=''):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def render():
+    """Prometheus text exposition format (version 0.0.4)."""
+    values, histograms = collect()
+    lines = []
+    for name, (kind, help_text, label_names, buckets) in METRICS.items():
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+        if kind == 'histogram':
+            for (metric, labels), counts in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(buckets + ('+Inf',), counts):
+                    cumulative += count
+                    le = 'le="%s"' % bound
+                    lines.append(f'{name}_bucket{_labels(label_names, labels, le)} {cumulative}')
+                lines.append(f'{name}_sum{_labels(label_names, labels)} {counts[-1]}')
+                lines.append(f'{name}_count{_labels(label_names, labels)} {cumulative}')
+        else:
+            for (metric, labels), value in sorted(values.items()):
+                if metric == name:
+                    lines.append(f'{name}{_labels(label_names, labels)} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+_wrappers = set()
+
+
+def query_helper(fn):
+    """Mark fn as a cursor helper, so its queries are named after fn's caller instead."""
+    _wrappers.add(fn.__code__)
+    return fn
+
+
+def _caller(depth=2):
+    frame = sys._getframe(depth)
+    while frame.f_code in _wrappers:
+        frame = frame.f_back
+    return frame
+
+
+class TimedCursor(psycopg2.extensions.cursor):
+    """Cursor that records db_query_duration_seconds and db_rows_returned_total.
+
+    Queries are named after the calling module and function, e.g.
+    'meter_cache._load', so dashboards stay stable as SQL text changes.
+    """
+
+    def _record(self, started, caller, rows):
+        name = f'{caller.f_globals.get("__name__", "?")}.{caller.f_code.co_name}'
+        observe('db_query_duration_seconds', (name,), time.perf_counter() - started)
+        if rows > 0:
+            inc('db_rows_returned_total', (name,), rows)
+
+    def execute(self, query, vars=None):
+        started = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            # Client-side cursors have every row once execute returns
+            rows = self.rowcount if self.name is None and self.description is not None else 0
+            self._record(started, _caller(), rows)
+
+    def copy_expert(self, sql, file, size=8192):
+        started = time.perf_counter()
+        try:
+            return super().copy_expert(sql, file, size)
+        finally:
+            self._record(started, _caller(), 0)
+
+    def fetchmany(self, size=None):
+        if self.name is None:
+            return super().fetchmany(size) if size is not None else super().fetchmany()
+        # Named (server-side) cursors do their network round trips here
+        started = time.perf_counter()
+        rows = super().fetchmany(size) if size is not None else super().fetchmany()
+        self._record(started, _caller(), len(rows))
+        return rows
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_snapshot_writer():
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                _writer = SnapshotWriter(interval=float(os.environ.get('METRICS_SNAPSHOT_INTERVAL', 5)))
+    return _writer
@@ -0,0 +1,34 @@
+"""Opaque keyset pagination cursors."""
+import base64
+import json
+from datetime import datetime
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(scope, values):
+    """Encode the sort key of the last row on a page. scope ties the cursor to one listing."""
+    key = [{'dt': v.isoformat()} if isinstance(v, datetime) else v for v in values]
+    raw = json.dumps({'s': scope, 'k': key}, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(scope, token, types=None):
+    """Return the sort key encoded by encode_cursor. types, if given, is the expected type of each value."""
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        payload = json.loads(raw)
+        if payload['s'] != scope:
+            raise InvalidCursor('Cursor does not belong to this listing')
+        values = [datetime.fromisoformat(v['dt']) if isinstance(v, dict) else v for v in payload['k']]
+    except InvalidCursor:
+        raise
+    except (ValueError, KeyError, TypeError) as e:
+        raise InvalidCursor(f'Invalid cursor: {e}')
+    # A well-formed cursor with the wrong key would otherwise fail in the query
+    if types is not None and (len(values) != len(types) or not all(
+            isinstance(v, t) and not isinstance(v, bool) for v, t in zip(values, types))):
+        raise InvalidCursor('Cursor does not match this listing')
+    return values
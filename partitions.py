@@ -0,0 +1,249 @@
+"""Range partitioning of meter_readings on reading_date: creation, upkeep, retention and migration."""
+import os
+import re
+import threading
+from datetime import datetime, timedelta
+
+import psycopg2
+
+from db_pool import db_connection, DatabaseUnavailable
+
+PARTITION_INTERVAL = os.environ.get('READINGS_PARTITION_INTERVAL', '').lower()   # '', 'day', 'week' or 'month'
+PARTITIONS_AHEAD = int(os.environ.get('READINGS_PARTITIONS_AHEAD', 3))
+RETENTION = os.environ.get('READINGS_RETENTION', '')                           # e.g. '24 months'
+RETENTION_MODE = os.environ.get('READINGS_RETENTION_MODE', 'detach')             # 'detach' or 'drop'
+MAINTENANCE_INTERVAL = float(os.environ.get('READINGS_PARTITION_MAINTENANCE_INTERVAL', 3600))
+
+INTERVALS = ('day', 'week', 'month')
+MAINTENANCE_LOCK_ID = 0x736d7061   # pg advisory lock key shared by all workers
+
+_BOUND_RE = re.compile(r"FROM \('([^']+)'\) TO \('([^']+)'\)")
+
+# The primary key has to include the partition key; UNIQUE(meter_id, reading_date)
+# already does, and its index doubles as idx_readings_meter_date.
+PARTITIONED_READINGS_DDL = '''
+    CREATE TABLE IF NOT EXISTS meter_readings (
+        reading_id SERIAL,
+        meter_id VARCHAR(50) REFERENCES meters(meter_id),
+        customer_id VARCHAR(50) REFERENCES customers(customer_id),
+        reading_value DECIMAL(12,3) NOT NULL,
+        reading_date TIMESTAMP NOT NULL,
+        reading_type VARCHAR(20) DEFAULT 'automatic',
+        quality_code VARCHAR(10) DEFAULT 'good',
+        temperature DECIMAL(5,2),
+        voltage DECIMAL(5,2),
+        signal_strength INTEGER,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (reading_id, reading_date),
+        UNIQUE(meter_id, reading_date)
+    ) PARTITION BY RANGE (reading_date);
+'''
+
+
+def partitioning_enabled():
+    if PARTITION_INTERVAL and PARTITION_INTERVAL not in INTERVALS:
+        raise ValueError(f'READINGS_PARTITION_INTERVAL must be one of {", ".join(INTERVALS)}')
+    return bool(PARTITION_INTERVAL)
+
+
+def period_start(value, interval=None):
+    interval = interval or PARTITION_INTERVAL
+    day = datetime(value.year, value.month, value.day)
+    if interval == 'month':
+        return day.replace(day=1)
+    if interval == 'week':
+        return day - timedelta(days=day.weekday())
+    return day
+
+
+def next_period(start, interval=None):
+    interval = interval or PARTITION_INTERVAL
+    if interval == 'month':
+        return datetime(start.year + start.month // 12, start.month % 12 + 1, 1)
+    if interval == 'week':
+        return start + timedelta(days=7)
+    return start + timedelta(days=1)
+
+
+def partition_name(start, interval=None):
+    interval = interval or PARTITION_INTERVAL
+    suffix = start.strftime('%Y%m') if interval == 'month' else start.strftime('%Y%m%d')
+    return f'meter_readings_p{suffix}'
+
+
+def is_partitioned(cur):
+    cur.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass('meter_readings')")
+    row = cur.fetchone()
+    return row is not None and row[0] == 'p'
+
+
+def list_partitions(cur):
+    """Return [(name, start, end)] for the range partitions, oldest first."""
+    cur.execute('''
+        SELECT c.relname, pg_get_expr(c.relpartbound, c.oid)
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'meter_readings'::regclass
+    ''')
+    partitions = []
+    for name, bound in cur.fetchall():
+        match = _BOUND_RE.search(bound or '')
+        if match:
+            partitions.append((name, datetime.fromisoformat(match.group(1)), datetime.fromisoformat(match.group(2))))
+    return sorted(partitions, key=lambda p: p[1])
+
+
+def setup_readings_table(cur):
+    """Create partitioned meter_readings if missing and top up partitions. Returns True if partitioned."""
+    cur.execute("SELECT to_regclass('meter_readings')")
+    if cur.fetchone()[0] is None:
+        create_partitioned_readings(cur)
+    elif not is_partitioned(cur):
+        print('⚠️  meter_readings is not partitioned - run "flask --app app partition-readings" to migrate')
+        return False
+    ensure_partitions(cur)
+    return True
+
+
+def create_partitioned_readings(cur):
+    cur.execute(PARTITIONED_READINGS_DDL)
+    # Catches readings outside every range partition so ingestion never fails on a date
+    cur.execute('CREATE TABLE IF NOT EXISTS meter_readings_default PARTITION OF meter_readings DEFAULT;')
+
+
+def create_partition(cur, start, interval=None):
+    """Create the partition for [start, next period), moving any rows already in the default partition."""
+    end = next_period(start, interval)
+    name = partition_name(start, interval)
+    cur.execute(f'CREATE TABLE {name} (LIKE meter_readings INCLUDING DEFAULTS INCLUDING CONSTRAINTS);')
+    cur.execute(f'''
+        WITH moved AS (
+            DELETE FROM meter_readings_default WHERE reading_date >= %s AND reading_date < %s RETURNING *
+        )
+        INSERT INTO {name} SELECT * FROM moved;
+    ''', (start, end))
+    cur.execute(f'ALTER TABLE meter_readings ATTACH PARTITION {name} FOR VALUES FROM (%s) TO (%s);', (start, end))
+    return name
+
+
+def ensure_partitions(cur, now=None, ahead=None, interval=None, since=None):
+    """Create any missing partitions from the oldest existing one (or since) through `ahead` periods from now."""
+    now = now or datetime.utcnow()
+    ahead = PARTITIONS_AHEAD if ahead is None else ahead
+    existing = list_partitions(cur)
+    covered = {start for _, start, _ in existing}
+
+    start = existing[0][1] if existing else period_start(now, interval)
+    if since is not None:
+        start = min(start, period_start(since, interval))
+    last = period_start(now, interval)
+    for _ in range(ahead):
+        last = next_period(last, interval)
+
+    created = []
+    while start <= last:
+        if start not in covered:
+            created.append(create_partition(cur, start, interval))
+        start = next_period(start, interval)
+    return created
+
+
+def apply_retention(cur, retention=None, mode=None, now=None):
+    """Detach (or drop) partitions entirely older than the retention window."""
+    retention = retention or RETENTION
+    mode = mode or RETENTION_MODE
+    if not retention:
+        return []
+    cur.execute('SELECT %s::timestamp - %s::interval', (now or datetime.utcnow(), retention))
+    cutoff = cur.fetchone()[0]
+
+    removed = []
+    for name, _, end in list_partitions(cur):
+        if end > cutoff:
+            break
+        cur.execute(f'ALTER TABLE meter_readings DETACH PARTITION {name};')
+        if mode == 'drop':
+            cur.execute(f'DROP TABLE {name};')
+        removed.append(name)
+    return removed
+
+
+def maintain_partitions(conn):
+    """Create upcoming partitions and apply retention. Safe to run from every worker at once."""
+    cur = conn.cursor()
+    cur.execute('SELECT pg_try_advisory_xact_lock(%s)', (MAINTENANCE_LOCK_ID,))
+    if not cur.fetchone()[0] or not is_partitioned(cur):
+        conn.rollback()
+        return [], []
+    created = ensure_partitions(cur)
+    removed = apply_retention(cur)
+    conn.commit()
+    if created or removed:
+        print(f'Partition maintenance: created {created}, removed ({RETENTION_MODE}) {removed}')
+    return created, removed
+
+
+def migrate_to_partitioned(conn, triggers_fn):
+    """Convert an existing plain meter_readings table into the partitioned layout.
+
+    Runs in one transaction, so writers block until it finishes. The old
+    table is kept as meter_readings_legacy. reading_id values and the
+    sequence position are preserved.
+    """
+    cur = conn.cursor()
+    if is_partitioned(cur):
+        return 0
+    cur.execute('LOCK TABLE meter_readings IN ACCESS EXCLUSIVE MODE;')
+    cur.execute('ALTER TABLE meter_readings RENAME TO meter_readings_legacy;')
+    cur.execute('ALTER SEQUENCE IF EXISTS meter_readings_reading_id_seq RENAME TO meter_readings_legacy_reading_id_seq;')
+    cur.execute('DROP TRIGGER IF EXISTS meter_readings_rollup ON meter_readings_legacy;')
+    cur.execute('DROP TRIGGER IF EXISTS meter_readings_notify ON meter_readings_legacy;')
+    # Index names are schema-wide, so free them up for the new table
+    for index in ('idx_readings_meter_date', 'idx_readings_customer', 'idx_readings_date'):
+        cur.execute(f'ALTER INDEX IF EXISTS {index} RENAME TO {index}_legacy;')
+    cur.execute('''
+        SELECT conname FROM pg_constraint
+        WHERE conrelid = 'meter_readings_legacy'::regclass AND contype IN ('p', 'u')
+    ''')
+    for (name,) in cur.fetchall():
+        cur.execute(f'ALTER TABLE meter_readings_legacy RENAME CONSTRAINT {name} TO {name.replace("meter_readings", "meter_readings_legacy", 1)};')
+    create_partitioned_readings(cur)
+
+    cur.execute('SELECT MIN(reading_date) FROM meter_readings_legacy')
+    ensure_partitions(cur, since=cur.fetchone()[0])
+
+    cur.execute('INSERT INTO meter_readings SELECT * FROM meter_readings_legacy')
+    moved = cur.rowcount
+    cur.execute('''
+        SELECT setval('meter_readings_reading_id_seq',
+                      GREATEST((SELECT MAX(reading_id) FROM meter_readings), 1))
+    ''')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_readings_customer ON meter_readings(customer_id);')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_readings_date ON meter_readings(reading_date);')
+    # Rollups already cover the copied rows; the triggers go on only after the copy
+    triggers_fn(cur)
+    conn.commit()
+    return moved
+
+
+class PartitionMaintainer:
+    def __init__(self, interval=MAINTENANCE_INTERVAL):
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None and partitioning_enabled():
+            self._thread = threading.Thread(target=self._run, name='partition-maintainer', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                with db_connection() as conn:
+                    maintain_partitions(conn)
+            except (DatabaseUnavailable, psycopg2.Error) as e:
+                print(f'Partition maintenance failed: {e}')
@@ -0,0 +1,238 @@
+"""Vectorized quality scoring of cumulative register readings: range, rollback, spike, flatline and gap checks."""
+import json
+import os
+
+import numpy as np
+
+from recent_readings import get_recent_readings, notify_rewritten
+
+# Index 0 is a clean reading; higher indexes win when a reading trips several checks
+QUALITY_CODES = ('good', 'rollover', 'gap', 'flatline', 'spike', 'rollback', 'range')
+GOOD, ROLLOVER, GAP, FLATLINE, SPIKE, ROLLBACK, RANGE = range(len(QUALITY_CODES))
+# Readings with these codes don't reflect the register: left out of baselines and billing
+UNUSABLE_CODES = ('range', 'rollback', 'spike')
+# Rollbacks stay in scoring context: a run of them can be a reset register's new baseline
+CONTEXT_EXCLUDED_CODES = ('range', 'spike')
+
+QUALITY_CHECKS = os.environ.get('QUALITY_CHECKS', 'true').lower() in ('1', 'true', 'yes')
+BASELINE_WINDOW = int(os.environ.get('QUALITY_BASELINE_WINDOW', 24))     # previous intervals in the rate baseline
+MIN_BASELINE = int(os.environ.get('QUALITY_MIN_BASELINE', 4))            # intervals needed before spike checks
+SPIKE_FACTOR = float(os.environ.get('QUALITY_SPIKE_FACTOR', 10))         # rate over baseline that counts as a spike
+GAP_FACTOR = float(os.environ.get('QUALITY_GAP_FACTOR', 3))              # expected intervals missed before a gap
+REBASE_STEPS = int(os.environ.get('QUALITY_REBASE_STEPS', 4))            # rising readings below the max that reset it
+ROLLOVER_BAND = 0.1   # a drop from the top 10% of the register to the bottom 10% is a wrap, not a rollback
+
+# register_max: value at which the register wraps to zero; readings above it are out of range
+# max_rate: consumption per hour that is implausible for the meter type
+# interval: expected seconds between readings
+# flatline_steps: consecutive zero-consumption intervals before flagging (0 disables)
+DEFAULT_RULES = {
+    'electric': {'register_max': 1000000, 'max_rate': 500, 'interval': 900, 'flatline_steps': 96},
+    'gas': {'register_max': 100000, 'max_rate': 100, 'interval': 3600, 'flatline_steps': 0},
+    'water': {'register_max': 10000000, 'max_rate': 5000, 'interval': 3600, 'flatline_steps': 0},
+    None: {'register_max': 999999999.999, 'max_rate': float('inf'), 'interval': 3600, 'flatline_steps': 0}
+}
+
+
+def load_rules():
+    """DEFAULT_RULES with per-type overrides from the QUALITY_RULES JSON object."""
+    rules = {meter_type: dict(rule) for meter_type, rule in DEFAULT_RULES.items()}
+    for meter_type, rule in json.loads(os.environ.get('QUALITY_RULES', '{}')).items():
+        rules.setdefault(meter_type, dict(DEFAULT_RULES[None])).update(rule)
+    return rules
+
+
+RULES = load_rules()
+
+
+def _rule_column(type_names, type_index, field, dtype=np.float64):
+    per_type = np.array([RULES.get(name, RULES[None])[field] for name in type_names], dtype=dtype)
+    return per_type[type_index]
+
+
+def score(meter_ids, times, values, meter_types, known_flat=None):
+    """Return one QUALITY_CODES index per reading.
+
+    Inputs are parallel sequences in any order: meter ids, epoch seconds,
+    cumulative register values and meter types. Each meter is scored in
+    time order against its own earlier readings, so prepend stored history
+    as context to score new readings against it. known_flat marks context
+    readings already flagged as flatline, so runs continue across batches.
+    """
+    n = len(values)
+    if n == 0:
+        return np.zeros(0, dtype=np.int8)
+
+    _, group = np.unique(np.asarray(meter_ids, dtype=object), return_inverse=True)
+    t = np.asarray(times, dtype=np.float64)
+    order = np.lexsort((t, group))
+    group, t = group[order], t[order]
+    # Thousandths, as stored in DECIMAL(12,3), keep the running-max arithmetic exact
+    v = np.rint(np.asarray(values, dtype=np.float64)[order] * 1000).astype(np.int64)
+    type_names, type_index = np.unique(np.asarray(meter_types, dtype=object)[order].astype(str), return_inverse=True)
+    ceiling = np.rint(_rule_column(type_names, type_index, 'register_max') * 1000).astype(np.int64)
+    max_rate = _rule_column(type_names, type_index, 'max_rate')
+    interval = _rule_column(type_names, type_index, 'interval')
+    flatline_steps = _rule_column(type_names, type_index, 'flatline_steps', np.int64)
+
+    idx = np.arange(n)
+    same = np.zeros(n, dtype=bool)          # row continues the previous row's meter
+    same[1:] = group[1:] == group[:-1]
+    group_start = np.maximum.accumulate(np.where(same, 0, idx))
+    dt = np.zeros(n)
+    dt[1:] = np.diff(t)
+
+    out_of_range = (v < 0) | (v > ceiling)
+
+    # Unwrap register rollovers, then compare against the highest earlier value of the meter
+    prev_v = np.zeros(n, dtype=np.int64)
+    prev_v[1:] = v[:-1]
+    band = (ceiling * ROLLOVER_BAND).astype(np.int64)
+    rollover = same & (v < prev_v) & (prev_v >= ceiling - band) & (v <= band)
+    wraps = np.cumsum(rollover)
+    wraps -= wraps[group_start]
+    adjusted = v + ceiling * wraps
+
+    # One global running max, kept per baseline by offsetting each above the previous one.
+    # Pinned values sit at the meter's floor so they don't raise it: out-of-range values
+    # always, and on a second pass the first pass's spikes, so a single bad high reading
+    # doesn't turn every later reading into a rollback.
+    low = adjusted.min()
+    span = adjusted.max() - low + 1
+    window_start = np.maximum(idx - BASELINE_WINDOW, group_start + 1)
+    count = np.maximum(idx - window_start, 0)
+    floor = np.where(np.isfinite(max_rate), max_rate * 0.01, 0.0)
+
+    # Readings from each one that rise steadily for REBASE_STEPS, none out of range
+    rising = np.zeros(n, dtype=bool)
+    rising[:-1] = same[1:] & (adjusted[1:] >= adjusted[:-1]) & ~out_of_range[1:]
+    run_end = np.minimum.accumulate(np.where(rising, n, idx)[::-1])[::-1]
+    run_last = np.minimum(idx + max(REBASE_STEPS, 1) - 1, n - 1)
+    can_rebase = (run_end - idx >= REBASE_STEPS - 1) & (REBASE_STEPS > 0)
+
+    spike = np.zeros(n, dtype=bool)
+    for _ in range(2):
+        # A register that was reset or replaced keeps reading below the old max. When a
+        # rollback starts a steady climb that stays below it, the meter gets a new baseline
+        # from that reading; baselines are found one at a time since each moves the max.
+        rebase = np.zeros(n, dtype=bool)
+        while True:
+            continues = same & ~rebase
+            baseline_id = np.cumsum(~continues)
+            running = np.maximum.accumulate(np.where(out_of_range | spike, 0, adjusted - low) + baseline_id * span)
+            prev_max = np.zeros(n, dtype=np.int64)
+            prev_max[1:] = running[:-1] - baseline_id[1:] * span + low
+            rollback = continues & (adjusted < prev_max)
+            starts = np.flatnonzero(rollback & can_rebase & (adjusted[run_last] < prev_max))
+            if len(starts) == 0:
+                break
+            _, first = np.unique(baseline_id[starts], return_index=True)
+            rebase[starts[first]] = True
+
+        steps = continues & ~rollback
+        consumption = np.where(steps, adjusted - prev_max, 0) / 1000
+        rate = np.where(steps, consumption / np.maximum(dt, 1) * 3600, 0.0)
+
+        # Mean rate over up to BASELINE_WINDOW earlier intervals of the same meter
+        totals = np.zeros(n + 1)
+        totals[1:] = np.cumsum(np.minimum(rate, max_rate))
+        baseline = np.where(count > 0, (totals[idx] - totals[np.minimum(window_start, idx)]) / np.maximum(count, 1), 0.0)
+        spike = steps & ((rate > max_rate) |
+                         ((count >= MIN_BASELINE) & (rate > SPIKE_FACTOR * np.maximum(baseline, floor))))
+
+    # Length of the current zero-consumption run ending at each reading
+    zero = steps & (consumption == 0)
+    last_break = np.maximum.accumulate(np.where(zero, 0, idx))
+    flatline = zero & (flatline_steps > 0) & (idx - last_break >= flatline_steps)
+    if known_flat is not None:
+        last_flat = np.maximum.accumulate(np.where(np.asarray(known_flat, dtype=bool)[order], idx, -1))
+        flatline |= zero & (flatline_steps > 0) & (last_flat >= last_break)
+
+    gap = same & (dt > interval * GAP_FACTOR)
+
+    codes = np.zeros(n, dtype=np.int8)
+    for code, mask in ((ROLLOVER, rollover), (GAP, gap), (FLATLINE, flatline), (SPIKE, spike),
+                       (ROLLBACK, rollback), (RANGE, out_of_range)):
+        codes[mask] = code
+    result = np.empty(n, dtype=np.int8)
+    result[order] = codes
+    return result
+
+
+def load_context(cur, earliest):
+    """Fetch up to BASELINE_WINDOW + 1 accepted readings per meter before {meter_id: epoch seconds}.
+
+    Returns (meter_ids, times, values, known_flat) lists. Readings flagged
+    as range or spike are left out so they don't skew the history. Rollbacks
+    are kept: they don't raise the running max, and a run of them is how a
+    reset register earns a new baseline.
+    """
+    if not earliest:
+        return [], [], [], []
+    cur.execute('''
+        SELECT c.meter_id, EXTRACT(EPOCH FROM r.reading_date)::float8, r.reading_value::float8,
+               r.quality_code = 'flatline'
+        FROM unnest(%s::varchar[], %s::float8[]) AS c(meter_id, before)
+        CROSS JOIN LATERAL (
+            SELECT reading_date, reading_value, quality_code
+            FROM meter_readings
+            WHERE meter_id = c.meter_id
+              AND reading_date < to_timestamp(c.before) AT TIME ZONE 'UTC'
+              AND quality_code NOT IN %s
+            ORDER BY reading_date DESC
+            LIMIT %s
+        ) r
+    ''', (list(earliest), list(earliest.values()), CONTEXT_EXCLUDED_CODES, BASELINE_WINDOW + 1))
+    rows = cur.fetchall()
+    return [list(column) for column in zip(*rows)] if rows else ([], [], [], [])
+
+
+def rescore_readings(conn, meter_id=None, chunk_meters=50):
+    """Re-run the checks over stored history and rewrite quality codes that changed.
+
+    Works through meters in chunks of chunk_meters, one transaction each.
+    Only readings whose current code is one of QUALITY_CODES are rewritten,
+    so codes supplied by the meter or an operator are left alone. Meters
+    with rewritten codes are dropped from recent-readings buffers, here and
+    in other processes. Returns (readings scored, readings updated).
+    """
+    cur = conn.cursor()
+    if meter_id:
+        cur.execute('SELECT meter_id, meter_type FROM meters WHERE meter_id = %s', (meter_id,))
+    else:
+        cur.execute('SELECT meter_id, meter_type FROM meters ORDER BY meter_id')
+    meter_types = dict(cur.fetchall())
+    meters = list(meter_types)
+
+    scored = updated = 0
+    for start in range(0, len(meters), chunk_meters):
+        chunk = meters[start:start + chunk_meters]
+        cur.execute('''
+            SELECT meter_id, reading_date, EXTRACT(EPOCH FROM reading_date)::float8,
+                   reading_value::float8, quality_code
+            FROM meter_readings
+            WHERE meter_id = ANY(%s)
+        ''', (chunk,))
+        rows = cur.fetchall()
+        if not rows:
+            continue
+        ids, dates, times, values, current = zip(*rows)
+        codes = score(ids, times, values, [meter_types[m] for m in ids])
+
+        changes = [(ids[i], dates[i], QUALITY_CODES[code]) for i, code in enumerate(codes)
+                   if current[i] in QUALITY_CODES and current[i] != QUALITY_CODES[code]]
+        if changes:
+            cur.execute('''
+                UPDATE meter_readings r SET quality_code = u.quality_code
+                FROM unnest(%s::varchar[], %s::timestamp[], %s::varchar[]) AS u(meter_id, reading_date, quality_code)
+                WHERE r.meter_id = u.meter_id AND r.reading_date = u.reading_date
+            ''', [list(column) for column in zip(*changes)])
+            changed = sorted({change[0] for change in changes})
+            notify_rewritten(cur, changed)
+        conn.commit()
+        if changes:
+            # Our own backends' notifications are skipped, as for inserts pushed after commit
+            get_recent_readings().invalidate(changed)
+        scored += len(rows)
+        updated += len(changes)
+    return scored, updated
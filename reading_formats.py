@@ -0,0 +1,53 @@
+"""Columnar and packed binary encodings for readings queries, built without per-row dicts."""
+import struct
+from datetime import datetime, timedelta
+
+# ?format= values accepted by GET /api/v1/readings/<meter_id>
+READING_FORMATS = ('json', 'columnar', 'binary')
+
+BINARY_MIMETYPE = 'application/vnd.smartmeter.readings'
+
+# One fixed-width little-endian record per reading:
+# int64 reading_date in microseconds since the Unix epoch, float64 reading_value
+BINARY_RECORD = struct.Struct('<qd')
+
+_EPOCH = datetime(1970, 1, 1)
+
+# The database does the type conversion, so cursor rows already hold JSON-ready
+# values. reading_date must stay at column 1 and reading_id at column 0 for keyset cursors.
+COLUMNAR_COLUMNS = ['reading_id', 'reading_date', 'customer_id', 'reading_value', 'reading_type',
+                    'quality_code', 'temperature', 'voltage', 'signal_strength', 'created_at']
+
+COLUMNAR_SELECT = '''
+    SELECT reading_id, EXTRACT(EPOCH FROM reading_date)::float8, customer_id,
+           reading_value::float8, reading_type, quality_code,
+           temperature::float8, voltage::float8, signal_strength,
+           EXTRACT(EPOCH FROM created_at)::float8
+'''
+
+BINARY_SELECT = '''
+    SELECT reading_id, (EXTRACT(EPOCH FROM reading_date) * 1000000)::bigint, reading_value::float8
+'''
+
+
+def epoch_to_datetime(value, unit=1):
+    """Exact naive UTC datetime for an epoch value in 1/unit seconds."""
+    return _EPOCH + timedelta(microseconds=round(value * 1000000 / unit))
+
+
+def columnar(rows):
+    """Transpose cursor rows into {column: [values]} with epoch-second timestamps."""
+    if not rows:
+        return {name: [] for name in COLUMNAR_COLUMNS}
+    return dict(zip(COLUMNAR_COLUMNS, map(list, zip(*rows))))
+
+
+def pack_binary(rows):
+    """Pack BINARY_SELECT rows as consecutive BINARY_RECORD records."""
+    flat = [value for row in rows for value in row[1:]]
+    return struct.pack(f'<{"qd" * len(rows)}', *flat)
+
+
+def unpack_binary(body):
+    """Decode a binary readings body into [(epoch_microseconds, reading_value)]."""
+    return list(BINARY_RECORD.iter_unpack(body))
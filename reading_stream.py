@@ -0,0 +1,238 @@
+"""Server-Sent Events fan-out of committed readings and reading-count deltas, one database listener per process."""
+import json
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+
+import psycopg2
+
+from db_events import get_listener
+from db_pool import db_connection, get_pool, DatabaseUnavailable
+from recent_readings import CHANNEL, READING_COLUMNS, parse_notification
+
+STREAM_MAX_CLIENTS = int(os.environ.get('STREAM_MAX_CLIENTS', 2))
+STREAM_HEARTBEAT = float(os.environ.get('STREAM_HEARTBEAT', 15))
+STREAM_MAX_SECONDS = float(os.environ.get('STREAM_MAX_SECONDS', 300))
+STREAM_QUEUE_SIZE = int(os.environ.get('STREAM_QUEUE_SIZE', 1000))
+
+_CLOSED = object()
+
+
+class StreamFull(Exception):
+    pass
+
+
+def reading_dict(row):
+    """JSON shape of a READING_COLUMNS row, matching GET /api/v1/readings/<meter_id>."""
+    return {
+        'reading_id': row[0],
+        'meter_id': row[1],
+        'customer_id': row[2],
+        'reading_value': float(row[3]),
+        'reading_date': row[4].isoformat(),
+        'reading_type': row[5],
+        'quality_code': row[6],
+        'temperature': float(row[7]) if row[7] is not None else None,
+        'voltage': float(row[8]) if row[8] is not None else None,
+        'signal_strength': row[9],
+        'created_at': row[10].isoformat()
+    }
+
+
+def format_event(event, data):
+    return f'event: {event}\ndata: {json.dumps(data, separators=(",", ":"))}\n\n'
+
+
+class Subscription:
+    __slots__ = ('meter_ids', 'events', 'overflowed')
+
+    def __init__(self, meter_ids, queue_size):
+        self.meter_ids = meter_ids      # None for every meter
+        self.events = queue.Queue(queue_size)
+        self.overflowed = False
+
+    def wants(self, meter_id):
+        return self.meter_ids is None or meter_id in self.meter_ids
+
+    def offer(self, message):
+        try:
+            self.events.put_nowait(message)
+        except queue.Full:
+            # A slow client gets one resync instead of an unbounded backlog
+            self.overflowed = True
+
+
+class ReadingStream:
+    """Fans reading and stats events out to SSE subscribers.
+
+    Readings committed by this process arrive through publish(), in full.
+    Readings committed elsewhere arrive as notifications on the recent
+    readings channel and are fetched once per notification: subscribers get
+    the newest reading of each notified meter and the exact row count.
+    """
+
+    def __init__(self, max_clients=2, queue_size=1000):
+        self.max_clients = max_clients
+        self.queue_size = queue_size
+        self._lock = threading.Lock()
+        self._subscribers = []
+        self._last_sent = OrderedDict()     # meter_id -> reading_id, so a foreign fetch skips what was sent
+        self._subscribed = False
+        self._closed = False
+
+        self.events_published = 0
+        self.rejected = 0
+        self.overflows = 0
+
+    def subscribe(self, meter_ids=None):
+        with self._lock:
+            if self._closed or len(self._subscribers) >= self.max_clients:
+                self.rejected += 1
+                raise StreamFull(f'At most {self.max_clients} live streams per process')
+            sub = Subscription(frozenset(meter_ids) if meter_ids else None, self.queue_size)
+            self._subscribers.append(sub)
+        if not self._subscribed:
+            self._subscribed = True
+            get_listener().subscribe(CHANNEL, self._on_notify, on_reset=self._on_reset)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            if sub in self._subscribers:
+                self._subscribers.remove(sub)
+
+    def close(self):
+        """End every open stream, e.g. when the worker is shutting down."""
+        with self._lock:
+            self._closed = True
+            subscribers, self._subscribers = self._subscribers, []
+        for sub in subscribers:
+            sub.offer(_CLOSED)
+
+    def publish(self, rows, count=None):
+        """Send events for rows (READING_COLUMNS order) to interested subscribers."""
+        if not self._subscribers or not (rows or count):
+            return
+        with self._lock:
+            subscribers = list(self._subscribers)
+            for row in rows:
+                self._last_sent[row[1]] = row[0]
+                self._last_sent.move_to_end(row[1])
+            while len(self._last_sent) > 100000:
+                self._last_sent.popitem(last=False)
+        # Serialize each event once, however many subscribers get it
+        for row in rows:
+            message = None
+            for sub in subscribers:
+                if sub.wants(row[1]):
+                    message = message or format_event('reading', reading_dict(row))
+                    sub.offer(message)
+        stats = format_event('stats', {'readings': count if count is not None else len(rows)})
+        for sub in subscribers:
+            sub.offer(stats)
+        self.events_published += len(rows)
+
+    def _broadcast(self, event, data):
+        message = format_event(event, data)
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for sub in subscribers:
+            sub.offer(message)
+
+    def _on_reset(self):
+        # Notifications sent while the listener was down are lost
+        self._broadcast('resync', {'reason': 'listener reconnected'})
+
+    def _on_notify(self, payload):
+        if not self._subscribers:
+            return
+        pid, count, meter_ids = parse_notification(payload)
+        # Inserts through this process's pool were already published after commit
+        if pid in get_pool().backend_pids():
+            return
+        if meter_ids is None:
+            self._broadcast('resync', {'reason': 'too many meters in one insert'})
+            return
+        with self._lock:
+            wanted = [m for m in meter_ids if any(sub.wants(m) for sub in self._subscribers)]
+        rows = []
+        if wanted:
+            try:
+                rows = self._fetch_newest(wanted)
+            except (DatabaseUnavailable, psycopg2.Error) as e:
+                print(f'Reading stream fetch failed: {e}')
+                self._broadcast('resync', {'reason': 'fetch failed'})
+                return
+            with self._lock:
+                rows = [row for row in rows if self._last_sent.get(row[1]) != row[0]]
+        self.publish(rows, count)
+
+    def _fetch_newest(self, meter_ids):
+        # Runs on the listener thread, so it uses the same short pool timeout as a request
+        with db_connection() as conn:
+            cur = conn.cursor()
+            cur.execute(f'''
+                SELECT {', '.join('r.' + column for column in READING_COLUMNS)}
+                FROM unnest(%s::varchar[]) AS m(meter_id)
+                CROSS JOIN LATERAL (
+                    SELECT * FROM meter_readings
+                    WHERE meter_id = m.meter_id
+                    ORDER BY reading_date DESC, reading_id DESC
+                    LIMIT 1
+                ) r
+            ''', (meter_ids,))
+            rows = cur.fetchall()
+            conn.commit()
+        return rows
+
+    def events(self, sub, heartbeat=15.0, max_seconds=300.0):
+        """Yield SSE text for sub until it closes, overflows or reaches max_seconds."""
+        deadline = time.monotonic() + max_seconds
+        try:
+            # The browser reconnects after `retry` ms; ready tells it to refetch whatever it missed
+            yield 'retry: 3000\n' + format_event('ready', {'meter_ids': sorted(sub.meter_ids or [])})
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return
+                try:
+                    message = sub.events.get(timeout=min(heartbeat, remaining))
+                except queue.Empty:
+                    yield ': keepalive\n\n'
+                    continue
+                if message is _CLOSED:
+                    return
+                if sub.overflowed:
+                    self.overflows += 1
+                    yield format_event('resync', {'reason': 'client fell behind'})
+                    return
+                yield message
+        finally:
+            self.unsubscribe(sub)
+
+    def stats(self):
+        with self._lock:
+            clients = len(self._subscribers)
+        return {
+            'clients': clients,
+            'max_clients': self.max_clients,
+            'events_published': self.events_published,
+            'rejected': self.rejected,
+            'overflows': self.overflows,
+            'listening': self._subscribed and get_listener().listening
+        }
+
+
+_stream = None
+_stream_lock = threading.Lock()
+
+
+def get_reading_stream():
+    global _stream
+    if _stream is None:
+        with _stream_lock:
+            if _stream is None:
+                _stream = ReadingStream(max_clients=STREAM_MAX_CLIENTS, queue_size=STREAM_QUEUE_SIZE)
+    return _stream
@@ -0,0 +1,342 @@
+"""Per-meter ring buffers of the most recent readings, filled on ingest and loaded lazily on miss.
+
+Each buffered reading takes 80 bytes: seven 8-byte array slots (reading_id,
+reading_date, created_at, reading_value, temperature, voltage,
+signal_strength) plus three list references to interned strings
+(customer_id, reading_type, quality_code). Add roughly 1 KB of fixed
+overhead per meter. With the defaults (100 readings, 2000 meters) a fully
+populated cache holds about 18 MB per process.
+"""
+import os
+import sys
+import threading
+from array import array
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from db_events import get_listener
+from db_pool import db_connection, get_pool
+
+CHANNEL = 'readings_inserted'
+
+READING_COLUMNS = ['reading_id', 'meter_id', 'customer_id', 'reading_value', 'reading_date', 'reading_type',
+                   'quality_code', 'temperature', 'voltage', 'signal_strength', 'created_at']
+
+_EPOCH = datetime(1970, 1, 1)
+_MICROSECOND = timedelta(microseconds=1)
+_NAN = float('nan')
+_NO_SIGNAL = -2 ** 63     # signal_strength NULL marker in the int64 array
+
+# Largest meter list sent in one notification; longer lists ask listeners to drop everything
+_MAX_PAYLOAD = 7000
+
+
+def create_recent_readings_trigger(cur):
+    """Notify other processes which meters got new readings, as 'writer backend pid:row count:meter ids'."""
+    cur.execute(f'''
+        CREATE OR REPLACE FUNCTION notify_readings_inserted() RETURNS trigger AS $$
+        DECLARE
+            meters TEXT;
+            inserted BIGINT;
+        BEGIN
+            SELECT string_agg(DISTINCT meter_id, ','), count(*) INTO meters, inserted FROM new_readings;
+            IF meters IS NULL THEN
+                RETURN NULL;
+            END IF;
+            IF length(meters) > {_MAX_PAYLOAD} THEN
+                meters := '';
+            END IF;
+            PERFORM pg_notify('{CHANNEL}', pg_backend_pid() || ':' || inserted || ':' || meters);
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+    ''')
+    cur.execute('DROP TRIGGER IF EXISTS meter_readings_notify ON meter_readings;')
+    cur.execute('''
+        CREATE TRIGGER meter_readings_notify
+        AFTER INSERT ON meter_readings
+        REFERENCING NEW TABLE AS new_readings
+        FOR EACH STATEMENT EXECUTE FUNCTION notify_readings_inserted();
+    ''')
+
+
+def notify_rewritten(cur, meter_ids):
+    """Tell other processes that stored readings of meter_ids changed in place.
+
+    Sends the trigger's payload with a row count of 0, so buffers drop those
+    meters and live streams have nothing new to count.
+    """
+    meters = ','.join(sorted(set(meter_ids)))
+    if len(meters) > _MAX_PAYLOAD:
+        meters = ''
+    cur.execute('SELECT pg_notify(%s, pg_backend_pid() || %s)', (CHANNEL, f':0:{meters}'))
+
+
+def parse_notification(payload):
+    """Split a CHANNEL payload into (pid, row count, meter ids); meter ids is None when too many to list."""
+    parts = payload.split(':', 2)
+    if len(parts) == 2:
+        # Sent by a trigger created before the row count was added
+        parts.insert(1, '')
+    pid, count, meters = parts
+    return (int(pid) if pid.isdigit() else None, int(count) if count.isdigit() else None,
+            meters.split(',') if meters else None)
+
+
+def _micros(value):
+    return (value - _EPOCH) // _MICROSECOND
+
+
+def _intern(value):
+    return None if value is None else sys.intern(value)
+
+
+class _MeterBuffer:
+    """Fixed-capacity ring of one meter's newest readings, oldest at head."""
+    __slots__ = ('meter_id', 'capacity', 'complete', 'head', 'ids', 'dates', 'created', 'values',
+                 'temperatures', 'voltages', 'signals', 'customers', 'types', 'qualities')
+
+    def __init__(self, meter_id, capacity, complete):
+        self.meter_id = meter_id
+        self.capacity = capacity
+        self.complete = complete    # True while the buffer holds every reading the meter has
+        self.head = 0
+        self.ids = array('q')
+        self.dates = array('q')
+        self.created = array('q')
+        self.values = array('d')
+        self.temperatures = array('d')
+        self.voltages = array('d')
+        self.signals = array('q')
+        self.customers = []
+        self.types = []
+        self.qualities = []
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _key(self, position):
+        index = (self.head + position) % len(self.ids)
+        return self.dates[index], self.ids[index]
+
+    def append(self, row):
+        """Add a row in READING_COLUMNS order. Returns False if the buffer can no longer be trusted."""
+        key = (_micros(row[4]), row[0])
+        if self.ids:
+            if key[1] in self.ids:
+                return True     # Already loaded from the database
+            if key <= self._key(-1):
+                # Out-of-order arrival: older than everything kept is simply not recent
+                if len(self.ids) == self.capacity and key < self._key(0):
+                    self.complete = False
+                    return True
+                return False
+        fields = (
+            key[1], key[0], _micros(row[10]), float(row[3]),
+            _NAN if row[7] is None else float(row[7]),
+            _NAN if row[8] is None else float(row[8]),
+            _NO_SIGNAL if row[9] is None else row[9],
+            _intern(row[2]), _intern(row[5]), _intern(row[6])
+        )
+        columns = (self.ids, self.dates, self.created, self.values, self.temperatures, self.voltages,
+                   self.signals, self.customers, self.types, self.qualities)
+        if len(self.ids) < self.capacity:
+            for column, value in zip(columns, fields):
+                column.append(value)
+        else:
+            for column, value in zip(columns, fields):
+                column[self.head] = value
+            self.head = (self.head + 1) % self.capacity
+            self.complete = False
+        return True
+
+    def rows(self, count, fmt='json'):
+        """Newest-first rows shaped like the readings query for fmt, or None if count isn't covered."""
+        size = len(self.ids)
+        if count > size and not self.complete:
+            return None
+        rows = []
+        for position in range(size - 1, max(size - count, 0) - 1, -1):
+            i = (self.head + position) % size
+            if fmt == 'binary':
+                rows.append((self.ids[i], self.dates[i], self.values[i]))
+                continue
+            temperature, voltage, signal = self.temperatures[i], self.voltages[i], self.signals[i]
+            temperature = None if temperature != temperature else temperature
+            voltage = None if voltage != voltage else voltage
+            signal = None if signal == _NO_SIGNAL else signal
+            if fmt == 'columnar':
+                rows.append((self.ids[i], self.dates[i] / 1000000, self.customers[i], self.values[i],
+                             self.types[i], self.qualities[i], temperature, voltage, signal,
+                             self.created[i] / 1000000))
+            else:
+                rows.append((self.ids[i], self.meter_id, self.customers[i], self.values[i],
+                             _EPOCH + timedelta(microseconds=self.dates[i]), self.types[i], self.qualities[i],
+                             temperature, voltage, signal, _EPOCH + timedelta(microseconds=self.created[i])))
+        return rows
+
+    def nbytes(self):
+        return sum(sys.getsizeof(column) for column in (
+            self, self.ids, self.dates, self.created, self.values, self.temperatures, self.voltages,
+            self.signals, self.customers, self.types, self.qualities))
+
+
+class RecentReadings:
+    def __init__(self, per_meter=100, max_meters=2000):
+        self.per_meter = per_meter
+        self.max_meters = max_meters
+        # One extra reading per meter tells a full page whether there is a next page
+        self.capacity = per_meter + 1 if per_meter > 0 else 0
+        self._lock = threading.Lock()
+        self._buffers = OrderedDict()   # meter_id -> _MeterBuffer, LRU order
+        self._loading = {}              # meter_id -> rows pushed during the load, None once stale
+        self._subscribed = False
+
+        self.hits = 0
+        self.misses = 0
+        self.bypasses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @property
+    def enabled(self):
+        return self.capacity > 0
+
+    def get(self, conn, meter_id, count, fmt='json'):
+        """Return the newest `count` rows for meter_id shaped for fmt, or None to query the database.
+
+        conn is only used to load a missing buffer; pass None to borrow one from the pool.
+        """
+        if not self.enabled or count > self.capacity or not (self._subscribed and get_listener().listening):
+            self.bypasses += 1
+            return None
+        with self._lock:
+            buf = self._buffers.get(meter_id)
+            if buf is not None:
+                rows = buf.rows(count, fmt)
+                if rows is not None:
+                    self._buffers.move_to_end(meter_id)
+                    self.hits += 1
+                    return rows
+            if meter_id in self._loading:
+                self.bypasses += 1
+                return None
+            self.misses += 1
+            self._loading[meter_id] = []
+
+        try:
+            if conn is None:
+                with db_connection() as conn:
+                    buf = self._load(conn, meter_id)
+            else:
+                buf = self._load(conn, meter_id)
+        finally:
+            with self._lock:
+                pending = self._loading.pop(meter_id)
+        if pending is None:
+            return buf.rows(count, fmt)
+
+        with self._lock:
+            if all(buf.append(row) for row in pending):
+                self._buffers[meter_id] = buf
+                self._buffers.move_to_end(meter_id)
+                while len(self._buffers) > self.max_meters:
+                    self._buffers.popitem(last=False)
+                    self.evictions += 1
+        return buf.rows(count, fmt)
+
+    def _load(self, conn, meter_id):
+        cur = conn.cursor()
+        cur.execute(f'''
+            SELECT {", ".join(READING_COLUMNS)}
+            FROM meter_readings
+            WHERE meter_id = %s
+            ORDER BY reading_date DESC, reading_id DESC
+            LIMIT %s
+        ''', (meter_id, self.capacity))
+        rows = cur.fetchall()
+        buf = _MeterBuffer(meter_id, self.capacity, complete=len(rows) < self.capacity)
+        for row in reversed(rows):
+            buf.append(row)
+        return buf
+
+    def push(self, rows):
+        """Record rows (READING_COLUMNS order) committed through a pooled connection."""
+        if not self.enabled or not rows:
+            return
+        by_meter = {}
+        for row in rows:
+            by_meter.setdefault(row[1], []).append(row)
+        with self._lock:
+            for meter_id, meter_rows in by_meter.items():
+                meter_rows.sort(key=lambda r: (r[4], r[0]))
+                pending = self._loading.get(meter_id)
+                if pending is not None:
+                    pending.extend(meter_rows)
+                buf = self._buffers.get(meter_id)
+                if buf is not None and not all(buf.append(row) for row in meter_rows):
+                    del self._buffers[meter_id]
+                    self.invalidations += 1
+
+    def invalidate(self, meter_ids=None):
+        with self._lock:
+            self.invalidations += 1
+            if meter_ids is None:
+                self._buffers.clear()
+                stale = list(self._loading)
+            else:
+                for meter_id in meter_ids:
+                    self._buffers.pop(meter_id, None)
+                stale = [meter_id for meter_id in meter_ids if meter_id in self._loading]
+            for meter_id in stale:
+                self._loading[meter_id] = None
+
+    def _on_notify(self, payload):
+        pid, _, meter_ids = parse_notification(payload)
+        # Inserts through this process's pool were already pushed after commit
+        if pid in get_pool().backend_pids():
+            return
+        self.invalidate(meter_ids)
+
+    def subscribe(self, listener=None):
+        if self._subscribed or not self.enabled:
+            return
+        self._subscribed = True
+        (listener or get_listener()).subscribe(CHANNEL, self._on_notify, on_reset=self.invalidate)
+
+    def stats(self):
+        with self._lock:
+            meters = len(self._buffers)
+            readings = sum(len(buf) for buf in self._buffers.values())
+            nbytes = sum(buf.nbytes() for buf in self._buffers.values())
+        return {
+            'enabled': self.enabled,
+            'per_meter': self.per_meter,
+            'max_meters': self.max_meters,
+            'meters': meters,
+            'readings': readings,
+            'approx_bytes': nbytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'bypasses': self.bypasses,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+            'listening': self._subscribed and get_listener().listening
+        }
+
+
+_recent = None
+_recent_lock = threading.Lock()
+
+
+def get_recent_readings():
+    global _recent
+    if _recent is None:
+        with _recent_lock:
+            if _recent is None:
+                _recent = RecentReadings(
+                    per_meter=int(os.environ.get('RECENT_READINGS_PER_METER', 100)),
+                    max_meters=int(os.environ.get('RECENT_READINGS_MAX_METERS', 2000))
+                )
+                _recent.subscribe()
+    return _recent
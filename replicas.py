@@ -0,0 +1,274 @@
+"""Read-replica routing: read-only routes use a replica that is up and within the lag limit, otherwise the primary."""
+import functools
+import itertools
+import os
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+
+import psycopg2
+
+from db_pool import ConnectionPool, PoolTimeout, DatabaseUnavailable, connect, get_pool
+from metrics import inc
+
+REPLICA_MAX_LAG = float(os.environ.get('REPLICA_MAX_LAG', 5))
+REPLICA_CHECK_INTERVAL = float(os.environ.get('REPLICA_CHECK_INTERVAL', 2))
+REPLICA_CHECK_TIMEOUT = float(os.environ.get('REPLICA_CHECK_TIMEOUT', 1))
+REPLICA_SELECTION = os.environ.get('REPLICA_SELECTION', 'least_loaded')
+# An idle primary only sends keepalives every wal_sender_timeout / 2 (30s by default),
+# so silence is judged against its own, longer limit than REPLICA_MAX_LAG
+REPLICA_MAX_SILENCE = float(os.environ.get('REPLICA_MAX_SILENCE', 60))
+SELECTIONS = ('least_loaded', 'round_robin')
+
+# NULL (unusable) unless the standby's WAL receiver is streaming and has heard
+# from the primary within REPLICA_MAX_SILENCE seconds: a replica cut off from the
+# primary has replayed everything it received and would otherwise read zero.
+# Then zero while the replica has replayed everything it received, so an idle
+# primary doesn't make its replicas look stale; otherwise the age of the last
+# replayed transaction, NULL if it has replayed none since it started.
+# pg_stat_wal_receiver hides status from roles without pg_read_all_stats, which
+# leaves every replica unusable; grant it to DB_USER.
+LAG_QUERY = '''
+    SELECT pg_is_in_recovery(),
+           CASE WHEN NOT pg_is_in_recovery() THEN 0
+                WHEN NOT EXISTS (
+                    SELECT 1 FROM pg_stat_wal_receiver
+                    WHERE status = 'streaming' AND last_msg_receipt_time >= now() - make_interval(secs => %s)
+                ) THEN NULL
+                WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+           END::float8
+'''
+
+
+def parse_read_hosts(value):
+    """'host[:port],...' -> [(host, port or None)]; a host may be a socket directory."""
+    hosts = []
+    for spec in value.split(','):
+        spec = spec.strip()
+        if not spec:
+            continue
+        host, _, port = spec.rpartition(':')
+        if host and port.isdigit():
+            hosts.append((host, int(port)))
+        else:
+            hosts.append((spec, None))
+    return hosts
+
+
+DB_READ_HOSTS = parse_read_hosts(os.environ.get('DB_READ_HOSTS', ''))
+
+
+class Replica:
+    def __init__(self, name, pool):
+        self.name = name
+        self.pool = pool
+        self.up = False
+        self.in_recovery = None
+        self.lag = None
+        self.error = 'Replica has not been checked yet'
+        self.checked = None     # monotonic time of the last completed check
+        self.reads = 0
+
+    def in_use(self):
+        return self.pool.stats()['in_use']
+
+
+class ReplicaRouter:
+    def __init__(self, replicas, max_lag=5.0, interval=2.0, timeout=1.0, selection='least_loaded', max_silence=60.0):
+        if selection not in SELECTIONS:
+            raise ValueError(f'REPLICA_SELECTION must be one of {", ".join(SELECTIONS)}')
+        self.replicas = replicas
+        self.max_lag = max_lag
+        self.max_silence = max_silence
+        self.interval = interval
+        self.timeout = timeout
+        self.selection = selection
+        self._lock = threading.Lock()
+        self._turn = itertools.count()
+        self._thread = None
+        self._stop = threading.Event()
+
+        self.primary_reads = {'requested': 0, 'unavailable': 0, 'error': 0}
+
+    def start(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='replica-checker', daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def close(self):
+        self.stop()
+        for replica in self.replicas:
+            replica.pool.close()
+
+    def _run(self):
+        while not self._stop.is_set():
+            for replica in self.replicas:
+                self.check(replica)
+            self._stop.wait(self.interval)
+
+    def check(self, replica):
+        error, in_recovery, lag = None, None, None
+        try:
+            with replica.pool.connection(timeout=self.timeout) as conn:
+                cur = conn.cursor()
+                cur.execute('SET LOCAL statement_timeout = %s', (int(self.timeout * 1000),))
+                cur.execute(LAG_QUERY, (self.max_silence,))
+                in_recovery, lag = cur.fetchone()
+                conn.rollback()
+        except PoolTimeout:
+            # Every connection busy serving reads: the replica is up, keep the last lag
+            return
+        except (DatabaseUnavailable, psycopg2.Error) as e:
+            error = str(e).strip()
+        with self._lock:
+            if error is None and replica.error is not None:
+                print(f'Replica {replica.name} is up')
+            elif error is not None and replica.up:
+                print(f'Replica {replica.name} is down: {error}')
+            replica.up = error is None
+            replica.error = error
+            replica.in_recovery = in_recovery
+            replica.lag = lag
+            replica.checked = time.monotonic()
+
+    def _usable(self, replica, now):
+        # A wedged checker must not keep routing on its last good result
+        return (replica.up and replica.lag is not None and replica.lag <= self.max_lag
+                and now - replica.checked <= self.interval * 3 + self.timeout)
+
+    def choose(self):
+        """The replica to read from, or None when none is usable."""
+        now = time.monotonic()
+        with self._lock:
+            usable = [replica for replica in self.replicas if self._usable(replica, now)]
+        if not usable:
+            return None
+        # Rotating the start spreads ties between equally loaded replicas
+        start = next(self._turn) % len(usable)
+        usable = usable[start:] + usable[:start]
+        if self.selection == 'round_robin':
+            return usable[0]
+        return min(usable, key=Replica.in_use)
+
+    def _mark_down(self, replica, error):
+        with self._lock:
+            if replica.up:
+                print(f'Replica {replica.name} is down: {error}')
+            replica.up = False
+            replica.error = str(error)
+
+    @contextmanager
+    def connection(self, primary=False, timeout=None):
+        """A pooled connection for read-only queries; primary=True reads this process's own writes."""
+        self.start()
+        with ExitStack() as stack:
+            conn, reason = None, 'requested'
+            replica = None if primary else self.choose()
+            if replica is not None:
+                try:
+                    conn = stack.enter_context(replica.pool.connection(timeout))
+                except PoolTimeout:
+                    reason = 'error'
+                except DatabaseUnavailable as e:
+                    self._mark_down(replica, e)
+                    reason = 'error'
+            elif not primary:
+                reason = 'unavailable'
+
+            if conn is None:
+                conn = stack.enter_context(get_pool().connection(timeout))
+                self.primary_reads[reason] += 1
+                inc('db_read_connections_total', ('primary', reason))
+            else:
+                replica.reads += 1
+                inc('db_read_connections_total', (replica.name, 'replica'))
+            yield conn
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            replicas = [{
+                'name': replica.name,
+                'up': replica.up,
+                'usable': self._usable(replica, now),
+                'in_recovery': replica.in_recovery,
+                'lag_seconds': None if replica.lag is None else round(replica.lag, 3),
+                'checked_seconds_ago': None if replica.checked is None else round(now - replica.checked, 3),
+                'error': replica.error,
+                'reads': replica.reads,
+                'pool': replica.pool.stats()
+            } for replica in self.replicas]
+        return {
+            'selection': self.selection,
+            'max_lag_seconds': self.max_lag,
+            'replicas': replicas,
+            'primary_reads': dict(self.primary_reads)
+        }
+
+
+_router = None
+_router_lock = threading.Lock()
+
+
+def get_router():
+    """The process's replica router, or None when DB_READ_HOSTS is not set."""
+    global _router
+    if _router is None:
+        if not DB_READ_HOSTS:
+            return None
+        with _router_lock:
+            if _router is None:
+                replicas = []
+                for host, port in DB_READ_HOSTS:
+                    pool = ConnectionPool(
+                        connect_fn=functools.partial(connect, host=host, port=port),
+                        min_size=0,
+                        max_size=int(os.environ.get('DB_READ_POOL_MAX_SIZE', os.environ.get('DB_POOL_MAX_SIZE', 10))),
+                        acquire_timeout=float(os.environ.get('DB_POOL_TIMEOUT', 5)),
+                        max_uses=int(os.environ.get('DB_POOL_MAX_USES', 5000)),
+                        max_lifetime=float(os.environ.get('DB_POOL_MAX_LIFETIME', 1800)),
+                        validate_after=float(os.environ.get('DB_POOL_VALIDATE_AFTER', 30))
+                    )
+                    replicas.append(Replica(f'{host}:{port}' if port else host, pool))
+                _router = ReplicaRouter(replicas, max_lag=REPLICA_MAX_LAG, interval=REPLICA_CHECK_INTERVAL,
+                                        timeout=REPLICA_CHECK_TIMEOUT, selection=REPLICA_SELECTION,
+                                        max_silence=REPLICA_MAX_SILENCE)
+    return _router
+
+
+def close_router():
+    global _router
+    with _router_lock:
+        router, _router = _router, None
+    if router is not None:
+        router.close()
+
+
+def read_connection(primary=False, timeout=None):
+    """Connection for read-only queries: a replica when one is configured and usable, else the primary pool."""
+    router = get_router()
+    if router is None:
+        return get_pool().connection(timeout)
+    return router.connection(primary, timeout)
+
+
+_inherited_routers = []
+
+
+def _forget_router_after_fork():
+    # Same as the primary pool: the parent owns inherited sockets and the checker thread
+    global _router, _router_lock
+    if _router is not None:
+        _inherited_routers.append(_router)
+    _router = None
+    _router_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_forget_router_after_fork)
@@ -0,0 +1,123 @@
+"""Hourly/daily/monthly consumption rollups maintained incrementally by a trigger on meter_readings."""
+
+INTERVALS = ('hour', 'day', 'month')
+
+# Aggregates readings from {source} into one row per meter, interval and bucket.
+# first/last values are the register readings at the earliest/latest timestamps.
+ROLLUP_SELECT = '''
+    SELECT n.meter_id, i.bucket_interval, date_trunc(i.bucket_interval, n.reading_date) AS bucket_start,
+           MIN(n.reading_date), (array_agg(n.reading_value ORDER BY n.reading_date))[1],
+           MAX(n.reading_date), (array_agg(n.reading_value ORDER BY n.reading_date DESC))[1],
+           MIN(n.reading_value), MAX(n.reading_value), COUNT(*)
+    FROM {source} n
+    CROSS JOIN (VALUES ('hour'), ('day'), ('month')) AS i(bucket_interval)
+    {where}
+    GROUP BY 1, 2, 3
+'''
+
+ROLLUP_COLUMNS = '''(meter_id, bucket_interval, bucket_start, first_date, first_value,
+                     last_date, last_value, min_value, max_value, reading_count)'''
+
+
+def create_rollup_schema(cur):
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS reading_rollups (
+            meter_id VARCHAR(50) NOT NULL,
+            bucket_interval VARCHAR(5) NOT NULL CHECK (bucket_interval IN ('hour', 'day', 'month')),
+            bucket_start TIMESTAMP NOT NULL,
+            first_date TIMESTAMP NOT NULL,
+            first_value DECIMAL(12,3) NOT NULL,
+            last_date TIMESTAMP NOT NULL,
+            last_value DECIMAL(12,3) NOT NULL,
+            min_value DECIMAL(12,3) NOT NULL,
+            max_value DECIMAL(12,3) NOT NULL,
+            reading_count INTEGER NOT NULL,
+            PRIMARY KEY (meter_id, bucket_interval, bucket_start)
+        );
+    ''')
+
+    # Statement-level trigger: one set-based upsert per INSERT statement,
+    # so a COPY-backed batch costs one rollup pass rather than one per row
+    cur.execute(f'''
+        CREATE OR REPLACE FUNCTION rollup_new_readings() RETURNS trigger AS $$
+        BEGIN
+            INSERT INTO reading_rollups AS r {ROLLUP_COLUMNS}
+            {ROLLUP_SELECT.format(source='new_readings', where='')}
+            ON CONFLICT (meter_id, bucket_interval, bucket_start) DO UPDATE SET
+                first_value = CASE WHEN EXCLUDED.first_date < r.first_date THEN EXCLUDED.first_value ELSE r.first_value END,
+                first_date = LEAST(r.first_date, EXCLUDED.first_date),
+                last_value = CASE WHEN EXCLUDED.last_date > r.last_date THEN EXCLUDED.last_value ELSE r.last_value END,
+                last_date = GREATEST(r.last_date, EXCLUDED.last_date),
+                min_value = LEAST(r.min_value, EXCLUDED.min_value),
+                max_value = GREATEST(r.max_value, EXCLUDED.max_value),
+                reading_count = r.reading_count + EXCLUDED.reading_count;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+    ''')
+    cur.execute('DROP TRIGGER IF EXISTS meter_readings_rollup ON meter_readings;')
+    cur.execute('''
+        CREATE TRIGGER meter_readings_rollup
+        AFTER INSERT ON meter_readings
+        REFERENCING NEW TABLE AS new_readings
+        FOR EACH STATEMENT EXECUTE FUNCTION rollup_new_readings();
+    ''')
+
+
+def rebuild_rollups(conn, meter_id=None):
+    """Recompute rollups from meter_readings, for one meter or the whole fleet."""
+    cur = conn.cursor()
+    if meter_id:
+        cur.execute('DELETE FROM reading_rollups WHERE meter_id = %s', (meter_id,))
+        where, params = 'WHERE n.meter_id = %s', (meter_id,)
+    else:
+        cur.execute('TRUNCATE reading_rollups')
+        where, params = '', ()
+    cur.execute(f'INSERT INTO reading_rollups {ROLLUP_COLUMNS} '
+                + ROLLUP_SELECT.format(source='meter_readings', where=where), params)
+    count = cur.rowcount
+    conn.commit()
+    return count
+
+
+def get_consumption(cur, meter_id, interval, start_date=None, end_date=None):
+    """Return consumption buckets for a meter, oldest first.
+
+    Consumption is measured from the last reading of the previous bucket,
+    so usage that straddles a bucket boundary is not lost. The first
+    bucket ever recorded falls back to its own first reading.
+    """
+    cur.execute('''
+        SELECT bucket_start, first_date, first_value, last_date, last_value,
+               min_value, max_value, reading_count, consumption
+        FROM (
+            SELECT bucket_start, first_date, first_value, last_date, last_value,
+                   min_value, max_value, reading_count,
+                   last_value - COALESCE(LAG(last_value) OVER (ORDER BY bucket_start), first_value) AS consumption
+            FROM reading_rollups
+            WHERE meter_id = %(meter_id)s AND bucket_interval = %(interval)s
+              AND bucket_start >= COALESCE((
+                  SELECT MAX(bucket_start) FROM reading_rollups
+                  WHERE meter_id = %(meter_id)s AND bucket_interval = %(interval)s
+                    AND bucket_start < date_trunc(%(interval)s, %(start_date)s::timestamp)
+              ), '-infinity')
+              AND (%(end_date)s::timestamp IS NULL OR bucket_start <= %(end_date)s::timestamp)
+        ) buckets
+        WHERE %(start_date)s::timestamp IS NULL OR bucket_start >= date_trunc(%(interval)s, %(start_date)s::timestamp)
+        ORDER BY bucket_start;
+    ''', {'meter_id': meter_id, 'interval': interval, 'start_date': start_date, 'end_date': end_date})
+
+    buckets = []
+    for row in cur.fetchall():
+        buckets.append({
+            'bucket_start': row[0].isoformat(),
+            'first_reading_date': row[1].isoformat(),
+            'first_value': float(row[2]),
+            'last_reading_date': row[3].isoformat(),
+            'last_value': float(row[4]),
+            'min_value': float(row[5]),
+            'max_value': float(row[6]),
+            'reading_count': row[7],
+            'consumption': float(row[8])
+        })
+    return buckets
@@ -0,0 +1,110 @@
+"""Cheap system statistics: planner estimates and rollup counters instead of COUNT(*) scans."""
+import os
+import threading
+import time
+from datetime import datetime, timezone
+
+STATS_CACHE_TTL = float(os.environ.get('STATS_CACHE_TTL', 10))
+
+
+class StatsService:
+    def __init__(self, ttl=STATS_CACHE_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._cache = {}        # exact flag -> (expires_at, payload)
+        self._server_version = None
+
+    def get(self, conn_factory, exact=False):
+        entry = self._cache.get(exact)
+        if entry is not None and entry[0] > time.monotonic():
+            return entry[1]
+        # One refresh at a time; concurrent callers pick up its result
+        with self._lock:
+            entry = self._cache.get(exact)
+            if entry is not None and entry[0] > time.monotonic():
+                return entry[1]
+            with conn_factory() as conn:
+                payload = self._compute(conn.cursor(), exact)
+            self._cache[exact] = (time.monotonic() + self.ttl, payload)
+            return payload
+
+    def invalidate(self):
+        self._cache = {}
+
+    def server_version(self, cur):
+        if self._server_version is None:
+            cur.execute('SELECT version()')
+            self._server_version = cur.fetchone()[0]
+        return self._server_version
+
+    def _compute(self, cur, exact):
+        cur.execute('SELECT utility_type, COUNT(*) FROM customers GROUP BY utility_type')
+        customers_by_type = dict(cur.fetchall())
+
+        cur.execute('SELECT status, meter_type, COUNT(*) FROM meters GROUP BY status, meter_type')
+        meters_by_status, meters_by_type = {}, {}
+        for status, meter_type, count in cur.fetchall():
+            meters_by_status[status] = meters_by_status.get(status, 0) + count
+            meters_by_type[meter_type] = meters_by_type.get(meter_type, 0) + count
+
+        if exact:
+            cur.execute('''
+                SELECT m.meter_type, COUNT(*)
+                FROM meter_readings r
+                JOIN meters m ON m.meter_id = r.meter_id
+                GROUP BY m.meter_type
+            ''')
+            readings_by_type = dict(cur.fetchall())
+            readings = sum(readings_by_type.values())
+            source = 'exact'
+        else:
+            # Per-type counts from the monthly rollups, which the ingestion trigger keeps current
+            cur.execute('''
+                SELECT m.meter_type, SUM(r.reading_count)::bigint
+                FROM reading_rollups r
+                JOIN meters m ON m.meter_id = r.meter_id
+                WHERE r.bucket_interval = 'month'
+                GROUP BY m.meter_type
+            ''')
+            readings_by_type = dict(cur.fetchall())
+            readings, source = self._estimate_readings(cur)
+            if readings is None:
+                readings, source = sum(readings_by_type.values()), 'rollups'
+
+        return {
+            'mode': 'exact' if exact else 'estimate',
+            'postgres_version': self.server_version(cur),
+            'data_summary': {
+                'customers': sum(customers_by_type.values()),
+                'meters': sum(meters_by_status.values()),
+                'readings': readings
+            },
+            'readings_count_source': source,
+            'customers_by_utility_type': customers_by_type,
+            'meters_by_status': meters_by_status,
+            'meters_by_type': meters_by_type,
+            'readings_by_meter_type': readings_by_type,
+            'generated_at': datetime.now(timezone.utc).isoformat(),
+            'cache_ttl_seconds': self.ttl
+        }
+
+    def _estimate_readings(self, cur):
+        # Partitioned tables keep their statistics on the partitions, not the parent
+        cur.execute('''
+            SELECT SUM(GREATEST(c.reltuples, 0))::bigint, bool_and(c.reltuples < 0)
+            FROM pg_class c
+            WHERE (c.oid = 'meter_readings'::regclass AND c.relkind = 'r')
+               OR c.oid IN (SELECT inhrelid FROM pg_inherits WHERE inhparent = 'meter_readings'::regclass)
+        ''')
+        estimate, never_analyzed = cur.fetchone()
+        # Before the first ANALYZE reltuples is -1 (0 before PostgreSQL 14)
+        if not estimate or never_analyzed:
+            return None, None
+        return estimate, 'pg_class.reltuples'
+
+
+_stats = StatsService()
+
+
+def get_stats_service():
+    return _stats